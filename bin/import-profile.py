@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Reports the time spent importing each module of the extension and the modules
+that are loaded because of it, on top of the CKAN modules that are already
+loaded by any CKAN worker. Each module is imported in a fresh interpreter.
+
+Usage: python bin/import-profile.py [--check]
+
+With --check, the script exits with an error when a module eagerly loads one
+of the modules that must only be imported on first use.
+"""
+
+from __future__ import print_function
+
+import json
+import subprocess
+import sys
+
+MODULES = [
+    'ckanext.baepublisher.store_connector',
+    'ckanext.baepublisher.plugin',
+    'ckanext.baepublisher.controllers.ui_controller',
+]
+
+# Modules already loaded by CKAN workers, they are not blamed on the extension
+BASELINE = [
+    'ckan.plugins',
+    'ckan.model',
+    'ckan.lib.base',
+    'ckan.lib.helpers',
+    'pylons',
+]
+
+# Modules that must only be loaded when the store is contacted for the first time
+DEFERRED = [
+    'requests_oauthlib',
+    'oauthlib',
+]
+
+PROBE = '''
+import json, sys, time
+for name in %(baseline)r:
+    __import__(name)
+before = set(sys.modules)
+start = time.time()
+__import__(%(module)r)
+elapsed = time.time() - start
+loaded = sorted(set(name.split('.')[0] for name in set(sys.modules) - before if sys.modules.get(name) is not None))
+ui = sys.modules.get('ckanext.baepublisher.controllers.ui_controller')
+logo_loaded = ui is not None and getattr(ui, '_LOGO_CKAN_B64', None) is not None
+print(json.dumps({'elapsed': elapsed, 'loaded': loaded, 'logo_loaded': logo_loaded}))
+'''
+
+
+def profile(module):
+    output = subprocess.check_output([sys.executable, '-c', PROBE % {'baseline': BASELINE, 'module': module}])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main(argv):
+    check = '--check' in argv
+    failed = False
+
+    print('%-50s %10s  %s' % ('module', 'time (ms)', 'new top-level modules'))
+    for module in MODULES:
+        result = profile(module)
+        print('%-50s %10.1f  %s' % (module, result['elapsed'] * 1000, ', '.join(result['loaded']) or '-'))
+
+        eager = [name for name in DEFERRED if name in result['loaded']]
+        if result['logo_loaded']:
+            eager.append('logo-ckan.png')
+
+        if eager:
+            failed = True
+            print('  eagerly loaded: %s' % ', '.join(eager))
+
+    return 1 if check and failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Drives publish and delete cycles against an in-process fake store and reports
+the memory retained by the worker: RSS growth and, when tracemalloc is
+available, the lines that allocated the retained memory. Run it in the CKAN
+virtualenv:
+
+Usage: python bin/soak.py [--cycles N] [--warm-up N] [--image-size KB]
+                          [--listing-size N] [--top N] [--max-growth KB]
+
+With --max-growth, the script exits with an error when the memory retained per
+cycle after the warm-up exceeds the given number of KB.
+"""
+
+from __future__ import print_function
+
+import argparse
+import base64
+from collections import defaultdict
+import gc
+import hashlib
+import itertools
+import json
+import os
+import resource
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+STORE_URL = 'http://store.soak'
+CATALOG_API = '/DSProductCatalog/api/catalogManagement/v2'
+
+
+def get_rss():
+    """
+    Returns the current resident set size in KB (the peak one when /proc is
+    not available)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize() // 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class FakeStore(object):
+    """
+    Minimal in-memory store with the endpoints used to publish and delete
+    datasets. It is plugged as the transport of the recording module, so the
+    store connector runs unchanged. Retired elements are removed, so the
+    memory of the fake store does not grow with the cycles.
+    """
+
+    def __init__(self, listing_size):
+        from ckanext.baepublisher.recording import ReplayResponse
+
+        self._response_class = ReplayResponse
+        self._ids = itertools.count(1)
+        self.products = {}
+        self.offerings = defaultdict(dict)
+
+        # Products of other datasets, so listings have a realistic size
+        for i in range(listing_size):
+            self._add_product({
+                'name': 'Other dataset %d' % i,
+                'description': 'x' * 500,
+                'productSpecCharacteristic': [{
+                    'name': 'Location',
+                    'productSpecCharacteristicValue': [{'value': 'http://ckan.soak/dataset/other-%d' % i}],
+                }],
+            })
+
+    def _add_product(self, product):
+        product_id = '%d' % next(self._ids)
+        product.update({
+            'id': product_id,
+            'href': '%s%s/productSpecification/%s:(0.1)' % (STORE_URL, CATALOG_API, product_id),
+            'lifecycleStatus': 'Launched',
+        })
+        self.products[product_id] = product
+        return product
+
+    def _response(self, url, status_code, body, headers=None):
+        headers = dict(headers or {})
+        headers['ETag'] = '"%s"' % hashlib.sha1(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()
+        return self._response_class(url, {'status_code': status_code, 'headers': headers, 'body': body, 'encoding': 'json'})
+
+    def send(self, method, send, url, **kwargs):
+        path, _, query = url[len(STORE_URL):].partition('?')
+        params = dict(param.split('=', 1) for param in query.split('&') if '=' in param)
+        data = kwargs.get('json')
+
+        if path.endswith('/assets/uploadJob'):
+            location = '%s/charging/api/assetManagement/assets/%d' % (STORE_URL, next(self._ids))
+            return self._response(url, 201, {}, {'Location': location})
+
+        if method == 'get' and path.endswith('/productSpecification/'):
+            products = list(self.products.values())
+            return self._response(url, 200, products)
+
+        if method == 'post' and path.endswith('/productSpecification/'):
+            return self._response(url, 201, self._add_product(dict(data)))
+
+        if method == 'get' and path.endswith('/productOffering/'):
+            offerings = list(self.offerings.get(params.get('productSpecification.id'), {}).values())
+            return self._response(url, 200, offerings)
+
+        if method == 'post' and path.endswith('/productOffering/'):
+            offering_id = '%d' % next(self._ids)
+            offering = dict(data, id=offering_id, href='%s%s%s:(0.1)' % (STORE_URL, path, offering_id))
+            self.offerings[data['productSpecification']['id']][offering_id] = offering
+            return self._response(url, 201, offering)
+
+        if method == 'patch':
+            element_id = path.rstrip('/').split('/')[-1]
+            if data.get('lifecycleStatus') == 'Retired':
+                if '/productSpecification/' in path:
+                    self.products.pop(element_id, None)
+                    self.offerings.pop(element_id, None)
+                else:
+                    for offerings in self.offerings.values():
+                        offerings.pop(element_id, None)
+            return self._response(url, 200, {'id': element_id})
+
+        return self._response(url, 404, {'error': 'Not found: %s %s' % (method, path)})
+
+
+def get_connector():
+    from ckanext.baepublisher.store_connector import StoreConnector
+
+    class SoakConnector(StoreConnector):
+        # The CKAN database is not used, only the requests to the store are measured
+
+        def _save_acquire_url(self, dataset_id, acquire_url):
+            pass
+
+        def _get_published_offering(self, idempotency_key):
+            return None
+
+        def _record_published_offering(self, idempotency_key, dataset, offering_info, offering_url):
+            pass
+
+        def _forget_published_offerings(self, dataset):
+            pass
+
+    connector = SoakConnector({
+        'ckan.site_url': 'http://ckan.soak',
+        'ckan.baepublisher.store_url': STORE_URL,
+        'ckan.baepublisher.lock_backend': 'local',
+    })
+    return connector.bind('soak', {'token_type': 'bearer', 'access_token': 'soak'})
+
+
+def run_cycle(connector, cycle, image_size):
+    dataset = {
+        'id': 'dataset-%d' % cycle,
+        'name': 'dataset-%d' % cycle,
+        'title': 'Dataset %d' % cycle,
+        'notes': 'Description of the dataset %d' % cycle,
+        'type': 'dataset',
+        'version': '1.0',
+        'private': False,
+        'license_title': 'Creative Commons Attribution',
+        'license_url': 'http://www.opendefinition.org/licenses/cc-by',
+    }
+
+    # The image is encoded as the publish form does
+    offering_info = {
+        'pkg_id': dataset['id'],
+        'name': dataset['title'],
+        'description': dataset['notes'],
+        'license_title': dataset['license_title'],
+        'license_description': '',
+        'version': '1.0',
+        'is_open': True,
+        'catalog': '1',
+        'categories': [],
+        'role': '',
+        'image_base64': base64.b64encode(os.urandom(image_size * 1024)),
+    }
+
+    phases = {}
+    for phase, action in (('publish', lambda: connector.create_offering(dataset, offering_info)),
+                          ('delete', lambda: connector.delete_attached_resources(dataset))):
+        before = tracemalloc.get_traced_memory()[0] if tracemalloc and tracemalloc.is_tracing() else 0
+        action()
+        after = tracemalloc.get_traced_memory()[0] if tracemalloc and tracemalloc.is_tracing() else 0
+        phases[phase] = after - before
+
+    return phases
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Memory soak test of the publish and delete paths')
+    parser.add_argument('--cycles', type=int, default=2000)
+    parser.add_argument('--warm-up', type=int, default=100)
+    parser.add_argument('--image-size', type=int, default=64, help='size of the offering image in KB')
+    parser.add_argument('--listing-size', type=int, default=200, help='products of other datasets in the store')
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--max-growth', type=float, default=None, help='retained KB per cycle allowed')
+    args = parser.parse_args(argv)
+
+    from ckanext.baepublisher import recording
+
+    recording.TRANSPORT = FakeStore(args.listing_size)
+    connector = get_connector()
+
+    start = time.time()
+    for cycle in range(args.warm_up):
+        run_cycle(connector, cycle, args.image_size)
+
+    if tracemalloc is not None:
+        tracemalloc.start(10)
+    gc.collect()
+    rss_before = get_rss()
+    baseline = tracemalloc.take_snapshot() if tracemalloc is not None else None
+
+    retained = defaultdict(int)
+    for cycle in range(args.warm_up, args.warm_up + args.cycles):
+        for phase, size in run_cycle(connector, cycle, args.image_size).items():
+            retained[phase] += size
+
+    gc.collect()
+    rss_after = get_rss()
+    growth = float(rss_after - rss_before) / max(args.cycles, 1)
+
+    print('cycles: %d (+%d warm-up) in %.1fs' % (args.cycles, args.warm_up, time.time() - start))
+    print('RSS: %d KB -> %d KB (%+.2f KB per cycle)' % (rss_before, rss_after, growth))
+
+    if baseline is not None:
+        snapshot = tracemalloc.take_snapshot()
+        traced = sum(stat.size_diff for stat in snapshot.compare_to(baseline, 'filename'))
+        growth = float(traced) / 1024 / max(args.cycles, 1)
+        print('Traced growth: %+.1f KB (%+.2f KB per cycle)' % (float(traced) / 1024, growth))
+
+        print('\nRetained per code path (KB):')
+        for phase in sorted(retained):
+            print('  %-10s %+.1f' % (phase, float(retained[phase]) / 1024))
+
+        print('\nTop allocators of the retained memory:')
+        for stat in snapshot.compare_to(baseline, 'lineno')[:args.top]:
+            frame = stat.traceback[0]
+            print('  %+10.1f KB %8d blocks  %s:%d' % (
+                float(stat.size_diff) / 1024, stat.count_diff, frame.filename, frame.lineno))
+    else:
+        print('tracemalloc not available, only the RSS is reported')
+
+    if args.max_growth is not None and growth > args.max_growth:
+        print('\nRetained memory per cycle exceeds %.2f KB' % args.max_growth)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,3 +1,8 @@
 #!/usr/bin/env bash
 
-python setup.py nosetests
\ No newline at end of file
+set -e
+
+python setup.py nosetests
+
+# Modules that must only be loaded on first use are not imported eagerly
+python bin/import-profile.py --check
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3 import connection, connectionpool
+from requests.packages.urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from requests.packages.urllib3.util import connection as connection_util
+
+from ckanext.baepublisher import connections
+
+
+class _StoreConnectionMixin(object):
+    """
+    Resolves the host with the shared DNS cache and records the time spent
+    opening the connection. The TLS handshake still uses the host name, so
+    the certificate is verified against it.
+    """
+
+    def _new_conn(self):
+        address = connections.DNS_CACHE.resolve(self.host, self.port)
+
+        kwargs = {}
+        if getattr(self, 'source_address', None):
+            kwargs['source_address'] = self.source_address
+        if getattr(self, 'socket_options', None):
+            kwargs['socket_options'] = self.socket_options
+
+        try:
+            return connection_util.create_connection(address, self.timeout, **kwargs)
+        except socket.timeout:
+            raise ConnectTimeoutError(self, 'Connection to %s timed out. (connect timeout=%s)' % (self.host, self.timeout))
+        except socket.error as e:
+            # The host may have moved to another address
+            connections.DNS_CACHE.forget(self.host, self.port)
+            raise NewConnectionError(self, 'Failed to establish a new connection: %s' % e)
+
+    def connect(self):
+        start = time.time()
+        super(_StoreConnectionMixin, self).connect()
+        connections.connection_opened(time.time() - start)
+
+
+class StoreHTTPConnection(_StoreConnectionMixin, connection.HTTPConnection):
+    pass
+
+
+class StoreHTTPSConnection(_StoreConnectionMixin, connection.HTTPSConnection):
+    pass
+
+
+class StoreHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+    ConnectionCls = StoreHTTPConnection
+
+
+class StoreHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+    ConnectionCls = StoreHTTPSConnection
+
+
+class StoreAdapter(HTTPAdapter):
+    """
+    Adapter shared by the sessions of all the requests to the store, so their
+    connections are kept alive and reused
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.last_used = 0
+        super(StoreAdapter, self).__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(StoreAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': StoreHTTPConnectionPool,
+            'https': StoreHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        connections.request_started()
+        try:
+            return super(StoreAdapter, self).send(request, **kwargs)
+        finally:
+            self.last_used = time.time()
+            connections.request_finished()
+
+    def _get_pool(self, url, verify):
+        # The same pool, with the same TLS settings, that send uses for the URL. Sessions
+        # replace verify with the CA bundle set in the environment, if any
+        verify = requests.Session().merge_environment_settings(url, {}, None, verify, None)['verify']
+        if hasattr(self, 'get_connection_with_tls_context'):
+            pool = self.get_connection_with_tls_context(requests.Request('GET', url).prepare(), verify)
+        else:
+            pool = self.get_connection(url)
+        self.cert_verify(pool, url, verify, None)
+        return pool
+
+    def prewarm(self, url, count, verify=True):
+        pool = self._get_pool(url, verify)
+
+        # All the connections are taken from the pool first, so each one is a different connection
+        conns = [pool._get_conn() for _ in range(count)]
+        opened = []
+
+        def _connect(conn):
+            try:
+                if getattr(conn, 'sock', None) is None:
+                    conn.connect()
+                    opened.append(conn)
+            except Exception:
+                conn.close()
+
+        threads = [threading.Thread(target=_connect, args=(conn,)) for conn in conns]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for conn in conns:
+            pool._put_conn(conn)
+
+        self.last_used = time.time()
+        return len(opened)
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from collections import namedtuple, OrderedDict
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class RefreshAheadCache(object):
+    """
+    Thread safe cache whose entries are refreshed in background before they
+    expire. Entries older than ttl are still served (while they are being
+    refreshed) until they are older than ttl + max_stale, so callers only
+    wait for the loader when the key is not cached or its value is too old.
+    Entries that cannot be served anymore are dropped, and only the
+    max_entries most recently used are kept (e.g. the catalogs of each user).
+
+    :param ttl: Seconds during which an entry is fresh
+    :param refresh_ahead: Seconds before the expiration when the background
+        refresh starts
+    :param max_stale: Seconds after the expiration during which the stale value
+        is served
+    :param max_entries: Maximum number of entries kept
+    """
+
+    def __init__(self, ttl=300, refresh_ahead=60, max_stale=3600, max_entries=1000):
+        self._guard = threading.Lock()
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self.configure(ttl, refresh_ahead, max_stale, max_entries)
+
+    def configure(self, ttl, refresh_ahead, max_stale, max_entries=1000):
+        self.ttl = ttl
+        self.refresh_ahead = min(refresh_ahead, ttl)
+        self.max_stale = max_stale
+        with self._guard:
+            self.max_entries = max_entries
+            self._evict(time.time())
+
+    def __len__(self):
+        with self._guard:
+            return len(self._entries)
+
+    def _evict(self, now):
+        for key in [key for key, (_, loaded) in self._entries.items() if now - loaded >= self.ttl + self.max_stale]:
+            del self._entries[key]
+
+        # Entries are kept in order of use, so the least recently used ones are first
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._guard:
+            self._entries.clear()
+
+    def set(self, key, value):
+        now = time.time()
+        with self._guard:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, now)
+            self._evict(now)
+
+    def get(self, key, loader):
+        """
+        Returns the value of the key, calling loader() to get it when needed. The
+        exceptions of the loader are only propagated when there is no value that
+        can be served.
+        """
+        with self._guard:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+
+        if entry is not None:
+            value, loaded = entry
+            age = time.time() - loaded
+
+            if age < self.ttl + self.max_stale:
+                if age >= self.ttl - self.refresh_ahead:
+                    self.refresh(key, loader)
+                return value
+
+        value = loader()
+        self.set(key, value)
+        return value
+
+    def refresh(self, key, loader):
+        """
+        Reloads the value of the key in a background thread, unless it is
+        already being reloaded
+        """
+        with self._guard:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        thread = threading.Thread(target=self._refresh, args=(key, loader))
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self, key, loader):
+        try:
+            self.set(key, loader())
+        except Exception as e:
+            log.warn('Cache entry %s could not be refreshed: %s' % (key, e))
+        finally:
+            with self._guard:
+                self._refreshing.discard(key)
+
+
+class ExpiringDict(object):
+    """
+    Thread safe dictionary whose entries are dropped ttl seconds after they are
+    set, keeping at most max_entries, so the entries that are never popped do
+    not accumulate.
+    """
+
+    def __init__(self, ttl=300, max_entries=1000):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._guard = threading.Lock()
+        self._entries = OrderedDict()
+
+    def _expire(self, now):
+        # Entries are kept in insertion order, so the oldest ones are first
+        while self._entries:
+            key = next(iter(self._entries))
+            if self._entries[key][1] > now and len(self._entries) <= self._max_entries:
+                break
+            del self._entries[key]
+
+    def __len__(self):
+        with self._guard:
+            self._expire(time.time())
+            return len(self._entries)
+
+    def set(self, key, value):
+        now = time.time()
+        with self._guard:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, now + self._ttl)
+            self._expire(now)
+
+    def pop(self, key, default=None):
+        with self._guard:
+            entry = self._entries.pop(key, None)
+
+        if entry is None or entry[1] <= time.time():
+            return default
+        return entry[0]
+
+
+ValidatedEntry = namedtuple('ValidatedEntry', ['etag', 'last_modified', 'data', 'size'])
+
+
+class ValidatorCache(object):
+    """
+    Keeps the validators (ETag and Last-Modified headers) of the responses
+    together with their parsed bodies, so the requests can be made conditional
+    and a 304 response can reuse the parsed body. Only the most recently used
+    entries are kept, up to max_bytes of response bodies, so the memory used
+    by the parsed bodies is bounded no matter how big the listings are.
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._guard = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def configure(self, max_bytes):
+        with self._guard:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    @property
+    def size(self):
+        return self._size
+
+    def _evict(self):
+        while self._size > self.max_bytes:
+            _, entry = self._entries.popitem(last=False)
+            self._size -= entry.size
+
+    def get(self, key):
+        with self._guard:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def put(self, key, response, data):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        size = len(response.content or b'')
+
+        with self._guard:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry.size
+
+            # Responses without validators cannot be revalidated, and bodies bigger
+            # than the whole cache would only evict the rest of the entries
+            if (etag or last_modified) and size <= self.max_bytes:
+                self._entries[key] = ValidatedEntry(etag, last_modified, data, size)
+                self._size += size
+                self._evict()
+
+    def clear(self):
+        with self._guard:
+            self._entries.clear()
+            self._size = 0
+
+    @staticmethod
+    def get_conditional_headers(entry):
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def fetch(self, key, request):
+        """
+        Makes a conditional request and returns the parsed body of the response,
+        or the cached one when the resource has not been modified
+
+        :param request: Function that receives the conditional headers and makes
+            the request
+        """
+        entry = self.get(key)
+        response = request(self.get_conditional_headers(entry))
+
+        if response.status_code == 304 and entry is not None:
+            return entry.data
+
+        data = response.json()
+        self.put(key, response, data)
+        return data
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Snapshot layout: header, one fixed size record per category and a blob with
+# the UTF-8 encoded strings referenced by the records (offset, length)
+MAGIC = b'BAECAT01'
+HEADER = struct.Struct(str('<8sQ20sI'))
+RECORD = struct.Struct(str('<9I'))
+FLAG_ROOT = 1
+FLAG_CHILD = 2
+
+STRING_FIELDS = ['id', 'name', 'href', 'parentId']
+
+
+def get_digest(categories):
+    return hashlib.sha1(json.dumps(categories, sort_keys=True).encode('utf-8')).digest()
+
+
+def serialize(categories, relatives, version):
+    """
+    Serializes the sorted list of categories and their relatives (as returned
+    by reference_data.sort_categories) into a snapshot
+    """
+    records = []
+    blob = bytearray()
+
+    for category in categories:
+        values = []
+        for field in STRING_FIELDS:
+            value = ('%s' % category.get(field, '')).encode('utf-8')
+            values.extend([len(blob), len(value)])
+            blob.extend(value)
+
+        flags = FLAG_ROOT if category.get('isRoot') else 0
+        if 'parentId' in relatives.get(category['id'], {}):
+            flags |= FLAG_CHILD
+        values.append(flags)
+        records.append(RECORD.pack(*values))
+
+    header = HEADER.pack(MAGIC, version, get_digest(categories), len(categories))
+    return header + b''.join(records) + bytes(blob)
+
+
+class CategorySnapshot(object):
+    """
+    Read only view of a snapshot file. The file is memory mapped, so all the
+    processes reading the same snapshot share its pages. The categories are
+    decoded into new dicts on each read, so callers can modify them.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.version, self.digest, self._count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError('%s is not a category snapshot' % path)
+
+        self._strings_offset = HEADER.size + RECORD.size * self._count
+        # Last time the categories were confirmed, kept up to date by SnapshotStore
+        self.updated = self.version / 1000.0
+
+    def __len__(self):
+        return self._count
+
+    def _get_record(self, index):
+        values = RECORD.unpack_from(self._mmap, HEADER.size + RECORD.size * index)
+        fields = {}
+        for i, field in enumerate(STRING_FIELDS):
+            start = self._strings_offset + values[2 * i]
+            fields[field] = self._mmap[start:start + values[2 * i + 1]].decode('utf-8')
+        return fields, values[-1]
+
+    def category(self, index):
+        fields, flags = self._get_record(index)
+        fields['isRoot'] = bool(flags & FLAG_ROOT)
+        return fields
+
+    def categories(self):
+        return [self.category(i) for i in range(self._count)]
+
+    def relatives(self):
+        relatives = {}
+        for i in range(self._count):
+            fields, flags = self._get_record(i)
+            relative = {'href': fields['href'], 'id': fields['id']}
+            if flags & FLAG_CHILD:
+                relative['parentId'] = fields['parentId']
+            relatives[fields['id']] = relative
+        return relatives
+
+    def close(self):
+        self._mmap.close()
+
+
+class SnapshotStore(object):
+    """
+    Publishes and opens the category snapshot of a path. New snapshots are
+    written to a temporary file and renamed, so readers always see a complete
+    snapshot and pick up new versions atomically.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._guard = threading.Lock()
+        self._snapshot = None
+        self._stat = None
+
+    def current(self):
+        """
+        Returns the latest published snapshot, or None if there is none
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            st = None
+
+        # New snapshots are always renamed over the path, so the inode identifies
+        # them. The modification time only tracks when the snapshot was confirmed
+        stat = (st.st_ino, st.st_size) if st is not None else None
+
+        with self._guard:
+            if stat != self._stat:
+                snapshot = None
+                if stat is not None:
+                    try:
+                        snapshot = CategorySnapshot(self.path)
+                    except (IOError, OSError, ValueError, struct.error) as e:
+                        log.warn('Category snapshot %s could not be opened: %s' % (self.path, e))
+
+                # Previous snapshots are not closed, since they can still be in use
+                self._snapshot = snapshot
+                self._stat = stat
+
+            if self._snapshot is not None:
+                self._snapshot.updated = st.st_mtime
+
+            return self._snapshot
+
+    def publish(self, categories, relatives):
+        """
+        Writes a new snapshot, unless the categories have not changed. In that
+        case the current snapshot is only marked as up to date.
+
+        :returns: Whether a new snapshot has been written
+        :rtype: bool
+        """
+        now = time.time()
+        current = self.current()
+        if current is not None and current.digest == get_digest(categories):
+            os.utime(self.path, (now, now))
+            return False
+
+        data = serialize(categories, relatives, int(now * 1000))
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.categories')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.utime(tmp_path, (now, now))
+            os.rename(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        return True
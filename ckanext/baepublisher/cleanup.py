@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+import logging
+from multiprocessing.pool import ThreadPool
+
+import ckan.model as model
+
+from ckanext.baepublisher import db
+from ckanext.baepublisher.reconcile import get_dataset_products, get_package_states, is_active, parse_date, PRODUCT_ID_RE
+from ckanext.baepublisher.store_connector import INACTIVE_STATUSES
+
+log = logging.getLogger(__name__)
+
+CURSOR_KEY = 'gc_cursor'
+
+
+class GarbageCollector(object):
+    """
+    Retires the product specifications left behind by failed publications:
+    active products of this CKAN instance that are not included in any
+    offering, are not the acquire URL of any dataset and do not belong to a
+    publication that can still be resumed. Only the products older than
+    min_age hours are considered, so publications in progress are not
+    affected. The newest product of each dataset that still exists is kept,
+    since the next publication of the dataset reuses it.
+
+    Each run checks up to max_pages pages of the product listing, starting
+    where the previous run stopped, so the size of each pass is bounded.
+    Publish checkpoints that have expired are removed too, and the assets they
+    uploaded are reported, since the store does not allow removing them.
+    """
+
+    def __init__(self, connector, page_size=100, workers=4, max_pages=10, min_age=24):
+        self._connector = connector
+        self._page_size = page_size
+        self._workers = workers
+        self._max_pages = max_pages
+        self._min_age = timedelta(hours=min_age)
+        self._dataset_prefix = '%s/dataset/' % connector.site_url
+
+    def _get_page(self, offset):
+        return self._connector._get_json(
+            '%s/DSProductCatalog/api/catalogManagement/v2/productSpecification/?offset=%d&size=%d' % (
+                self._connector.store_url, offset, self._page_size))
+
+    def _get_referenced_products(self):
+        # Products of the acquire URLs of the datasets
+        referenced = set()
+        query = model.Session.query(model.PackageExtra.value).filter(
+            model.PackageExtra.key == 'acquire_url', model.PackageExtra.state == 'active')
+        for (acquire_url,) in query:
+            match = PRODUCT_ID_RE.search(acquire_url or '')
+            if match is not None:
+                referenced.add(match.group(1))
+
+        # Products of the publications that can still be resumed
+        expiration = datetime.utcnow() - self._connector.checkpoint_ttl
+        for checkpoint in model.Session.query(db.PublishCheckpoint).filter(db.PublishCheckpoint.modified >= expiration):
+            product = checkpoint.get_steps().get('product')
+            if product:
+                referenced.add(product['id'])
+
+        return referenced
+
+    def _get_package_states(self, package_ids):
+        return get_package_states(package_ids, self._page_size)
+
+    def _get_package_id(self, product):
+        location = self._connector._get_product_url(product.get('productSpecCharacteristic', []))
+        return location[len(self._dataset_prefix):]
+
+    def _get_last_update(self, product):
+        return parse_date(product.get('lastUpdate')) or parse_date(product.get('validFor', {}).get('startDateTime'))
+
+    def _get_age(self, product, now):
+        last_update = self._get_last_update(product)
+        return now - last_update if last_update is not None else None
+
+    def _get_duplicates(self, package_id):
+        # Products of a dataset that can be retired without breaking its next publication:
+        # all of them but the newest one that can still be reused
+        try:
+            products = [product for product in get_dataset_products(
+                self._connector, self._dataset_prefix + package_id, self._page_size)
+                if product.get('lifecycleStatus', '').lower() not in INACTIVE_STATUSES]
+            if not products:
+                return package_id, set(), None
+
+            newest = max(products, key=lambda product: (self._get_last_update(product) or datetime.min, product['id']))
+            return package_id, set(product['id'] for product in products if product is not newest), None
+        except Exception as e:
+            return package_id, set(), e
+
+    def _is_candidate(self, product, referenced, now):
+        location = self._connector._get_product_url(product.get('productSpecCharacteristic', []))
+        age = self._get_age(product, now)
+        return (is_active(product) and location.startswith(self._dataset_prefix) and
+                product['id'] not in referenced and age is not None and age >= self._min_age)
+
+    def _check(self, product):
+        try:
+            offerings = self._connector._get_json(
+                '%s/DSProductCatalog/api/catalogManagement/v2/productOffering/?productSpecification.id=%s' % (
+                    self._connector.store_url, product['id']))
+            return product, len(offerings) == 0, None
+        except Exception as e:
+            return product, False, e
+
+    def _retire(self, product):
+        try:
+            self._connector._retire_catalog_element(self._connector._normalize_catalog_url(product['href']))
+            return product['id'], None
+        except Exception as e:
+            return product['id'], e
+
+    def _expire_checkpoints(self, dry_run):
+        expiration = datetime.utcnow() - self._connector.checkpoint_ttl
+        query = model.Session.query(db.PublishCheckpoint).filter(db.PublishCheckpoint.modified < expiration)
+
+        assets = []
+        checkpoints = 0
+        for checkpoint in query:
+            checkpoints += 1
+            steps = checkpoint.get_steps()
+            if steps.get('image') and not steps.get('product'):
+                assets.append(steps['image'])
+
+        if not dry_run and checkpoints:
+            query.delete(synchronize_session=False)
+            model.Session.commit()
+
+        return checkpoints, assets
+
+    def run(self, dry_run=False):
+        """
+        Runs a collection pass
+
+        :param dry_run: Whether the orphaned products are only reported
+        :type dry_run: bool
+
+        :returns: A summary of the pass: number of checked products and expired
+            checkpoints, and the ids of orphaned, retired and failed products and
+            the URLs of the orphaned assets
+        :rtype: dict
+        """
+        db.init_db(model)
+        now = datetime.utcnow()
+        offset = int(db.State.get(CURSOR_KEY, 0) or 0)
+        referenced = self._get_referenced_products()
+
+        checked = 0
+        candidates = []
+        for _ in range(self._max_pages):
+            page = self._get_page(offset)
+            checked += len(page)
+            candidates.extend(product for product in page if self._is_candidate(product, referenced, now))
+
+            if len(page) < self._page_size:
+                # The end of the listing has been reached, the next pass starts again
+                offset = 0
+                break
+
+            offset += self._page_size
+
+        orphans = []
+        retired = []
+        failed = []
+        pool = ThreadPool(self._workers)
+        try:
+            # Products of datasets that still exist are only collected when they are not the
+            # newest product of the dataset, since the next publication reuses that one
+            package_ids = set(self._get_package_id(product) for product in candidates)
+            states = self._get_package_states(list(package_ids))
+            live = [package_id for package_id in package_ids if states.get(package_id, 'deleted') != 'deleted']
+
+            duplicates = set()
+            for package_id, products, error in pool.imap_unordered(self._get_duplicates, live):
+                if error is not None:
+                    log.warn('Products of dataset %s could not be checked: %s' % (package_id, error))
+                duplicates.update(products)
+
+            candidates = [product for product in candidates
+                          if states.get(self._get_package_id(product), 'deleted') == 'deleted' or product['id'] in duplicates]
+
+            for product, orphaned, error in pool.imap_unordered(self._check, candidates):
+                if error is not None:
+                    log.warn('Offerings of product %s could not be checked: %s' % (product['id'], error))
+                elif orphaned:
+                    orphans.append(product)
+
+            if not dry_run:
+                for product_id, error in pool.imap_unordered(self._retire, orphans):
+                    if error is None:
+                        retired.append(product_id)
+                    else:
+                        log.warn('Product %s could not be retired: %s' % (product_id, error))
+                        failed.append(product_id)
+        finally:
+            pool.close()
+            pool.join()
+
+        checkpoints, assets = self._expire_checkpoints(dry_run)
+
+        if not dry_run:
+            db.State.set(CURSOR_KEY, '%d' % offset)
+
+        summary = {
+            'products': checked,
+            'orphans': [product['id'] for product in orphans],
+            'retired': retired,
+            'failed': failed,
+            'checkpoints': checkpoints,
+            'assets': assets,
+        }
+        log.info('Garbage collection finished: %s' % summary)
+        return summary
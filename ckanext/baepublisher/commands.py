@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+
+from ckan.lib.cli import CkanCommand
+
+
+class BaePublisherCommand(CkanCommand):
+    '''Maintenance tasks of the BAE publisher
+
+    Usage:
+      baepublisher reconcile [--full] [--workers=N] [--page-size=N]
+                             [--max-lookups=N]
+        - Retires the store products of deleted datasets and repairs the
+          acquire URLs that point to products that are not active anymore.
+          Only the datasets and products modified since the last run are
+          checked, unless --full is given. The products of datasets purged
+          after their last update in the store are only retired by --full
+          runs. When more than --max-lookups deleted or private datasets
+          have been modified, all the products are listed instead of
+          requesting the ones of each dataset.
+
+      baepublisher gc [--dry-run] [--workers=N] [--page-size=N] [--max-pages=N]
+                      [--min-age=HOURS] [--rate=N]
+        - Retires the product specifications left behind by failed
+          publications, which are not included in any offering. The newest
+          product of each dataset that still exists is kept. Each run checks
+          up to --max-pages pages of products, starting where the previous
+          run stopped. With --dry-run the orphaned products are only
+          listed. --rate limits the requests per second sent to the store.
+
+    The store is accessed using the account configured in
+    ckan.baepublisher.service_user and ckan.baepublisher.service_token
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 1
+    min_args = 1
+
+    def __init__(self, name):
+        super(BaePublisherCommand, self).__init__(name)
+        self.parser.add_option('--full', dest='full', action='store_true', default=False,
+                               help='Check all the datasets and products')
+        self.parser.add_option('--workers', dest='workers', type='int', default=4,
+                               help='Number of concurrent requests to the store')
+        self.parser.add_option('--page-size', dest='page_size', type='int', default=100,
+                               help='Number of elements requested in each page')
+        self.parser.add_option('--max-lookups', dest='max_lookups', type='int', default=100,
+                               help='Maximum number of datasets whose products are requested one by one')
+        self.parser.add_option('--dry-run', dest='dry_run', action='store_true', default=False,
+                               help='List the orphaned products without retiring them')
+        self.parser.add_option('--max-pages', dest='max_pages', type='int', default=10,
+                               help='Maximum number of pages of products checked in each run')
+        self.parser.add_option('--min-age', dest='min_age', type='int', default=24,
+                               help='Minimum age, in hours, of the products that can be retired')
+        self.parser.add_option('--rate', dest='rate', type='float', default=None,
+                               help='Maximum number of requests per second sent to the store')
+
+    def command(self):
+        self._load_config()
+
+        cmd = self.args[0]
+        if cmd == 'reconcile':
+            self.reconcile()
+        elif cmd == 'gc':
+            self.gc()
+        else:
+            print('Command %s not recognized' % cmd)
+            print(self.usage)
+
+    def _get_connector(self):
+        from pylons import config
+        from ckanext.baepublisher.store_connector import StoreConnector
+
+        return StoreConnector(config).bind_service()
+
+    def reconcile(self):
+        from ckanext.baepublisher.reconcile import Reconciler
+
+        reconciler = Reconciler(self._get_connector(), self.options.page_size, self.options.workers,
+                                self.options.max_lookups)
+        summary = reconciler.run(self.options.full)
+
+        print('Checked %d datasets and %d products' % (summary['datasets'], summary['products']))
+        print('Retired products: %s' % (', '.join(summary['retired']) or '-'))
+        print('Repaired datasets: %s' % (', '.join(summary['repaired']) or '-'))
+        if summary['failed']:
+            print('Failed products (they will be checked again in the next run): %s' % ', '.join(summary['failed']))
+
+    def gc(self):
+        from ckanext.baepublisher.cleanup import GarbageCollector
+        from ckanext.baepublisher.ratelimit import RateLimiter
+
+        connector = self._get_connector()
+        if self.options.rate:
+            from pylons import config
+
+            connector._rate_limiter = RateLimiter(dict(config, **{
+                'ckan.baepublisher.rate_limit_reads': self.options.rate,
+                'ckan.baepublisher.rate_limit_writes': self.options.rate,
+            }))
+
+        collector = GarbageCollector(connector, self.options.page_size, self.options.workers,
+                                     self.options.max_pages, self.options.min_age)
+        summary = collector.run(self.options.dry_run)
+
+        print('Checked %d products' % summary['products'])
+        if self.options.dry_run:
+            print('Orphaned products: %s' % (', '.join(summary['orphans']) or '-'))
+        else:
+            print('Retired products: %s' % (', '.join(summary['retired']) or '-'))
+        print('Expired publish checkpoints: %d' % summary['checkpoints'])
+        if summary['assets']:
+            print('Orphaned assets (they cannot be removed from the store): %s' % ', '.join(summary['assets']))
+        if summary['failed']:
+            print('Failed products (they will be checked again in the next run): %s' % ', '.join(summary['failed']))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import gzip
+import io
+import json
+import logging
+
+from ckanext.baepublisher import metrics
+
+log = logging.getLogger(__name__)
+
+COMPRESSED_ENCODINGS = ('gzip', 'deflate')
+
+
+class CompressionPolicy(object):
+    """
+    Decides which request bodies are sent compressed. Only the endpoints whose
+    URL contains one of the fragments of ckan.baepublisher.compress_requests
+    (e.g. assetManagement/assets/uploadJob) accept compressed bodies, and only
+    bodies bigger than ckan.baepublisher.compress_min_size bytes are compressed.
+    """
+
+    def __init__(self, config):
+        self.endpoints = config.get('ckan.baepublisher.compress_requests', '').split()
+        self.min_size = int(config.get('ckan.baepublisher.compress_min_size', 1024))
+
+    def encode(self, url, data):
+        """
+        Returns the gzipped JSON representation of the data, or None when the
+        body must be sent as is
+        """
+        if data is None or not any(endpoint in url for endpoint in self.endpoints):
+            return None
+
+        body = json.dumps(data).encode('utf-8')
+        if len(body) < self.min_size:
+            return None
+
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(body)
+        compressed = buf.getvalue()
+
+        metrics.increment('request_bytes', len(compressed))
+        metrics.increment('request_bytes_saved', len(body) - len(compressed))
+        return compressed
+
+
+def record_response(response):
+    """
+    Updates the counters of transferred and saved bytes with a response whose
+    body has been compressed by the store
+    """
+    encoding = response.headers.get('Content-Encoding')
+    if encoding not in COMPRESSED_ENCODINGS:
+        return
+
+    try:
+        transferred = int(response.headers.get('Content-Length') or response.raw.tell())
+        saved = len(response.content) - transferred
+    except Exception as e:
+        log.debug('Compressed size of the response could not be calculated: %s' % e)
+        return
+
+    metrics.increment('response_bytes', transferred)
+    metrics.increment('response_bytes_saved', saved)
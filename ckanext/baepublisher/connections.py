@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import logging
+import socket
+import threading
+import time
+
+from ckanext.baepublisher import metrics
+
+log = logging.getLogger(__name__)
+
+# Whether the current request has opened a new connection
+_local = threading.local()
+
+
+class DNSCache(object):
+    """
+    Thread safe cache of the addresses of the store hosts. Python does not
+    expose the TTL of the DNS records, so the addresses are kept for ttl
+    seconds. A ttl of 0 disables the cache.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._guard = threading.Lock()
+        self._entries = {}
+
+    def clear(self):
+        with self._guard:
+            self._entries.clear()
+
+    def resolve(self, host, port):
+        key = (host, port)
+        with self._guard:
+            entry = self._entries.get(key)
+
+        if entry is not None and entry['expires'] > time.time():
+            metrics.increment('dns_cache_hits')
+            metrics.increment('dns_time_saved_ms', int(entry['lookup_time'] * 1000))
+            return entry['address']
+
+        start = time.time()
+        address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][4][:2]
+        lookup_time = time.time() - start
+        metrics.increment('dns_lookups')
+
+        if self.ttl > 0:
+            with self._guard:
+                self._entries[key] = {
+                    'address': address,
+                    'expires': start + lookup_time + self.ttl,
+                    'lookup_time': lookup_time
+                }
+        return address
+
+    def forget(self, host, port):
+        with self._guard:
+            self._entries.pop((host, port), None)
+
+
+# Addresses of the store hosts, shared by all the connections of the process
+DNS_CACHE = DNSCache()
+
+# Connections to the store, shared by all the requests of the process
+POOL_SIZE = 10
+_ADAPTER = None
+_ADAPTER_LOCK = threading.Lock()
+
+
+def configure(config):
+    global POOL_SIZE
+    DNS_CACHE.ttl = int(config.get('ckan.baepublisher.dns_ttl', 300))
+    POOL_SIZE = int(config.get('ckan.baepublisher.pool_connections', 10))
+
+
+def get_adapter():
+    global _ADAPTER
+    with _ADAPTER_LOCK:
+        if _ADAPTER is None:
+            # Imported here since requests is only needed once the store is contacted
+            from ckanext.baepublisher.adapters import StoreAdapter
+            _ADAPTER = StoreAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        return _ADAPTER
+
+
+def mount(session):
+    """
+    Makes the session use the connections shared by all the requests, so they
+    are kept alive between requests instead of opened for each session
+    """
+    adapter = get_adapter()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def connection_opened(setup_time):
+    _local.opened = True
+    metrics.increment('connections_opened')
+    metrics.increment('connection_setup_ms', int(setup_time * 1000))
+
+
+def request_started():
+    _local.opened = False
+
+
+def request_finished():
+    # A request that has not opened a connection has saved the average setup time
+    if not getattr(_local, 'opened', False):
+        counters = metrics.snapshot()
+        metrics.increment('connections_reused')
+        if counters.get('connections_opened'):
+            metrics.increment('connection_time_saved_ms',
+                              counters.get('connection_setup_ms', 0) // counters['connections_opened'])
+
+
+def report():
+    """
+    Returns the connections opened and reused by this process and the time
+    saved by reusing connections and addresses, in milliseconds
+    """
+    counters = metrics.snapshot()
+    return {
+        'opened': counters.get('connections_opened', 0),
+        'reused': counters.get('connections_reused', 0),
+        'setup_ms': counters.get('connection_setup_ms', 0),
+        'dns_lookups': counters.get('dns_lookups', 0),
+        'dns_cache_hits': counters.get('dns_cache_hits', 0),
+        'time_saved_ms': counters.get('connection_time_saved_ms', 0) + counters.get('dns_time_saved_ms', 0),
+    }
+
+
+def prewarm(url, count, verify=True):
+    """
+    Opens up to count connections to the given URL, so the next requests do
+    not wait for the DNS resolution and the TCP and TLS handshakes
+
+    :returns: The number of connections opened
+    :rtype: int
+    """
+    return get_adapter().prewarm(url, min(count, POOL_SIZE), verify)
+
+
+def _keep_connections_warm(urls, count, idle, verify):
+    while True:
+        adapter = get_adapter()
+        # The load balancer closes the idle connections, so they are opened again
+        if time.time() - adapter.last_used >= idle:
+            for url in urls:
+                try:
+                    prewarm(url, count, verify)
+                except Exception as e:
+                    log.warn('Connections to %s could not be opened: %s' % (url, e))
+
+            # Failed attempts are not retried until the next idle period
+            adapter.last_used = time.time()
+
+            log.info('Store connections: %(opened)d opened, %(reused)d reused, %(time_saved_ms)d ms saved' % report())
+
+        time.sleep(max(idle - (time.time() - adapter.last_used), 1))
+
+
+def start_prewarmer(urls, count=2, idle=60, verify=True):
+    """
+    Opens connections to the stores right away and again after the
+    connections have been idle for idle seconds
+    """
+    thread = threading.Thread(target=_keep_connections_warm, args=(urls, count, idle, verify))
+    thread.daemon = True
+    thread.start()
+    return thread
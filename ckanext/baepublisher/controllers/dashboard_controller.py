@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014-2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import ckan.lib.base as base
+import ckan.lib.helpers as helpers
+import ckan.model as model
+import ckan.plugins as plugins
+import logging
+import threading
+from urllib import urlencode
+
+from ckanext.baepublisher.offering_index import OfferingIndex
+from ckanext.baepublisher.store_connector import StoreConnector
+from ckanext.baepublisher.sync import bind_request_user
+from ckan.common import request
+from pylons import config
+
+log = logging.getLogger(__name__)
+
+KINDS = ['product', 'offering']
+
+# Index and store connector shared by all the requests of the process
+_INDEX = None
+_INDEX_LOCK = threading.Lock()
+
+
+def _get_index():
+    global _INDEX
+    with _INDEX_LOCK:
+        if _INDEX is None:
+            _INDEX = OfferingIndex(StoreConnector(config),
+                                   int(config.get('ckan.baepublisher.index_page_size', 100)),
+                                   int(config.get('ckan.baepublisher.index_max_age', 300)),
+                                   int(config.get('ckan.baepublisher.index_full_sync_interval', 3600)))
+        return _INDEX
+
+
+class DashboardControllerUI(base.BaseController):
+
+    def __init__(self, name=None):
+        self._index = _get_index()
+        self._store_connector = self._index.connector
+        self.page_size = int(config.get('ckan.baepublisher.dashboard_page_size', 20))
+
+    def _get_filters(self):
+        return {
+            'q': request.params.get('q', '').strip() or None,
+            'kind': request.params.get('kind') if request.params.get('kind') in KINDS else None,
+            'status': request.params.get('status') or None,
+            'sort': request.params.get('sort', 'last_update'),
+            'descending': request.params.get('order', 'desc') != 'asc',
+        }
+
+    def _pager_url(self, params, page):
+        query = [(key, value.encode('utf-8')) for key, value in params.items() if value]
+        query.append(('page', page))
+        return helpers.url_for('baepublisher_dashboard_offerings') + '?' + urlencode(query)
+
+    def offerings(self):
+        c = plugins.toolkit.c
+        tk = plugins.toolkit
+
+        if not c.user:
+            tk.abort(401, tk._('You must be logged in to see your offerings'))
+
+        context = {'model': model, 'session': model.Session,
+                   'user': c.user, 'auth_user_obj': c.userobj}
+        c.user_dict = tk.get_action('user_show')(context, {'id': c.userobj.id, 'user_obj': c.userobj})
+
+        # The page is served from the index, which is synchronized in background when it is too old
+        connector = bind_request_user(self._store_connector)
+        c.syncing = connector is not None and self._index.refresh(connector, c.user, 'refresh' in request.params)
+        c.last_sync = self._index.get_last_sync(c.user)
+
+        try:
+            page = max(int(request.params.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+
+        filters = self._get_filters()
+        count, elements = self._index.search(c.user, offset=(page - 1) * self.page_size, limit=self.page_size, **filters)
+
+        params = dict((key, request.params.get(key, '')) for key in ('q', 'kind', 'status', 'sort', 'order'))
+        c.page = helpers.Page(collection=elements, page=page, item_count=count, items_per_page=self.page_size,
+                              url=lambda page=None, **kwargs: self._pager_url(params, page))
+        c.page.items = elements
+
+        return tk.render('user/dashboard_offerings.html', extra_vars={
+            'filters': params,
+            'kinds': KINDS,
+            'statuses': self._index.get_statuses(c.user),
+            'store_url': self._store_connector.store_url,
+        })
@@ -24,77 +24,175 @@ import ckan.lib.base as base
 import ckan.lib.helpers as helpers
 import ckan.model as model
 import ckan.plugins as plugins
+import hashlib
+import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
-import requests
+import threading
 
+from ckanext.baepublisher import profiling, reference_data, scheduling, tracing
+from ckanext.baepublisher.multistore import get_store_connector
 from ckanext.baepublisher.store_connector import StoreConnector, StoreException
-from ckan.common import request
+from ckan.common import request, response
 from pylons import config
 
 log = logging.getLogger(__name__)
 
 __dir__ = os.path.dirname(os.path.abspath(__file__))
 filepath = os.path.join(__dir__, '../assets/logo-ckan.png')
-VERIFY_SSL = not bool(os.environ.get('OAUTHLIB_INSECURE_TRANSPORT'))
 
-with open(filepath, 'rb') as f:
-    LOGO_CKAN_B64 = base64.b64encode(f.read())
+# The default offering image is only read and encoded the first time it is needed
+_LOGO_CKAN_B64 = None
+
+
+# Loads the reference data in parallel with the request thread, shared by all the requests
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def _get_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ThreadPool(int(config.get('ckan.baepublisher.reference_data_pool_size', 4)))
+        return _POOL
+
+
+def get_default_logo():
+    global _LOGO_CKAN_B64
+    if _LOGO_CKAN_B64 is None:
+        with open(filepath, 'rb') as f:
+            _LOGO_CKAN_B64 = base64.b64encode(f.read())
+    return _LOGO_CKAN_B64
 
 
 class PublishControllerUI(base.BaseController):
 
     def __init__(self, name=None):
-        self._store_connector = StoreConnector(config)
+        self._store_connector = get_store_connector(StoreConnector(config), config)
         self.store_url = self._store_connector.store_url
 
     def _sort_categories(self, categories):
-        list_of_categories = []
-        cat_relatives = {}
-        categories_sorted = sorted(categories, key=lambda x: int(x['id']))
-        if not len(categories_sorted):
-            return list_of_categories, cat_relatives
-        list_of_categories.append(categories_sorted[0])
-        cat_relatives[categories_sorted[0]['id']] = {'href': categories_sorted[0]['href'],
-                                                     'id': categories_sorted[0]['id']}
-        categories_sorted.pop(0)
-
-        # Im sorry for this double loop, ill try to optimize this
-        for tag in categories_sorted:
-            if tag['isRoot']:
-                list_of_categories.append(tag)
-                cat_relatives[tag['id']] = {'href': tag['href'],
-                                            'id': tag['id']}
-                continue
-            for item in list_of_categories:
-                if tag['parentId'] == item['id']:
-                    list_of_categories.insert(list_of_categories.index(item) + 1, tag)
-                    cat_relatives[tag['id']] = {'href': tag['href'],
-                                                'id': tag['id'],
-                                                'parentId': tag.get('parentId', '')}
-                    break
+        return reference_data.sort_categories(categories)
+
+    def _get_categories(self):
+        # The categories are read from the snapshot shared by all the workers when available
+        snapshot = reference_data.get_category_snapshot()
+        if snapshot is not None:
+            return snapshot.categories(), snapshot.relatives()
+
+        list_of_categories, cat_relatives = self._sort_categories(self._get_content('category'))
+        if 'category' not in plugins.toolkit.c.errors:
+            reference_data.publish_category_snapshot(list_of_categories, cat_relatives)
+
         return list_of_categories, cat_relatives
 
+    def _load_options(self, content, user=None):
+        """
+        Loads the form options of the given content outside the request thread.
+        Returns the options and the error, if any. The categories are sorted so
+        each one is followed by its children.
+        """
+        try:
+            if content == 'catalog':
+                return [{'value': catalog['id'], 'text': catalog['name']}
+                        for catalog in reference_data.get_content(self.store_url, 'catalog', user)], None
+
+            snapshot = reference_data.get_category_snapshot()
+            if snapshot is not None:
+                categories = snapshot.categories()
+            else:
+                categories, relatives = self._sort_categories(reference_data.get_content(self.store_url, 'category'))
+                reference_data.publish_category_snapshot(categories, relatives)
+        except reference_data.ReferenceDataError:
+            log.warn('{} couldnt be loaded'.format(content))
+            return [], '{} couldnt be loaded'.format(content)
+
+        depths = {}
+        options = []
+        for category in categories:
+            depths[category['id']] = depths.get(category.get('parentId'), -1) + 1 if not category.get('isRoot') else 0
+            options.append({'value': category['id'], 'text': category['name'], 'depth': depths[category['id']]})
+
+        return options, None
+
+    def reference_data(self, content=None):
+        """
+        Returns the categories and the catalogs of the user as JSON, so the
+        publish form is rendered without waiting for the store. With content,
+        only the categories or the catalogs are returned. The category tree is
+        the same for every user, so it can also be cached by shared caches.
+        """
+        c = plugins.toolkit.c
+        tk = plugins.toolkit
+
+        if content not in (None, 'category', 'catalog'):
+            tk.abort(404, tk._('Unknown reference data %s') % content)
+
+        if content != 'category' and not c.user:
+            tk.abort(401, tk._('User not authorized to list the catalogs'))
+
+        with tracing.span('reference_data', {'content': content or 'all'}):
+            result = {}
+            errors = []
+
+            pending = None
+            if content is None:
+                parent = tracing.current_span()
+
+                def _load_categories():
+                    with tracing.activate(parent):
+                        return self._load_options('category')
+
+                pending = _get_pool().apply_async(_load_categories)
+
+            if content in (None, 'catalog'):
+                result['catalogs'], error = self._load_options('catalog', c.user)
+                errors.append(error)
+
+            if content == 'category':
+                result['categories'], error = self._load_options('category')
+                errors.append(error)
+            elif pending is not None:
+                result['categories'], error = pending.get()
+                errors.append(error)
+
+        result['errors'] = [err for err in errors if err is not None]
+        body = json.dumps(result, sort_keys=True)
+
+        response.content_type = str('application/json')
+        response.charset = str('utf-8')
+        if result['errors']:
+            # Partial results must not be cached
+            response.cache_control = str('no-store')
+            return body
+
+        etag = hashlib.md5(body.encode('utf-8')).hexdigest()
+        visibility = 'public' if content == 'category' else 'private'
+        response.cache_control = str('%s, max-age=%d' % (visibility, reference_data.CACHE.ttl))
+        response.etag = str(etag)
+
+        if etag in request.if_none_match:
+            response.status_int = 304
+            return ''
+
+        return body
+
     # This function is intended to make get requests to the api
     def _get_content(self, content):
         c = plugins.toolkit.c
-        filters = {
-            'lifecycleStatus': 'Launched'
-        }
-        if content == 'catalog':
-            filters['relatedParty.id'] = c.user
-        response = requests.get(
-            '{0}/DSProductCatalog/api/catalogManagement/v2/{1}'.format(
-                self.store_url, content), params=filters, verify=VERIFY_SSL)
-        # Checking that the request finished successfully
         try:
-            response.raise_for_status()
-        except Exception:
+            with tracing.span('get_content', {'content': content}):
+                return reference_data.get_content(self.store_url, content, c.user)
+        except reference_data.ReferenceDataError as e:
             log.warn('{} couldnt be loaded'.format(content))
             c.errors['{}'.format(
                 content)] = ['{} couldnt be loaded'.format(content)]
-        return response.json()
+            return e.data
 
+    @profiling.profiled('publish', lambda self, id, offering_info=None, errors=None: {
+        'dataset': id, 'user': plugins.toolkit.c.user, 'method': request.method})
     def publish(self, id, offering_info=None, errors=None):
 
         c = plugins.toolkit.c
@@ -122,24 +220,9 @@ class PublishControllerUI(base.BaseController):
         c.pkg_dict = dataset
         c.errors = {}
 
-        self._list_of_categories, self._cat_relatives = self._sort_categories(self._get_content('category'))
-        self._list_of_catalogs = self._get_content('catalog')
-
-        # Get categories in the expected format of the form select field
-        def _getList(param):
-            requiredFields = ['id', 'name']
-            result = []
-            for i in param:
-                result.append({x: i[x] for x in requiredFields})
-            for elem in result:
-                elem['text'] = elem.pop('name')
-                elem['value'] = elem.pop('id')
-            return result
-
-        c.offering = {
-            'categories': _getList(self._list_of_categories),
-            'catalogs': _getList(self._list_of_catalogs)
-        }
+        # The categories and the catalogs are loaded by the browser from the
+        # reference_data action, so the form does not wait for the store
+        c.offering = {}
         # when the data is provided
         if request.POST:
             offering_info = {
@@ -155,6 +238,12 @@ class PublishControllerUI(base.BaseController):
             categories = request.POST.getall('categories')
             tempList = []
 
+            # The parents of the selected categories are also included in the offering
+            if categories:
+                self._list_of_categories, self._cat_relatives = self._get_categories()
+                if 'category' in c.errors:
+                    categories = []
+
             # Insert all parents in the set until there are no more new parents
             for cat in categories:
                 tempList.append(self._cat_relatives[cat])
@@ -179,7 +268,7 @@ class PublishControllerUI(base.BaseController):
                 offering_info['image_base64'] = base64.b64encode(
                     image_field.file.read())
             else:
-                offering_info['image_base64'] = LOGO_CKAN_B64
+                offering_info['image_base64'] = get_default_logo()
 
             # Convert price into float (it's given as string)
             price = request.POST.get('price', '')
@@ -217,8 +306,10 @@ class PublishControllerUI(base.BaseController):
                 c.errors['Price'] = ['You cannot set a price to a dataset that is public since everyone can access it']
             if not c.errors:
                 try:
-                    offering_url = self._store_connector.create_offering(
-                        dataset, offering_info)
+                    # A user is waiting, so these requests go ahead of the background ones
+                    with scheduling.priority(scheduling.INTERACTIVE):
+                        offering_url = self._store_connector.create_offering(
+                            dataset, offering_info)
                     helpers.flash_success(
                         tk._(
                             'Offering <a href="%s" target="_blank">%s</a> published correctly.' % (
@@ -230,7 +321,4 @@ class PublishControllerUI(base.BaseController):
                     # response.location = '/dataset/%s' % id
                 except StoreException as e:
                     c.errors['Store'] = [e.message]
-            else:
-                c.offering['catalogs'] = _getList(self._list_of_catalogs)
-                c.offering['categories'] = _getList(self._list_of_categories)
         return tk.render('package/publish.html')
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from datetime import datetime
+import json
+
+import sqlalchemy as sa
+
+PublishRecord = None
+State = None
+ProductSync = None
+PublishCheckpoint = None
+IndexedElement = None
+
+# Columns of the indexed elements that can be used to sort them
+INDEX_SORT_FIELDS = ['name', 'kind', 'lifecycle_status', 'last_update']
+
+
+def init_db(model):
+    global PublishRecord, State, ProductSync, PublishCheckpoint, IndexedElement
+
+    if PublishRecord is None:
+
+        class _PublishRecord(model.DomainObject):
+
+            @classmethod
+            def by_key(cls, idempotency_key):
+                return model.Session.query(cls).filter_by(idempotency_key=idempotency_key).first()
+
+            @classmethod
+            def delete_by_package(cls, package_id):
+                model.Session.query(cls).filter_by(package_id=package_id).delete()
+
+            @classmethod
+            def is_published(cls, package_id):
+                return model.Session.query(cls.idempotency_key).filter_by(package_id=package_id).first() is not None
+
+        PublishRecord = _PublishRecord
+
+        publish_record_table = sa.Table('baepublisher_publish_record', model.meta.metadata,
+                                        sa.Column('idempotency_key', sa.types.UnicodeText, primary_key=True),
+                                        sa.Column('package_id', sa.types.UnicodeText, nullable=False, index=True),
+                                        sa.Column('catalog', sa.types.UnicodeText, nullable=False),
+                                        sa.Column('version', sa.types.UnicodeText, nullable=False),
+                                        sa.Column('offering_url', sa.types.UnicodeText, nullable=False),
+                                        sa.Column('created', sa.types.DateTime, default=datetime.utcnow))
+
+        # Create the table only if it does not exist
+        publish_record_table.create(checkfirst=True)
+
+        model.meta.mapper(PublishRecord, publish_record_table)
+
+    if State is None:
+
+        class _State(model.DomainObject):
+
+            @classmethod
+            def get(cls, key, default=None):
+                state = model.Session.query(cls).filter_by(key=key).first()
+                return state.value if state is not None else default
+
+            @classmethod
+            def set(cls, key, value):
+                state = model.Session.query(cls).filter_by(key=key).first()
+                if state is None:
+                    state = cls()
+                    state.key = key
+                    model.Session.add(state)
+                state.value = value
+                state.modified = datetime.utcnow()
+                model.Session.commit()
+
+        State = _State
+
+        state_table = sa.Table('baepublisher_state', model.meta.metadata,
+                               sa.Column('key', sa.types.UnicodeText, primary_key=True),
+                               sa.Column('value', sa.types.UnicodeText),
+                               sa.Column('modified', sa.types.DateTime, default=datetime.utcnow))
+
+        # Create the table only if it does not exist
+        state_table.create(checkfirst=True)
+
+        model.meta.mapper(State, state_table)
+
+    if ProductSync is None:
+
+        class _ProductSync(model.DomainObject):
+
+            @classmethod
+            def by_package(cls, package_id):
+                return model.Session.query(cls).filter_by(package_id=package_id).first()
+
+            @classmethod
+            def delete_by_package(cls, package_id):
+                model.Session.query(cls).filter_by(package_id=package_id).delete()
+
+        ProductSync = _ProductSync
+
+        product_sync_table = sa.Table('baepublisher_product_sync', model.meta.metadata,
+                                      sa.Column('package_id', sa.types.UnicodeText, primary_key=True),
+                                      sa.Column('product_id', sa.types.UnicodeText, nullable=False),
+                                      sa.Column('product_href', sa.types.UnicodeText, nullable=False),
+                                      # JSON with the fields and characteristics last pushed to the store
+                                      sa.Column('spec', sa.types.UnicodeText, nullable=False),
+                                      sa.Column('modified', sa.types.DateTime, default=datetime.utcnow))
+
+        # Create the table only if it does not exist
+        product_sync_table.create(checkfirst=True)
+
+        model.meta.mapper(ProductSync, product_sync_table)
+
+    if PublishCheckpoint is None:
+
+        class _PublishCheckpoint(model.DomainObject):
+
+            @classmethod
+            def by_key(cls, idempotency_key):
+                return model.Session.query(cls).filter_by(idempotency_key=idempotency_key).first()
+
+            @classmethod
+            def delete_by_key(cls, idempotency_key):
+                model.Session.query(cls).filter_by(idempotency_key=idempotency_key).delete()
+
+            @classmethod
+            def delete_by_package(cls, package_id):
+                model.Session.query(cls).filter_by(package_id=package_id).delete()
+
+            def get_steps(self):
+                return json.loads(self.steps or '{}')
+
+            def complete(self, step, value):
+                steps = self.get_steps()
+                steps[step] = value
+                self.steps = json.dumps(steps)
+                self.modified = datetime.utcnow()
+                model.Session.add(self)
+                model.Session.commit()
+
+        PublishCheckpoint = _PublishCheckpoint
+
+        publish_checkpoint_table = sa.Table('baepublisher_publish_checkpoint', model.meta.metadata,
+                                            sa.Column('idempotency_key', sa.types.UnicodeText, primary_key=True),
+                                            sa.Column('package_id', sa.types.UnicodeText, nullable=False, index=True),
+                                            # JSON with the result of each completed step of the publication
+                                            sa.Column('steps', sa.types.UnicodeText, nullable=False, default='{}'),
+                                            sa.Column('modified', sa.types.DateTime, default=datetime.utcnow))
+
+        # Create the table only if it does not exist
+        publish_checkpoint_table.create(checkfirst=True)
+
+        model.meta.mapper(PublishCheckpoint, publish_checkpoint_table)
+
+    if IndexedElement is None:
+
+        class _IndexedElement(model.DomainObject):
+
+            @classmethod
+            def by_owner(cls, owner):
+                return dict((element.href, element) for element in model.Session.query(cls).filter_by(owner=owner))
+
+            @classmethod
+            def delete_by_href(cls, hrefs):
+                if hrefs:
+                    model.Session.query(cls).filter(cls.href.in_(hrefs)).delete(synchronize_session=False)
+
+            @classmethod
+            def get_statuses(cls, owner):
+                query = model.Session.query(cls.lifecycle_status).filter_by(owner=owner).distinct()
+                return sorted(status for status, in query if status)
+
+            @classmethod
+            def search(cls, owner, q=None, kind=None, status=None, sort='last_update', descending=True, offset=0, limit=20):
+                """
+                Returns the number of elements of the owner that match the filters
+                and the requested page of them
+                """
+                query = model.Session.query(cls).filter_by(owner=owner)
+                if q:
+                    pattern = '%%%s%%' % q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                    query = query.filter(cls.name.ilike(pattern, escape='\\'))
+                if kind:
+                    query = query.filter_by(kind=kind)
+                if status:
+                    query = query.filter_by(lifecycle_status=status)
+
+                column = getattr(cls, sort if sort in INDEX_SORT_FIELDS else 'last_update')
+                query = query.order_by(column.desc() if descending else column.asc(), cls.href)
+
+                return query.count(), query.offset(offset).limit(limit).all()
+
+        IndexedElement = _IndexedElement
+
+        indexed_element_table = sa.Table('baepublisher_indexed_element', model.meta.metadata,
+                                         sa.Column('href', sa.types.UnicodeText, primary_key=True),
+                                         sa.Column('owner', sa.types.UnicodeText, nullable=False),
+                                         # product or offering
+                                         sa.Column('kind', sa.types.UnicodeText, nullable=False),
+                                         sa.Column('element_id', sa.types.UnicodeText, nullable=False),
+                                         sa.Column('name', sa.types.UnicodeText),
+                                         sa.Column('version', sa.types.UnicodeText),
+                                         sa.Column('lifecycle_status', sa.types.UnicodeText),
+                                         sa.Column('product_id', sa.types.UnicodeText),
+                                         sa.Column('package_id', sa.types.UnicodeText),
+                                         sa.Column('last_update', sa.types.DateTime),
+                                         sa.Column('synced', sa.types.DateTime, default=datetime.utcnow),
+                                         sa.Index('baepublisher_indexed_element_owner_last_update', 'owner', 'last_update'))
+
+        # Create the table only if it does not exist
+        indexed_element_table.create(checkfirst=True)
+
+        model.meta.mapper(IndexedElement, indexed_element_table)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+import ckan.model as model
+
+from ckanext.baepublisher.sync import bind_request_user
+
+log = logging.getLogger(__name__)
+
+
+class DeletionBatcher(object):
+    """
+    Groups the datasets deleted by the same user within a time window (e.g.
+    when an organization is purged), so their store resources are retired in
+    a single batch: the products of the user are requested once and the
+    products of the datasets are retired by a bounded number of workers.
+    """
+
+    def __init__(self, connector, window, workers=4):
+        self._connector = connector
+        self._window = window
+        self._workers = workers
+        self._guard = threading.Lock()
+        self._batches = {}
+
+    def add(self, dataset):
+        connector = bind_request_user(self._connector)
+        if connector is None:
+            log.debug('Resources of dataset %s not retired: there are no store credentials available' % dataset['id'])
+            return
+
+        user = connector._get_user()
+        with self._guard:
+            batch = self._batches.get(user)
+            if batch is None:
+                # The first dataset of the batch starts the window, later ones join it
+                timer = threading.Timer(self._window, self._flush, [user])
+                timer.daemon = True
+                batch = self._batches[user] = {'connector': connector, 'datasets': [], 'timer': timer}
+                timer.start()
+
+            batch['datasets'].append(dataset)
+
+    def pending(self):
+        with self._guard:
+            return dict((user, len(batch['datasets'])) for user, batch in self._batches.items())
+
+    def flush(self):
+        """
+        Retires the pending batches right away, without waiting for the end of
+        their windows (e.g. when the process exits)
+        """
+        with self._guard:
+            users = list(self._batches)
+            for user in users:
+                self._batches[user]['timer'].cancel()
+
+        for user in users:
+            self._flush(user)
+
+    def _flush(self, user):
+        with self._guard:
+            batch = self._batches.pop(user, None)
+
+        # The batch may have been flushed already while its timer was firing
+        if batch is None:
+            return
+
+        try:
+            log.info('Retiring the store resources of %d datasets of %s' % (len(batch['datasets']), user))
+            failed = batch['connector'].delete_attached_resources_batch(batch['datasets'], self._workers)
+            if failed:
+                log.warn('Resources of datasets %s could not be retired' % ', '.join(failed))
+        except Exception as e:
+            log.warn('Resources of the datasets deleted by %s could not be retired: %s' % (user, e))
+        finally:
+            model.Session.remove()
@@ -0,0 +1,53 @@
+/*
+ * (C) Copyright 2018 CoNWeT Lab., Universidad Politécnica de Madrid
+ *
+ * This file is part of CKAN BAE Publisher Extension.
+ *
+ * CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+ * modify it under the terms of the GNU Affero General Public License as
+ * published by the Free Software Foundation, either version 3 of the
+ * License, or (at your option) any later version.
+ *
+ * CKAN BAE Publisher Extension is distributed in the hope that it will be useful, but
+ * WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+ * or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+ * License for more details.
+ *
+ * You should have received a copy of the GNU Affero General Public License
+ * along with CKAN BAE Publisher Extension. If not, see
+ * <http://www.gnu.org/licenses/>.
+ *
+ */
+
+(function()  {
+    var form = $('form[data-reference-data-url]');
+    var errors = $('#reference-data-error');
+
+    // Replaces the options of the select, keeping the selected values
+    var setOptions = function(select, options) {
+        var selected = (select.attr('data-selected') || '').split(',');
+        select.empty();
+        $.each(options, function(i, option) {
+            // Children are indented below their parents
+            var text = new Array((option.depth || 0) + 1).join('   ') + option.text;
+            $('<option>').val(option.value).text(text)
+                .prop('selected', $.inArray(option.value, selected) !== -1)
+                .appendTo(select);
+        });
+        select.trigger('change');
+    };
+
+    $.ajax({
+        url: form.data('reference-data-url'),
+        dataType: 'json'
+    }).done(function(data) {
+        setOptions($('#field-category'), data.categories);
+        setOptions($('#field-catalogs'), data.catalogs);
+
+        if (data.errors.length) {
+            errors.text(data.errors.join('. ')).css('display', 'block');
+        }
+    }).fail(function() {
+        errors.text('Categories and catalogs could not be loaded').css('display', 'block');
+    });
+})();
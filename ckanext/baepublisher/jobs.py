@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import logging
+
+import ckan.plugins as plugins
+
+log = logging.getLogger(__name__)
+
+
+def reindex_package(package_id):
+    # Imported here since the search module is only needed when the job is run
+    from ckan.lib.search import rebuild
+    rebuild(package_id)
+
+
+def enqueue_reindex(package_id, deferred=True):
+    """
+    Updates the search index of a package. When deferred, the update is
+    run by the background workers (only available in CKAN 2.7 or higher)
+    """
+    toolkit = plugins.toolkit
+
+    if deferred and hasattr(toolkit, 'enqueue_job'):
+        toolkit.enqueue_job(reindex_package, [package_id], title='baepublisher reindex %s' % package_id)
+    else:
+        reindex_package(package_id)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import hashlib
+import logging
+import struct
+import threading
+import time
+
+import ckan.model as model
+
+log = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.2
+
+
+class LockTimeout(Exception):
+    pass
+
+
+class LockBackend(object):
+    """
+    Base class of the lock backends. Subclasses only have to implement a non
+    blocking _try_acquire and release, waiting is handled here.
+    """
+
+    def _try_acquire(self, name):
+        raise NotImplementedError
+
+    def release(self, name):
+        raise NotImplementedError
+
+    def acquire(self, name, timeout):
+        deadline = time.time() + timeout
+        while not self._try_acquire(name):
+            if time.time() >= deadline:
+                return False
+            time.sleep(POLL_INTERVAL)
+        return True
+
+    @contextmanager
+    def hold(self, name, timeout):
+        if not self.acquire(name, timeout):
+            raise LockTimeout('Lock %s could not be acquired in %s seconds' % (name, timeout))
+        try:
+            yield
+        finally:
+            self.release(name)
+
+
+class LocalLockBackend(LockBackend):
+    """
+    Locks shared by the threads of a single process
+    """
+
+    def __init__(self, config=None):
+        self._guard = threading.Lock()
+        self._held = set()
+
+    def _try_acquire(self, name):
+        with self._guard:
+            if name in self._held:
+                return False
+            self._held.add(name)
+            return True
+
+    def release(self, name):
+        with self._guard:
+            self._held.discard(name)
+
+
+class DatabaseLockBackend(LockBackend):
+    """
+    Locks shared by all the processes and nodes using the same PostgreSQL
+    database, based on session level advisory locks. Each lock is held by its
+    own connection, so commits made while the lock is held do not release it.
+    """
+
+    def __init__(self, config=None):
+        self._guard = threading.Lock()
+        self._connections = {}
+
+    def _get_lock_id(self, name):
+        # Advisory locks are identified by a signed 64 bits integer
+        return struct.unpack(str('>q'), hashlib.sha1(name.encode('utf-8')).digest()[:8])[0]
+
+    def _try_acquire(self, name):
+        connection = model.meta.engine.connect()
+        try:
+            acquired = connection.execute('SELECT pg_try_advisory_lock(%s)', self._get_lock_id(name)).scalar()
+        except Exception:
+            connection.close()
+            raise
+
+        if not acquired:
+            connection.close()
+            return False
+
+        with self._guard:
+            self._connections[name] = connection
+        return True
+
+    def release(self, name):
+        with self._guard:
+            connection = self._connections.pop(name, None)
+
+        if connection is not None:
+            try:
+                connection.execute('SELECT pg_advisory_unlock(%s)', self._get_lock_id(name))
+            finally:
+                connection.close()
+
+
+LOCK_BACKENDS = {
+    'database': DatabaseLockBackend,
+    'local': LocalLockBackend,
+}
+
+# Backends shared by all the connectors of the process, so local locks are
+# seen by every request and the held connections are tracked in one place
+_BACKENDS = {}
+_BACKENDS_LOCK = threading.Lock()
+
+
+def get_lock_backend(config):
+    """
+    Returns the lock backend configured in ckan.baepublisher.lock_backend. The
+    value can be one of the included backends (database, local) or the path
+    of a custom LockBackend class (my.module:MyLockBackend). The backend is
+    created once per process.
+    """
+    name = config.get('ckan.baepublisher.lock_backend', 'database').strip()
+
+    with _BACKENDS_LOCK:
+        if name not in _BACKENDS:
+            if name in LOCK_BACKENDS:
+                backend_class = LOCK_BACKENDS[name]
+            else:
+                module_name, _, class_name = name.partition(':')
+                module = __import__(str(module_name), fromlist=[str(class_name)])
+                backend_class = getattr(module, class_name)
+
+            _BACKENDS[name] = backend_class(config)
+
+        return _BACKENDS[name]
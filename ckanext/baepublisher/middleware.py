@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class FirstRequestMiddleware(object):
+    """
+    WSGI middleware that calls a function when the worker serves its first
+    request. Background tasks started from it only run in the web workers,
+    not in the paster commands, and they are started after the workers have
+    been forked.
+    """
+
+    def __init__(self, app, callback):
+        self.app = app
+        self._callback = callback
+        self._pending = True
+        self._guard = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if self._pending:
+            with self._guard:
+                if self._pending:
+                    self._pending = False
+                    try:
+                        self._callback()
+                    except Exception as e:
+                        log.warn('Background tasks could not be started: %s' % e)
+
+        return self.app(environ, start_response)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import copy
+import logging
+from multiprocessing.pool import ThreadPool
+import threading
+
+import ckan.plugins as plugins
+
+from ckanext.baepublisher import reference_data, scheduling, tracing
+from ckanext.baepublisher.store_connector import StoreException
+
+log = logging.getLogger(__name__)
+
+# Pool of each store, shared by all the requests of the process
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+class MultiStoreException(StoreException):
+    """
+    Raised when the dataset could not be published in some of the stores. The
+    result of each store is available in the results attribute
+    """
+
+    def __init__(self, results):
+        published = [store for store, result in results.items() if result['error'] is None]
+        failed = ['%s (%s)' % (store, result['error']) for store, result in results.items() if result['error'] is not None]
+
+        message = 'The offering could not be published in %s' % ', '.join(failed)
+        if published:
+            message += '. It has been published in %s' % ', '.join(published)
+
+        super(MultiStoreException, self).__init__(message)
+        self.results = results
+
+
+def _get_pool(store_url, size):
+    with _POOLS_LOCK:
+        if store_url not in _POOLS:
+            _POOLS[store_url] = ThreadPool(size)
+        return _POOLS[store_url]
+
+
+def get_store_urls(config):
+    return config.get('ckan.baepublisher.store_urls', '').split()
+
+
+class MultiStoreConnector(object):
+    """
+    Publishes the datasets in the main store (ckan.baepublisher.store_url) and
+    in the additional stores of ckan.baepublisher.store_urls at the same time.
+    Each additional store has its own pool of
+    ckan.baepublisher.store_pool_size threads, rate limits and rollback. The
+    main store is contacted from the calling thread, so the token of the user
+    can be refreshed as usual. Catalogs and categories are matched by name in
+    the additional stores.
+
+    Other attributes and methods are the ones of the main store connector.
+    """
+
+    def __init__(self, connector, config):
+        self._primary = connector
+        self.pool_size = int(config.get('ckan.baepublisher.store_pool_size', 4))
+        self.stores = [connector.for_store(url) for url in get_store_urls(config)
+                       if url.rstrip('/') != connector.store_url]
+
+    def __getattr__(self, name):
+        # Only called for the attributes that are not defined by this class
+        if name.startswith('__') or name == '_primary':
+            raise AttributeError(name)
+        return getattr(self._primary, name)
+
+    def bind(self, user, token, token_refresh=None):
+        connector = copy.copy(self)
+        connector._primary = self._primary.bind(user, token, token_refresh)
+        connector.stores = [store.bind(user, copy.copy(token)) for store in self.stores]
+        return connector
+
+    def bind_service(self):
+        primary = self._primary.bind_service()
+        return self.bind(primary._get_user(), primary._get_token())
+
+    def _get_stores(self):
+        # The additional stores run in other threads, so they cannot use the user of the request
+        if self._primary._identity is not None:
+            return self.stores
+
+        c = plugins.toolkit.c
+        return [store.bind(c.user, copy.copy(c.usertoken)) for store in self.stores]
+
+    def _fan_out(self, func):
+        """
+        Calls func with each store connector, the main one in the calling
+        thread, and returns the result or the error of each store
+        """
+        priority = scheduling.current_priority()
+        parent = tracing.current_span()
+
+        def _run(connector):
+            with scheduling.priority(priority), tracing.activate(parent):
+                try:
+                    return {'result': func(connector), 'error': None}
+                except Exception as e:
+                    log.warn('Request to the store %s failed: %s' % (connector.store_url, e))
+                    return {'result': None, 'error': '%s' % e}
+
+        pending = [(store.store_url, _get_pool(store.store_url, self.pool_size).apply_async(_run, (store,)))
+                   for store in self._get_stores()]
+
+        results = OrderedDict()
+        results[self._primary.store_url] = _run(self._primary)
+        for store_url, result in pending:
+            results[store_url] = result.get()
+
+        return results
+
+    def _get_store_offering_info(self, connector, offering_info):
+        """
+        Returns the offering info with the catalog and the categories of the
+        given store, which are matched by name with the ones of the main store
+        """
+        if connector.primary:
+            return offering_info
+
+        user = connector._get_user()
+
+        def _by_name(store_url, content, content_user=None):
+            return dict((element['name'], element) for element in
+                        reference_data.get_content(store_url, content, content_user) if 'name' in element)
+
+        def _by_id(store_url, content, content_user=None):
+            return dict((element['id'], element) for element in
+                        reference_data.get_content(store_url, content, content_user))
+
+        store_offering_info = dict(offering_info)
+
+        catalog = _by_id(self._primary.store_url, 'catalog', user).get(offering_info['catalog'])
+        store_catalog = _by_name(connector.store_url, 'catalog', user).get(catalog['name']) if catalog else None
+        if store_catalog is None:
+            raise StoreException('The catalog does not exist in %s' % connector.store_url)
+        store_offering_info['catalog'] = store_catalog['id']
+
+        categories = _by_id(self._primary.store_url, 'category')
+        store_categories = _by_name(connector.store_url, 'category')
+        store_offering_info['categories'] = []
+        for category in offering_info['categories']:
+            name = categories.get(category['id'], {}).get('name')
+            if name not in store_categories:
+                raise StoreException('The category %s does not exist in %s' % (name or category['id'], connector.store_url))
+            store_offering_info['categories'].append({
+                'id': store_categories[name]['id'],
+                'href': store_categories[name]['href'],
+            })
+
+        return store_offering_info
+
+    def publish(self, dataset, offering_info):
+        """
+        Publishes the dataset in all the stores
+
+        :returns: The result of each store, a dict with the offering URL
+            (result) or the error (error)
+        :rtype: OrderedDict
+        """
+        return self._fan_out(lambda connector: connector.create_offering(
+            dataset, self._get_store_offering_info(connector, offering_info)))
+
+    def create_offering(self, dataset, offering_info):
+        """
+        Publishes the dataset in all the stores and returns the offering URL of
+        the main store
+
+        :raises MultiStoreException: When the dataset could not be published in
+            some of the stores
+        """
+        results = self.publish(dataset, offering_info)
+        if any(result['error'] is not None for result in results.values()):
+            raise MultiStoreException(results)
+
+        return results[self._primary.store_url]['result']
+
+    def delete_attached_resources(self, dataset):
+        return self._fan_out(lambda connector: connector.delete_attached_resources(dataset))
+
+    def delete_attached_resources_batch(self, datasets, workers=4):
+        results = self._fan_out(lambda connector: connector.delete_attached_resources_batch(datasets, workers))
+
+        # A dataset has failed when its resources could not be retired in some store
+        failed = set()
+        for result in results.values():
+            if result['error'] is not None:
+                return [dataset['id'] for dataset in datasets]
+            failed.update(result['result'])
+
+        return [dataset['id'] for dataset in datasets if dataset['id'] in failed]
+
+
+def get_store_connector(connector, config):
+    """
+    Returns a connector that publishes in all the configured stores, or the
+    given one when there are no additional stores
+    """
+    if not get_store_urls(config):
+        return connector
+    return MultiStoreConnector(connector, config)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+import logging
+import threading
+
+import ckan.model as model
+
+from ckanext.baepublisher import db
+from ckanext.baepublisher.reconcile import DATE_FORMAT, parse_date
+
+log = logging.getLogger(__name__)
+
+SYNC_KEY = 'index_synced:%s'
+FULL_SYNC_KEY = 'index_full_synced:%s'
+LOCK_NAME = 'baepublisher-index-%s'
+
+# Users whose index is being synchronized by this process
+_syncing = set()
+_syncing_lock = threading.Lock()
+
+
+class OfferingIndex(object):
+    """
+    Local copy of the product specifications and offerings of each user, so
+    they can be listed, filtered and sorted without paging through the store.
+
+    The index of a user is synchronized in background when it is older than
+    max_age seconds, by a single worker at a time thanks to the lock backend
+    of the connector. Only the elements updated since the previous pass are
+    requested, and only the ones whose status or last update have changed are
+    written. Elements removed from the store are only detected by listing
+    everything again, which is done every full_sync_interval seconds.
+    """
+
+    def __init__(self, connector, page_size=100, max_age=300, full_sync_interval=3600):
+        self.connector = connector
+        self._locks = connector._lock_backend
+        self._page_size = page_size
+        self.max_age = max_age
+        self.full_sync_interval = full_sync_interval
+        self._dataset_prefix = '%s/dataset/' % connector.site_url
+
+    def get_last_sync(self, user):
+        db.init_db(model)
+        return parse_date(db.State.get(SYNC_KEY % user))
+
+    def is_syncing(self, user):
+        with _syncing_lock:
+            return user in _syncing
+
+    def is_fresh(self, user):
+        last_sync = self.get_last_sync(user)
+        return last_sync is not None and datetime.utcnow() - last_sync < timedelta(seconds=self.max_age)
+
+    def refresh(self, connector, user, force=False):
+        """
+        Synchronizes the index of the user in background when it is too old
+
+        :param connector: Store connector bound to the user
+        :returns: Whether the index of the user is being synchronized
+        :rtype: bool
+        """
+        if not force and self.is_fresh(user):
+            return self.is_syncing(user)
+
+        with _syncing_lock:
+            if user in _syncing:
+                return True
+            _syncing.add(user)
+
+        thread = threading.Thread(target=self._run, args=(connector, user, force))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _run(self, connector, user, force=False):
+        lock = LOCK_NAME % user
+        try:
+            # Other workers can be synchronizing the same index
+            if not self._locks.acquire(lock, 0):
+                log.debug('Index of %s is being synchronized by another worker' % user)
+                return
+
+            try:
+                # The index can have been synchronized while waiting
+                if force or not self.is_fresh(user):
+                    self.sync(connector, user)
+            finally:
+                self._locks.release(lock)
+        except Exception as e:
+            log.warn('Index of %s could not be synchronized: %s' % (user, e))
+            model.Session.rollback()
+        finally:
+            with _syncing_lock:
+                _syncing.discard(user)
+            model.Session.remove()
+
+    def _get_package_id(self, product):
+        url = self.connector._get_product_url(product.get('productSpecCharacteristic', []))
+        return url[len(self._dataset_prefix):] if url.startswith(self._dataset_prefix) else None
+
+    def _update(self, indexed, user, kind, element, product_id, package_id):
+        current = indexed.get(element['href'])
+        last_update = parse_date(element.get('lastUpdate'))
+        status = element.get('lifecycleStatus')
+
+        if current is not None and current.last_update == last_update and current.lifecycle_status == status \
+                and current.package_id == package_id:
+            return False
+
+        if current is None:
+            current = db.IndexedElement()
+            current.href = element['href']
+            indexed[current.href] = current
+
+        current.owner = user
+        current.kind = kind
+        current.element_id = element['id']
+        current.name = element.get('name')
+        current.version = element.get('version')
+        current.lifecycle_status = status
+        current.product_id = product_id
+        current.package_id = package_id
+        current.last_update = last_update
+        current.synced = datetime.utcnow()
+        model.Session.add(current)
+        return True
+
+    def _get_since(self, user, started):
+        # Last pass of an incremental synchronization, or None when everything has to be listed
+        last_full_sync = parse_date(db.State.get(FULL_SYNC_KEY % user))
+        if last_full_sync is None or started - last_full_sync >= timedelta(seconds=self.full_sync_interval):
+            return None
+
+        return self.get_last_sync(user)
+
+    def sync(self, connector, user):
+        """
+        Synchronizes the index of the user with the store
+
+        :returns: The number of products and offerings of the user listed by
+            the store, and of the elements of the index that have been updated
+            and removed
+        :rtype: dict
+        """
+        db.init_db(model)
+        started = datetime.utcnow()
+        since = self._get_since(user, started)
+        indexed = db.IndexedElement.by_owner(user)
+        seen = set()
+        summary = {'products': 0, 'offerings': 0, 'updated': 0, 'removed': 0}
+
+        # Offerings of products not updated since the last pass keep the dataset of the index
+        packages = dict((element.element_id, element.package_id) for element in indexed.values() if element.kind == 'product')
+        for product in connector.get_products(owner=user, page_size=self._page_size, modified_since=since):
+            packages[product['id']] = self._get_package_id(product)
+            summary['products'] += 1
+            summary['updated'] += self._update(indexed, user, 'product', product, product['id'], packages[product['id']])
+            seen.add(product['href'])
+
+        # Offerings are listed by the catalogs of the user
+        catalogs = connector.get_paginated('%s/DSProductCatalog/api/catalogManagement/v2/catalog/?relatedParty.id=%s' % (
+            connector.store_url, user), self._page_size)
+        offerings_filter = '?lastUpdate.gt=%s' % since.strftime('%Y-%m-%dT%H:%M:%S.000Z') if since is not None else ''
+        for catalog in list(catalogs):
+            offerings = connector.get_paginated('%s/DSProductCatalog/api/catalogManagement/v2/catalog/%s/productOffering/%s' % (
+                connector.store_url, catalog['id'], offerings_filter), self._page_size)
+            for offering in offerings:
+                product_id = offering.get('productSpecification', {}).get('id')
+                summary['offerings'] += 1
+                summary['updated'] += self._update(indexed, user, 'offering', offering, product_id, packages.get(product_id))
+                seen.add(offering['href'])
+
+        # Incremental passes only list the updated elements, so they cannot detect removals
+        if since is None:
+            removed = [href for href in indexed if href not in seen]
+            db.IndexedElement.delete_by_href(removed)
+            summary['removed'] = len(removed)
+        model.Session.commit()
+
+        db.State.set(SYNC_KEY % user, started.strftime(DATE_FORMAT))
+        if since is None:
+            db.State.set(FULL_SYNC_KEY % user, started.strftime(DATE_FORMAT))
+        log.info('Index of %s synchronized: %s' % (user, summary))
+        return summary
+
+    def search(self, user, **filters):
+        db.init_db(model)
+        return db.IndexedElement.search(user, **filters)
+
+    def get_statuses(self, user):
+        db.init_db(model)
+        return db.IndexedElement.get_statuses(user)
@@ -17,20 +17,62 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
 
+import atexit
+from functools import partial
+import threading
+
 import ckan.plugins as plugins
 
-from store_connector import StoreConnector
+import connections
+import profiling
+import recording
+import reference_data
+import scheduling
+import tracing
+from cache import ExpiringDict
+from deletion import DeletionBatcher
+from middleware import FirstRequestMiddleware
+from multistore import get_store_connector, get_store_urls
+from store_connector import LISTING_VALIDATORS, StoreConnector
+from sync import ProductSync
 from pylons import config
 
 
 class StorePublisher(plugins.SingletonPlugin):
 
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IPackageController, inherit=True)
     plugins.implements(plugins.IRoutes, inherit=True)
+    plugins.implements(plugins.IMiddleware, inherit=True)
 
     def __init__(self, name=None):
-        self._store_connector = StoreConnector(config)
+        store_connector = StoreConnector(config)
+        # Datasets are published in all the configured stores
+        self._store_connector = get_store_connector(store_connector, config)
+        # Tasks of the web workers, started when they serve their first request
+        self._background_tasks = []
+        self._background_lock = threading.Lock()
+
+        # Fields of the datasets being deleted, captured before the deletion. The
+        # entries of deletions that fail after delete() has been called expire
+        self._deleted_datasets = ExpiringDict(ttl=300)
+
+        # Updates of published datasets are pushed to the store, coalescing bursts of updates
+        self._product_sync = None
+        if plugins.toolkit.asbool(config.get('ckan.baepublisher.sync_products', True)):
+            self._product_sync = ProductSync(store_connector, int(config.get('ckan.baepublisher.sync_window', 30)))
+            # Updates still waiting for their window are pushed before the process exits
+            atexit.register(self._product_sync.flush)
+
+        # Deletions made by the same user within the window are retired in a single batch
+        self._deletion_batcher = None
+        delete_window = float(config.get('ckan.baepublisher.delete_window', 0))
+        if delete_window > 0:
+            self._deletion_batcher = DeletionBatcher(
+                self._store_connector, delete_window, int(config.get('ckan.baepublisher.delete_workers', 4)))
+            # Deletions still waiting for their window are retired before the process exits
+            atexit.register(self._deletion_batcher.flush)
 
     def update_config(self, config):
         # Add this plugin's templates dir to CKAN's extra_template_paths, so
@@ -40,20 +82,93 @@ class StorePublisher(plugins.SingletonPlugin):
         # Register this plugin's fanstatic directory with CKAN.
         plugins.toolkit.add_resource('fanstatic', 'baepublisher')
 
+    def configure(self, config):
+        connections.configure(config)
+        recording.configure(config)
+        reference_data.configure(config)
+        scheduling.configure(config)
+        profiling.configure(config)
+        tracing.configure(config)
+
+        # Parsed store listings kept by the worker to make conditional requests
+        LISTING_VALIDATORS.configure(int(config.get('ckan.baepublisher.listing_cache_size', 8)) * 1024 * 1024)
+
+        # Load the store categories and keep them fresh
+        background_tasks = []
+        if plugins.toolkit.asbool(config.get('ckan.baepublisher.warm_up', True)):
+            background_tasks.append(partial(reference_data.start_refresher, self._store_connector.store_url,
+                                            self._store_connector._lock_backend))
+
+        # Open connections to the stores before the first publication needs them
+        prewarm_connections = int(config.get('ckan.baepublisher.prewarm_connections', 2))
+        if prewarm_connections > 0:
+            store_urls = [self._store_connector.store_url] + [
+                url for url in get_store_urls(config) if url.rstrip('/') != self._store_connector.store_url]
+            background_tasks.append(partial(
+                connections.start_prewarmer, store_urls, prewarm_connections,
+                int(config.get('ckan.baepublisher.prewarm_idle', 60)), self._store_connector.verify_https))
+
+        with self._background_lock:
+            self._background_tasks = background_tasks
+
+    def make_middleware(self, app, config):
+        # Paster commands do not build the WSGI app, so they do not start the background tasks
+        return FirstRequestMiddleware(app, self._start_background_tasks)
+
+    def _start_background_tasks(self):
+        # The middleware can wrap several apps (Pylons and Flask), tasks are started only once
+        with self._background_lock:
+            tasks, self._background_tasks = self._background_tasks, []
+
+        for task in tasks:
+            task()
+
     def before_map(self, m):
         # Publish data offering controller
         m.connect('dataset_publish', '/dataset/publish/{id}', action='publish',
                   controller='ckanext.baepublisher.controllers.ui_controller:PublishControllerUI',
                   ckan_icon='shopping-cart')
+        # Categories and catalogs of the publish form
+        m.connect('baepublisher_reference_data', '/baepublisher/reference_data', action='reference_data',
+                  controller='ckanext.baepublisher.controllers.ui_controller:PublishControllerUI')
+        m.connect('baepublisher_reference_data_content', '/baepublisher/reference_data/{content}', action='reference_data',
+                  controller='ckanext.baepublisher.controllers.ui_controller:PublishControllerUI')
+        # Products and offerings of the user
+        m.connect('baepublisher_dashboard_offerings', '/dashboard/offerings', action='offerings',
+                  controller='ckanext.baepublisher.controllers.dashboard_controller:DashboardControllerUI',
+                  ckan_icon='shopping-cart')
         return m
 
     ######################################################################
     ######################### IPACKAGECONTROLLER #########################
     ######################################################################
 
+    def after_update(self, context, pkg_dict):
+        if self._product_sync is not None:
+            self._product_sync.schedule(pkg_dict['id'])
+
+        return pkg_dict
+
+    def delete(self, entity):
+        # package_delete can receive either the id or the name of the dataset
+        dataset = {'id': entity.id, 'name': entity.name, 'private': entity.private}
+        self._deleted_datasets.set(entity.id, dataset)
+        self._deleted_datasets.set(entity.name, dataset)
+
+    @profiling.profiled('after_delete', lambda self, context, pkg_dict: {
+        'dataset': pkg_dict.get('id'), 'user': context.get('user')})
     def after_delete(self, context, pkg_dict):
 
-        dataset = plugins.toolkit.get_action('package_show')(context, pkg_dict)
-        self._store_connector.delete_attached_resources(dataset)
+        dataset = self._deleted_datasets.pop(pkg_dict.get('id'), None)
+        if dataset is not None:
+            self._deleted_datasets.pop(dataset['id'], None)
+            self._deleted_datasets.pop(dataset['name'], None)
+        else:
+            dataset = plugins.toolkit.get_action('package_show')(context, pkg_dict)
+
+        if self._deletion_batcher is not None:
+            self._deletion_batcher.add(dataset)
+        else:
+            self._store_connector.delete_attached_resources(dataset)
 
         return pkg_dict
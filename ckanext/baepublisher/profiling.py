@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import cProfile
+from datetime import datetime
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+from decorator import decorator
+
+log = logging.getLogger(__name__)
+
+
+class Profiler(object):
+    """
+    Profiles a sample of the calls to the wrapped functions. Each profile is
+    written to ckan.baepublisher.profile_dir as a .prof file (readable with
+    pstats or snakeviz) next to a .json file with the request metadata. Only
+    the last ckan.baepublisher.profile_keep profiles are kept.
+    """
+
+    def __init__(self, config=None):
+        self.configure(config or {})
+
+    def configure(self, config):
+        self.rate = float(config.get('ckan.baepublisher.profile_rate', 0))
+        self.directory = config.get('ckan.baepublisher.profile_dir') or \
+            os.path.join(tempfile.gettempdir(), 'baepublisher-profiles')
+        self.keep = int(config.get('ckan.baepublisher.profile_keep', 100))
+        self._lock = threading.Lock()
+
+    def should_profile(self):
+        return self.rate > 0 and random.random() < self.rate
+
+    def run(self, name, metadata, func, *args, **kwargs):
+        profile = cProfile.Profile()
+        start = time.time()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            metadata = dict(metadata, name=name, pid=os.getpid(), duration=time.time() - start,
+                            date=datetime.utcnow().isoformat())
+            try:
+                self.save(profile, metadata)
+            except Exception as e:
+                log.warn('Profile of %s could not be saved: %s' % (name, e))
+
+    def save(self, profile, metadata):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        base = os.path.join(self.directory, '%s-%s-%d' % (
+            datetime.utcnow().strftime('%Y%m%d%H%M%S%f'), metadata['name'], metadata['pid']))
+        profile.dump_stats(base + '.prof')
+        with open(base + '.json', 'w') as f:
+            json.dump(metadata, f, indent=2, sort_keys=True, default=str)
+
+        self.rotate()
+
+    def rotate(self):
+        with self._lock:
+            profiles = sorted(name for name in os.listdir(self.directory) if name.endswith('.prof'))
+            for name in profiles[:max(len(profiles) - self.keep, 0)]:
+                base = os.path.join(self.directory, name[:-len('.prof')])
+                for path in (base + '.prof', base + '.json'):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+
+# Profiler shared by all the profiled functions of the process
+PROFILER = Profiler()
+
+
+def configure(config):
+    PROFILER.configure(config)
+
+
+def profiled(name, get_metadata=None):
+    """
+    Decorator that profiles a sample of the calls to the function. The
+    signature of the function is kept, since Pylons uses it to pass the
+    arguments of the actions. get_metadata receives the arguments of the call
+    and returns the metadata stored with the profile.
+    """
+
+    def _profiled(func, *args, **kwargs):
+        # When profiling is disabled the only cost is this check
+        if not PROFILER.should_profile():
+            return func(*args, **kwargs)
+
+        metadata = {}
+        if get_metadata is not None:
+            try:
+                metadata = get_metadata(*args, **kwargs)
+            except Exception as e:
+                log.warn('Metadata of the %s profile could not be got: %s' % (name, e))
+
+        return PROFILER.run(name, metadata, func, *args, **kwargs)
+
+    return decorator(_profiled)
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import copy
+import fcntl
+import json
+import logging
+import threading
+import time
+
+from ckanext.baepublisher import metrics
+from ckanext.baepublisher.scheduling import BACKGROUND
+
+log = logging.getLogger(__name__)
+
+READ = 'read'
+WRITE = 'write'
+
+
+def take_token(state, rate, capacity, now):
+    """
+    Token bucket step. Returns the new state of the bucket (tokens, timestamp)
+    and the seconds to wait until a token is available (0 if one has been taken)
+    """
+    tokens, timestamp = state if state else (capacity, now)
+    tokens = min(capacity, tokens + max(now - timestamp, 0) * rate)
+
+    if tokens >= 1:
+        return (tokens - 1, now), 0
+
+    return (tokens, now), (1 - tokens) / rate
+
+
+class MemoryBackend(object):
+    """
+    Buckets shared by the threads of the process
+    """
+
+    _guard = threading.Lock()
+    _buckets = {}
+
+    def __init__(self, config):
+        pass
+
+    def take(self, bucket, rate, capacity):
+        with self._guard:
+            self._buckets[bucket], wait = take_token(self._buckets.get(bucket), rate, capacity, time.time())
+            return wait
+
+
+class FileBackend(object):
+    """
+    Buckets shared by the processes of the node, stored in a file protected
+    with an exclusive lock
+    """
+
+    def __init__(self, config):
+        self.path = config.get('ckan.baepublisher.rate_limit_file', '/tmp/ckanext-baepublisher-ratelimit.json')
+
+    def take(self, bucket, rate, capacity):
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                buckets = json.loads(content) if content else {}
+                buckets[bucket], wait = take_token(buckets.get(bucket), rate, capacity, time.time())
+
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(buckets))
+                f.flush()
+                return wait
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class RedisBackend(object):
+    """
+    Buckets shared by all the nodes using the same Redis server (or a Redis
+    compatible one). The token bucket step is run as a script, so it is atomic
+    """
+
+    SCRIPT = '''
+        local state = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+        local rate = tonumber(ARGV[1])
+        local capacity = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local tokens = tonumber(state[1]) or capacity
+        local timestamp = tonumber(state[2]) or now
+        tokens = math.min(capacity, tokens + math.max(now - timestamp, 0) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'timestamp', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+        return tostring(wait)
+    '''
+
+    def __init__(self, config):
+        # redis is only required when this backend is used
+        import redis
+
+        url = config.get('ckan.baepublisher.rate_limit_redis_url') or config.get('ckan.redis.url', 'redis://localhost:6379/0')
+        self._script = redis.StrictRedis.from_url(url).register_script(self.SCRIPT)
+
+    def take(self, bucket, rate, capacity):
+        return float(self._script(keys=['baepublisher:ratelimit:%s' % bucket], args=[rate, capacity, time.time()]))
+
+
+RATE_LIMIT_BACKENDS = {
+    'memory': MemoryBackend,
+    'file': FileBackend,
+    'redis': RedisBackend,
+}
+
+# Backends shared by all the limiters of the process, so their clients and
+# connections are created only once
+_BACKENDS = {}
+_BACKENDS_LOCK = threading.Lock()
+
+
+def get_rate_limit_backend(config):
+    """
+    Returns the backend configured in ckan.baepublisher.rate_limit_backend
+    """
+    name = config.get('ckan.baepublisher.rate_limit_backend', 'memory').strip()
+
+    with _BACKENDS_LOCK:
+        if name not in _BACKENDS:
+            _BACKENDS[name] = RATE_LIMIT_BACKENDS[name](config)
+        return _BACKENDS[name]
+
+
+class RateLimiter(object):
+    """
+    Limits the rate of the requests made to the store, with separate budgets
+    for reads (GET requests) and mutations. Each budget is a token bucket of
+    ckan.baepublisher.rate_limit_reads (or rate_limit_writes) requests per
+    second, which allows bursts of up to ckan.baepublisher.rate_limit_burst
+    requests. Budgets without a rate are not limited.
+
+    Background requests also take from a shared budget of
+    ckan.baepublisher.rate_limit_background requests per second, so bulk jobs
+    running in other processes leave capacity to the interactive ones.
+    """
+
+    def __init__(self, config):
+        self.rates = {
+            READ: float(config.get('ckan.baepublisher.rate_limit_reads', 0)),
+            WRITE: float(config.get('ckan.baepublisher.rate_limit_writes', 0)),
+            BACKGROUND: float(config.get('ckan.baepublisher.rate_limit_background', 0)),
+        }
+        self.burst = float(config.get('ckan.baepublisher.rate_limit_burst', 0))
+
+        # Prefix of the buckets, so each store has its own budgets
+        self.scope = ''
+
+        self._backend = None
+        if any(self.rates.values()):
+            self._backend = get_rate_limit_backend(config)
+
+    def for_scope(self, scope):
+        """
+        Returns a limiter with the same rates whose budgets are separated from
+        the budgets of this one
+        """
+        limiter = copy.copy(self)
+        limiter.scope = scope
+        return limiter
+
+    @staticmethod
+    def get_kind(method):
+        return READ if method.lower() in ('get', 'head', 'options') else WRITE
+
+    def acquire(self, method, priority=None):
+        """
+        Waits until the request can be made
+        """
+        buckets = [self.get_kind(method)]
+        if priority == BACKGROUND:
+            buckets.append(BACKGROUND)
+
+        for bucket in buckets:
+            self._take(bucket)
+
+    def _take(self, bucket):
+        rate = self.rates[bucket]
+        if self._backend is None or not rate:
+            return
+
+        capacity = max(self.burst or rate, 1)
+        waited = 0
+        while True:
+            try:
+                wait = self._backend.take(self.scope + bucket, rate, capacity)
+            except Exception as e:
+                # The store must still be reachable when the backend is down
+                log.warn('Rate limit backend not available: %s' % e)
+                return
+
+            if wait <= 0:
+                break
+
+            waited += wait
+            time.sleep(wait)
+
+        if waited:
+            metrics.increment('rate_limit_wait_ms', int(waited * 1000))
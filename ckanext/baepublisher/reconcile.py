@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from datetime import datetime
+import logging
+from multiprocessing.pool import ThreadPool
+import re
+from urllib import quote
+
+import ckan.model as model
+
+from ckanext.baepublisher import db
+
+log = logging.getLogger(__name__)
+
+WATERMARK_KEY = 'reconcile_watermark'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+ACTIVE_STATUSES = ['active', 'launched']
+PRODUCT_ID_RE = re.compile(r'productSpecId=([^&]+)')
+
+
+def parse_date(value):
+    # Dates are returned by the store as 2017-03-14T10:00:00.000Z
+    try:
+        return datetime.strptime(value[:19], DATE_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_active(element):
+    return element.get('lifecycleStatus', '').lower() in ACTIVE_STATUSES
+
+
+def get_package_states(package_ids, batch_size=100):
+    """
+    Returns the state of the given datasets. Purged datasets are not included
+    """
+    states = {}
+    for i in range(0, len(package_ids), batch_size):
+        batch = package_ids[i:i + batch_size]
+        query = model.Session.query(model.Package.id, model.Package.state).filter(model.Package.id.in_(batch))
+        states.update(dict(query))
+
+    return states
+
+
+def get_dataset_products(connector, url, page_size=100):
+    """
+    Returns the product specifications of the store whose Location is the given
+    dataset URL. They are filtered again, since some stores ignore the filters
+    on nested fields
+    """
+    products = connector.get_paginated(
+        '%s/DSProductCatalog/api/catalogManagement/v2/productSpecification/'
+        '?productSpecCharacteristic.productSpecCharacteristicValue.value=%s' % (
+            connector.store_url, quote(url.encode('utf-8'), safe='')), page_size)
+
+    return [product for product in products
+            if connector._get_product_url(product.get('productSpecCharacteristic', [])) == url]
+
+
+class Reconciler(object):
+    """
+    Detects and fixes the drift between the CKAN datasets and the product
+    specifications of the store:
+
+    * Active products whose dataset has been deleted or purged are retired,
+      together with their offerings.
+    * Private datasets whose acquire URL points to a product that is not
+      active anymore are repaired, pointing them to an active product of the
+      dataset or removing the acquire URL.
+
+    Only the datasets and the products modified since the last run are
+    checked, unless a full pass is requested: the store is only asked for the
+    products updated since then and for the products of the deleted and
+    private datasets that have been modified. When there are more of these
+    datasets than max_lookups, all the products are listed instead of looking
+    them up one by one. Store requests and product retirements are made in
+    parallel by a bounded number of workers.
+
+    The products of datasets purged after their last update in the store are
+    only detected by full passes, since purged datasets leave no trace in CKAN.
+    """
+
+    def __init__(self, connector, page_size=100, workers=4, max_lookups=100):
+        self._connector = connector
+        self._page_size = page_size
+        self._workers = workers
+        self._max_lookups = max_lookups
+        self._dataset_prefix = '%s/dataset/' % connector.site_url
+
+    def _index_products(self, since=None):
+        # Products of this CKAN instance indexed by their Location URL. When a date is
+        # given, only the products updated after it are requested to the store
+        products_by_url = {}
+        for product in self._connector.get_products(page_size=self._page_size, modified_since=since):
+            url = self._connector._get_product_url(product.get('productSpecCharacteristic', []))
+            if url.startswith(self._dataset_prefix):
+                products_by_url.setdefault(url, []).append(product)
+
+        return products_by_url
+
+    def _get_dataset_products(self, url):
+        return url, get_dataset_products(self._connector, url, self._page_size)
+
+    def _lookup_products(self, packages):
+        # Products of the given datasets indexed by their Location URL, requested in parallel
+        pool = ThreadPool(self._workers)
+        try:
+            return dict(pool.map(self._get_dataset_products, [self._dataset_prefix + package.id for package in packages]))
+        finally:
+            pool.close()
+            pool.join()
+
+    def _get_modified_packages(self, since):
+        # Only the columns needed to check the datasets are loaded
+        query = model.Session.query(model.Package.id, model.Package.state, model.Package.private)
+        if since is not None:
+            query = query.filter(model.Package.metadata_modified >= since)
+
+        return query.order_by(model.Package.metadata_modified).yield_per(self._page_size)
+
+    def _get_acquire_urls(self, package_ids):
+        # Acquire URLs of the datasets, loaded in batches instead of once per dataset
+        acquire_urls = {}
+        for i in range(0, len(package_ids), self._page_size):
+            batch = package_ids[i:i + self._page_size]
+            query = model.Session.query(model.PackageExtra.package_id, model.PackageExtra.value).filter(
+                model.PackageExtra.package_id.in_(batch), model.PackageExtra.key == 'acquire_url',
+                model.PackageExtra.state == 'active')
+            acquire_urls.update(dict(query))
+
+        return acquire_urls
+
+    def _get_package_states(self, package_ids):
+        return get_package_states(package_ids, self._page_size)
+
+    def _get_acquire_url(self, product):
+        return '%s/#/offering?productSpecId=%s' % (self._connector.store_url, product['id'])
+
+    def _check_package(self, package, products, acquire_url, to_retire, to_repair):
+        active_products = [product for product in products if is_active(product)]
+
+        if package.state == 'deleted':
+            for product in active_products:
+                to_retire[product['id']] = product
+
+        elif package.private:
+            acquire_url = acquire_url or ''
+            match = PRODUCT_ID_RE.search(acquire_url) if acquire_url.startswith(self._connector.store_url) else None
+
+            if match is not None and match.group(1) not in [product['id'] for product in active_products]:
+                new_url = self._get_acquire_url(active_products[0]) if len(active_products) > 0 else ''
+                to_repair[package.id] = new_url
+
+    def _retire(self, product):
+        try:
+            self._connector._retire_product(product)
+            return product['id'], None
+        except Exception as e:
+            return product['id'], e
+
+    def run(self, full=False):
+        """
+        Runs a reconciliation pass and stores the time it started, so the next
+        pass only checks the elements modified after it.
+
+        :param full: Whether all the datasets and products have to be checked
+        :type full: bool
+
+        :returns: A summary of the pass: number of checked datasets and products,
+            and the ids of retired products, failed products and repaired datasets
+        :rtype: dict
+        """
+        db.init_db(model)
+        since = None if full else parse_date(db.State.get(WATERMARK_KEY))
+        started = datetime.utcnow()
+        log.info('Reconciling datasets and products modified since %s' % (since or 'the beginning'))
+
+        to_retire = {}
+        to_repair = {}
+
+        # Datasets modified in CKAN. Only the deleted and private ones can need a fix
+        checked_datasets = 0
+        packages = []
+        for package in self._get_modified_packages(since):
+            checked_datasets += 1
+            if package.state == 'deleted' or package.private:
+                packages.append(package)
+
+        # In incremental passes the index only has the modified products, so the products of
+        # the datasets are looked up, unless there are so many that listing them all is cheaper
+        lookup = since is not None and len(packages) <= self._max_lookups
+        if since is not None and not lookup:
+            log.info('Listing all the products to check %d datasets' % len(packages))
+
+        products_by_url = self._index_products(since if lookup else None)
+        dataset_products = self._lookup_products(packages) if lookup else products_by_url
+
+        acquire_urls = self._get_acquire_urls([package.id for package in packages if package.state != 'deleted'])
+        for package in packages:
+            products = dataset_products.get(self._dataset_prefix + package.id, [])
+            self._check_package(package, products, acquire_urls.get(package.id), to_retire, to_repair)
+
+        # Products modified in the store whose dataset does not exist anymore. They are
+        # filtered again, since some stores ignore the date filter
+        modified_products = {}
+        for url, products in products_by_url.items():
+            for product in products:
+                last_update = parse_date(product.get('lastUpdate'))
+                if since is None or last_update is None or last_update >= since:
+                    modified_products.setdefault(url[len(self._dataset_prefix):], []).append(product)
+
+        states = self._get_package_states(list(modified_products.keys()))
+        for package_id, products in modified_products.items():
+            if states.get(package_id, 'deleted') == 'deleted':
+                for product in products:
+                    if is_active(product):
+                        to_retire[product['id']] = product
+
+        # Fix the drift
+        retired = []
+        failed = []
+        if to_retire:
+            pool = ThreadPool(self._workers)
+            try:
+                for product_id, error in pool.imap_unordered(self._retire, to_retire.values()):
+                    if error is None:
+                        retired.append(product_id)
+                    else:
+                        log.warn('Product %s could not be retired: %s' % (product_id, error))
+                        failed.append(product_id)
+            finally:
+                pool.close()
+                pool.join()
+
+        for package_id, acquire_url in to_repair.items():
+            self._connector._save_acquire_url(package_id, acquire_url)
+
+        # Failed products are checked again in the next pass
+        if not failed:
+            db.State.set(WATERMARK_KEY, started.strftime(DATE_FORMAT))
+
+        summary = {
+            'datasets': checked_datasets,
+            'products': sum(len(products) for products in modified_products.values()),
+            'retired': retired,
+            'failed': failed,
+            'repaired': list(to_repair.keys()),
+        }
+        log.info('Reconciliation finished: %s' % summary)
+        return summary
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import base64
+from collections import defaultdict, deque
+import json
+import logging
+import threading
+import time
+from urllib import urlencode
+
+log = logging.getLogger(__name__)
+
+SCRUBBED = 'SCRUBBED'
+
+# Headers and body fields that contain credentials
+SECRET_HEADERS = ('authorization', 'cookie', 'set-cookie', 'proxy-authorization')
+SECRET_FIELDS = ('access_token', 'refresh_token', 'token', 'password', 'client_secret')
+
+# Body fields that contain images, replaced with padding of the same length
+IMAGE_FIELDS = ('data',)
+
+
+class ReplayError(Exception):
+    pass
+
+
+def get_key(method, url, params=None):
+    if params:
+        url = '%s?%s' % (url, urlencode(sorted(params.items())))
+    return '%s %s' % (method.upper(), url)
+
+
+def scrub_headers(headers):
+    return dict(
+        (name, SCRUBBED if name.lower() in SECRET_HEADERS else value)
+        for name, value in (headers or {}).items())
+
+
+def scrub(data):
+    """
+    Returns a copy of the JSON document with the credentials removed and the
+    images replaced by padding, so the size of the payload is kept
+    """
+    if isinstance(data, dict):
+        scrubbed = {}
+        for key, value in data.items():
+            if key in SECRET_FIELDS:
+                value = SCRUBBED
+            elif key in IMAGE_FIELDS and isinstance(value, basestring):
+                value = 'A' * len(value)
+            else:
+                value = scrub(value)
+            scrubbed[key] = value
+        return scrubbed
+    elif isinstance(data, list):
+        return [scrub(value) for value in data]
+    return data
+
+
+class Recorder(object):
+    """
+    Sends the requests to the store and appends each request and its response
+    to the cassette, one JSON document per line
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, method, send, url, **kwargs):
+        start = time.time()
+        response = send(url, **kwargs)
+        elapsed = time.time() - start
+
+        try:
+            self.record(method, url, kwargs, response, elapsed)
+        except Exception as e:
+            log.warn('%s(%s) could not be recorded: %s' % (method, url, e))
+
+        return response
+
+    def record(self, method, url, kwargs, response, elapsed):
+        content = response.content
+        try:
+            body, encoding = scrub(json.loads(content)), 'json'
+        except ValueError:
+            try:
+                body, encoding = content.decode('utf-8'), 'text'
+            except UnicodeDecodeError:
+                body, encoding = base64.b64encode(content).decode('ascii'), 'base64'
+
+        request_body = kwargs.get('json')
+        entry = {
+            'key': get_key(method, url, kwargs.get('params')),
+            'request': {
+                'headers': scrub_headers(kwargs.get('headers')),
+                'json': scrub(request_body),
+                'size': len(kwargs['data']) if kwargs.get('data') is not None else
+                len(json.dumps(request_body)) if request_body is not None else 0,
+            },
+            'response': {
+                'status_code': response.status_code,
+                'headers': scrub_headers(response.headers),
+                'body': body,
+                'encoding': encoding,
+            },
+            'elapsed': elapsed,
+        }
+
+        line = json.dumps(entry, sort_keys=True)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+class ReplayResponse(object):
+    """
+    Recorded response, with the attributes of requests.Response used by the
+    extension
+    """
+
+    def __init__(self, url, recorded):
+        # Imported here since requests is only needed when the store is contacted
+        from requests.structures import CaseInsensitiveDict
+
+        self.url = url
+        self.status_code = recorded['status_code']
+        self.headers = CaseInsensitiveDict(recorded['headers'])
+        if recorded['encoding'] == 'json':
+            self.content = json.dumps(recorded['body']).encode('utf-8')
+        elif recorded['encoding'] == 'base64':
+            self.content = base64.b64decode(recorded['body'])
+        else:
+            self.content = recorded['body'].encode('utf-8')
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if not self.ok:
+            from requests import HTTPError
+            raise HTTPError('%s Error for url: %s' % (self.status_code, self.url), response=self)
+
+
+class Player(object):
+    """
+    Serves the responses recorded in the cassette, waiting the recorded
+    latency multiplied by latency_scale (0 to answer immediately). Requests to
+    the same endpoint are answered in the recorded order, repeating the last
+    response once all of them have been served.
+    """
+
+    def __init__(self, path, latency_scale=1.0):
+        self.latency_scale = latency_scale
+        self._entries = defaultdict(deque)
+        self._lock = threading.Lock()
+
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries[entry['key']].append(entry)
+
+    def send(self, method, send, url, **kwargs):
+        key = get_key(method, url, kwargs.get('params'))
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise ReplayError('No response recorded for %s' % key)
+            entry = entries.popleft() if len(entries) > 1 else entries[0]
+
+        if self.latency_scale > 0:
+            time.sleep(entry['elapsed'] * self.latency_scale)
+
+        return ReplayResponse(url, entry['response'])
+
+
+TRANSPORT = None
+
+
+def configure(config):
+    """
+    Sets the mode configured in ckan.baepublisher.http_mode: record (the
+    requests to the store are saved to ckan.baepublisher.http_cassette) or
+    replay (the store is not contacted and the saved responses are returned).
+    Requests are sent normally by default.
+    """
+    global TRANSPORT
+
+    mode = config.get('ckan.baepublisher.http_mode', '').strip()
+    path = config.get('ckan.baepublisher.http_cassette', 'baepublisher-cassette.jsonl')
+
+    if mode == 'record':
+        TRANSPORT = Recorder(path)
+    elif mode == 'replay':
+        TRANSPORT = Player(path, float(config.get('ckan.baepublisher.replay_latency_scale', 1)))
+    elif mode:
+        raise ValueError('Invalid ckan.baepublisher.http_mode: %s' % mode)
+    else:
+        TRANSPORT = None
+
+
+def wrap(method, send):
+    """
+    Returns the function used to send a request with the given method, which
+    goes through the recorder or the player when configured
+    """
+    transport = TRANSPORT
+    if transport is None:
+        return send
+
+    return lambda url, **kwargs: transport.send(method, send, url, **kwargs)
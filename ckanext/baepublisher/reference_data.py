@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import logging
+import os
+import socket
+import threading
+import time
+
+from ckanext.baepublisher import compression, recording, tracing
+from ckanext.baepublisher.cache import RefreshAheadCache, ValidatorCache
+from ckanext.baepublisher.category_snapshot import SnapshotStore
+
+log = logging.getLogger(__name__)
+
+VERIFY_SSL = not bool(os.environ.get('OAUTHLIB_INSECURE_TRANSPORT'))
+
+# Categories and catalogs of the store shared by all the requests of the worker
+CACHE = RefreshAheadCache()
+
+# Validators of the last responses, used to revalidate the cached values
+VALIDATORS = ValidatorCache()
+
+# Sorted categories shared by all the workers of the node, when configured
+SNAPSHOT = None
+
+# Held by the worker of the node that refreshes the shared snapshot
+REFRESHER_LOCK = 'baepublisher-categories-%s-%s'
+
+
+class ReferenceDataError(Exception):
+
+    def __init__(self, content, data):
+        super(ReferenceDataError, self).__init__('{} couldnt be loaded'.format(content))
+        self.data = data
+
+
+def fetch_content(store_url, content, user=None):
+    # Imported here since requests is only needed once the store is contacted
+    import requests
+
+    filters = {
+        'lifecycleStatus': 'Launched'
+    }
+    if content == 'catalog':
+        filters['relatedParty.id'] = user
+
+    def _request(headers):
+        url = '{0}/DSProductCatalog/api/catalogManagement/v2/{1}'.format(store_url, content)
+        with tracing.span('store GET', {'http.method': 'GET', 'http.route': tracing.get_endpoint_template(url),
+                                        'retries': 0}) as span:
+            if span.recording:
+                headers = tracing.inject(dict(headers))
+
+            response = recording.wrap('get', requests.get)(url, params=filters, headers=headers, verify=VERIFY_SSL)
+            compression.record_response(response)
+
+            if span.recording:
+                span.set_attribute('http.status_code', response.status_code)
+                span.set_attribute('http.request_size', 0)
+                span.set_attribute('http.response_size', len(response.content))
+
+            # Checking that the request finished successfully
+            try:
+                response.raise_for_status()
+            except Exception:
+                raise ReferenceDataError(content, response.json())
+
+            return response
+
+    key = content if content != 'catalog' else 'catalog:%s' % user
+    return VALIDATORS.fetch(key, _request)
+
+
+def get_content(store_url, content, user=None):
+    """
+    Returns the launched elements of the given type (category, catalog) from the
+    cache. Catalogs are cached per user, since only the ones of the user are returned
+
+    :raises ReferenceDataError: When the content is not cached and the store
+        returns an error
+    """
+    key = content if content != 'catalog' else 'catalog:%s' % user
+    return CACHE.get(key, lambda: fetch_content(store_url, content, user))
+
+
+def sort_categories(categories):
+    """
+    Sorts the categories so each one is followed by its children, and returns
+    them together with a dict with the href, id and parentId of each category
+    """
+    list_of_categories = []
+    cat_relatives = {}
+    categories_sorted = sorted(categories, key=lambda x: int(x['id']))
+    if not len(categories_sorted):
+        return list_of_categories, cat_relatives
+    list_of_categories.append(categories_sorted[0])
+    cat_relatives[categories_sorted[0]['id']] = {'href': categories_sorted[0]['href'],
+                                                 'id': categories_sorted[0]['id']}
+    categories_sorted.pop(0)
+
+    # Im sorry for this double loop, ill try to optimize this
+    for tag in categories_sorted:
+        if tag['isRoot']:
+            list_of_categories.append(tag)
+            cat_relatives[tag['id']] = {'href': tag['href'],
+                                        'id': tag['id']}
+            continue
+        for item in list_of_categories:
+            if tag['parentId'] == item['id']:
+                list_of_categories.insert(list_of_categories.index(item) + 1, tag)
+                cat_relatives[tag['id']] = {'href': tag['href'],
+                                            'id': tag['id'],
+                                            'parentId': tag.get('parentId', '')}
+                break
+    return list_of_categories, cat_relatives
+
+
+def get_category_snapshot():
+    """
+    Returns the shared category snapshot, or None when it is not configured,
+    it has not been published yet or it is too old to be served
+    """
+    if SNAPSHOT is None:
+        return None
+
+    snapshot = SNAPSHOT.current()
+    if snapshot is None or time.time() - snapshot.updated > CACHE.ttl + CACHE.max_stale:
+        return None
+
+    return snapshot
+
+
+def publish_category_snapshot(categories, relatives):
+    if SNAPSHOT is None:
+        return
+
+    try:
+        if SNAPSHOT.publish(categories, relatives):
+            log.info('New category snapshot published in %s' % SNAPSHOT.path)
+    except Exception as e:
+        log.warn('Category snapshot could not be published: %s' % e)
+
+
+def configure(config):
+    global SNAPSHOT
+
+    CACHE.configure(
+        int(config.get('ckan.baepublisher.reference_data_ttl', 300)),
+        int(config.get('ckan.baepublisher.reference_data_refresh_ahead', 60)),
+        int(config.get('ckan.baepublisher.reference_data_max_stale', 3600)),
+        int(config.get('ckan.baepublisher.reference_data_max_entries', 1000)))
+
+    snapshot_path = config.get('ckan.baepublisher.category_snapshot', '').strip()
+    SNAPSHOT = SnapshotStore(snapshot_path) if snapshot_path else None
+
+
+def _elect_refresher(locks):
+    # Without a snapshot each worker keeps its own categories. Otherwise the lock is only
+    # released when its holder exits, so another worker of the node takes over then
+    if SNAPSHOT is None or locks is None:
+        return True
+
+    try:
+        return locks.acquire(REFRESHER_LOCK % (socket.gethostname(), os.path.abspath(SNAPSHOT.path)), 0)
+    except Exception as e:
+        log.warn('Category refresher could not be elected: %s' % e)
+        return False
+
+
+def _refresh_categories(store_url):
+    try:
+        categories = fetch_content(store_url, 'category')
+        if SNAPSHOT is not None:
+            # Workers read the categories from the snapshot, so they are not kept in memory
+            publish_category_snapshot(*sort_categories(categories))
+        else:
+            CACHE.set('category', categories)
+    except Exception as e:
+        log.warn('Categories could not be loaded: %s' % e)
+
+
+def _keep_categories_fresh(store_url, locks=None):
+    elected = False
+    while True:
+        elected = elected or _elect_refresher(locks)
+        if elected:
+            _refresh_categories(store_url)
+
+        time.sleep(max(CACHE.ttl - CACHE.refresh_ahead, 1))
+
+
+def start_refresher(store_url, locks=None):
+    """
+    Loads the categories, shared by all the users, right away and keeps them
+    fresh in background, so requests never wait for them. When the categories
+    are shared through a snapshot, only the worker of the node that holds the
+    refresher lock of the given backend requests them to the store, the rest
+    only read the snapshot.
+    """
+    thread = threading.Thread(target=_keep_categories_fresh, args=(store_url, locks))
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from collections import deque
+from contextlib import contextmanager
+import threading
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+_local = threading.local()
+
+
+def current_priority():
+    """
+    Returns the priority class of the store requests made by the current
+    thread. Requests are considered background traffic unless they are made
+    inside a priority(INTERACTIVE) block
+    """
+    return getattr(_local, 'priority', BACKGROUND)
+
+
+@contextmanager
+def priority(name):
+    previous = current_priority()
+    _local.priority = name
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+class Scheduler(object):
+    """
+    Limits the number of concurrent store requests of the process to a number
+    of slots. Free slots are given to the waiting requests using weighted fair
+    queuing between the priority classes, so interactive requests jump ahead of
+    background ones while background ones still get a share of the slots
+    proportional to their weight. With 0 slots requests are not scheduled.
+    """
+
+    def __init__(self, slots=0, weights=None):
+        self._cond = threading.Condition()
+        self.configure(slots, weights)
+
+    def configure(self, slots, weights=None):
+        with self._cond:
+            self.slots = slots
+            self.weights = weights or {INTERACTIVE: 10, BACKGROUND: 1}
+            self._free = slots
+            self._queues = dict((name, deque()) for name in self.weights)
+            self._virtual = dict((name, 0.0) for name in self.weights)
+            self._clock = 0.0
+            self._cond.notify_all()
+
+    def _finish(self, name):
+        return self._virtual[name] + 1.0 / self.weights[name]
+
+    def _next_class(self):
+        waiting = [name for name, queue in self._queues.items() if queue]
+        if not waiting:
+            return None
+
+        # The class whose next request has the lowest virtual finish time is served first
+        return min(waiting, key=lambda name: (self._finish(name), -self.weights[name]))
+
+    def acquire(self, priority_name):
+        with self._cond:
+            if self.slots <= 0:
+                return False
+
+            queue = self._queues[priority_name]
+            if not queue:
+                # Idle classes do not accumulate credit
+                self._virtual[priority_name] = max(self._virtual[priority_name], self._clock)
+
+            ticket = object()
+            queue.append(ticket)
+            while not (self._free > 0 and self._next_class() == priority_name and queue[0] is ticket):
+                self._cond.wait()
+
+            queue.popleft()
+            self._free -= 1
+            self._clock = self._virtual[priority_name]
+            self._virtual[priority_name] = self._finish(priority_name)
+
+            # Other waiting requests may be served now if there are more free slots
+            self._cond.notify_all()
+            return True
+
+    def release(self):
+        with self._cond:
+            self._free = min(self._free + 1, self.slots)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority_name=None):
+        acquired = self.acquire(priority_name or current_priority())
+        try:
+            yield
+        finally:
+            if acquired:
+                self.release()
+
+
+# Scheduler shared by all the store connectors of the process
+SCHEDULER = Scheduler()
+
+
+def configure(config):
+    SCHEDULER.configure(
+        int(config.get('ckan.baepublisher.scheduler_slots', 0)),
+        {
+            INTERACTIVE: int(config.get('ckan.baepublisher.scheduler_interactive_weight', 10)),
+            BACKGROUND: int(config.get('ckan.baepublisher.scheduler_background_weight', 1)),
+        })
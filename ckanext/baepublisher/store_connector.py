@@ -19,9 +19,13 @@
 
 from __future__ import unicode_literals
 
-from datetime import datetime
+import copy
+from datetime import datetime, timedelta
 from decimal import Decimal
+import hashlib
+import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import re
 from unicodedata import normalize
@@ -29,17 +33,71 @@ from urlparse import urlparse
 
 import ckan.model as model
 import ckan.plugins as plugins
-from requests_oauthlib import OAuth2Session
+from vdm.sqlalchemy import SQLAlchemySession
+
+from ckanext.baepublisher import compression, connections, db, jobs, recording, scheduling, tracing
+from ckanext.baepublisher.cache import ValidatorCache
+from ckanext.baepublisher.locks import get_lock_backend, LockTimeout
+from ckanext.baepublisher.ratelimit import RateLimiter
 
 log = logging.getLogger(__name__)
 WHITESPACE_RE = re.compile(r'\s+')
 REPEATED_DOTS_RE = re.compile(r'\.{2,}')
+INACTIVE_STATUSES = ['retired', 'obsolete']
+
+# Validators and parsed bodies of the store listings, shared by all the connectors of the worker
+LISTING_VALIDATORS = ValidatorCache()
 
 
 class StoreException(Exception):
     pass
 
 
+class StoreRequestError(Exception):
+    """
+    Error response of the store, with its status code
+    """
+
+    def __init__(self, message, status_code):
+        super(StoreRequestError, self).__init__(message)
+        self.status_code = status_code
+
+
+class PublishProgress(object):
+    """
+    Results of the steps of a publication that have already been completed
+    (image, asset, product, acquire_url and offering). They are saved as they
+    are completed, so a failed publication can be resumed reusing the elements
+    already created in the store. Without a checkpoint record the results are
+    only kept in memory.
+    """
+
+    def __init__(self, checkpoint=None, steps=None):
+        self._checkpoint = checkpoint
+        self.steps = steps or {}
+
+    def get(self, step):
+        return self.steps.get(step)
+
+    def complete(self, step, value=True):
+        self.steps[step] = value
+        if self._checkpoint is None:
+            return
+
+        try:
+            self._checkpoint.complete(step, value)
+        except Exception as e:
+            # The publication goes on, it just cannot be resumed
+            log.warn('Publish checkpoint could not be saved: %s' % e)
+            self._checkpoint = None
+
+
+def OAuth2Session(*args, **kwargs):
+    # requests_oauthlib is only imported when the first request to the store is made
+    from requests_oauthlib import OAuth2Session as _OAuth2Session
+    return _OAuth2Session(*args, **kwargs)
+
+
 # http get https://biz-ecosystem.conwet.com/#/api/offering/resources/
 class StoreConnector(object):
 
@@ -53,6 +111,88 @@ class StoreConnector(object):
 
         self.verify_https = os.environ.get('OAUTHLIB_INSECURE_TRANSPORT', 'false').strip().lower() in ('', 'false', '0', 'off')
 
+        # Concurrent publications of the same dataset are serialized using this lock
+        self._lock_backend = get_lock_backend(config)
+        self.lock_timeout = int(config.get('ckan.baepublisher.lock_timeout', 30))
+
+        # Failed publications are resumed if they are retried within this time
+        self.checkpoint_ttl = timedelta(seconds=int(config.get('ckan.baepublisher.checkpoint_ttl', 86400)))
+
+        # Search index updates caused by the publisher are run by the background workers
+        self.async_reindex = plugins.toolkit.asbool(config.get('ckan.baepublisher.async_reindex', True))
+
+        # Identity used when there is no logged in user (e.g. paster commands)
+        self.service_user = config.get('ckan.baepublisher.service_user', '').strip()
+        self.service_token = config.get('ckan.baepublisher.service_token', '').strip()
+
+        # Requests are throttled to avoid flooding the store
+        self._rate_limiter = RateLimiter(config)
+
+        # Request bodies sent compressed to the endpoints that support it
+        self._compression = compression.CompressionPolicy(config)
+
+        # By default, requests are made on behalf of the user of the current request
+        self._identity = None
+
+        # Only the main store sets the acquire URL of the datasets
+        self.primary = True
+
+    def for_store(self, store_url):
+        """
+        Returns a copy of the connector that publishes in another store. Its
+        requests have their own rate limits and its publish records and locks
+        are separated from the ones of the main store.
+        """
+        connector = copy.copy(self)
+        connector.store_url = store_url[:-1] if store_url.endswith('/') else store_url
+        connector.primary = False
+        connector._rate_limiter = self._rate_limiter.for_scope('%s:' % connector.store_url)
+        return connector
+
+    def bind(self, user, token, token_refresh=None):
+        """
+        Returns a copy of the connector that makes the requests on behalf of the
+        given user instead of the user of the current request, so it can be used
+        outside the request thread.
+
+        :param token_refresh: Function called when the token has expired. It must
+            return the new token
+        """
+        connector = copy.copy(self)
+        connector._identity = {
+            'user': user,
+            'token': token,
+            'token_refresh': token_refresh
+        }
+        return connector
+
+    def bind_service(self):
+        if not self.service_user or not self.service_token:
+            raise StoreException('ckan.baepublisher.service_user and ckan.baepublisher.service_token are required to access the store without a logged in user')
+
+        return self.bind(self.service_user, {'token_type': 'Bearer', 'access_token': self.service_token})
+
+    def _get_user(self):
+        if self._identity is None:
+            return plugins.toolkit.c.user
+        return self._identity['user']
+
+    def _get_token(self):
+        if self._identity is None:
+            return plugins.toolkit.c.usertoken
+        return self._identity['token']
+
+    def _refresh_token(self):
+        if self._identity is None:
+            plugins.toolkit.c.usertoken_refresh()
+            return True
+
+        if self._identity['token_refresh'] is None:
+            return False
+
+        self._identity['token'] = self._identity['token_refresh']()
+        return True
+
     def _get_url(self, config, config_property):
         env_name = config_property.upper().replace('.', '_')
         url = os.environ.get(env_name, '').strip()
@@ -98,13 +238,16 @@ class StoreConnector(object):
         ).headers.get('Location')
         return url
 
-    def _get_product(self, product, content_info):
-        c = plugins.toolkit.c
+    def _get_product(self, product, content_info, progress=None):
+        progress = progress or PublishProgress()
+        user = self._get_user()
         type_ = 'CKAN Dataset'
 
         if len(content_info['role']) > 0:
             type_ = 'CKAN API Dataset'
-            # If there is a role defined it is needed to register the asset
+
+        # If there is a role defined it is needed to register the asset, unless a previous attempt did it
+        if len(content_info['role']) > 0 and not progress.get('asset'):
             body = {
                 'contentType': product['type'],
                 'resourceType': 'CKAN API Dataset',
@@ -125,6 +268,7 @@ class StoreConnector(object):
                 headers,
                 body
             )
+            progress.complete('asset')
 
         resource = {}
         resource['productNumber'] = product['id']
@@ -132,26 +276,28 @@ class StoreConnector(object):
         resource['name'] = product['title']
         resource['description'] = product['notes']
         resource['isBundle'] = False
-        resource['brand'] = c.user  # Name of the author
+        resource['brand'] = user  # Name of the author
         resource['lifecycleStatus'] = 'Launched'
         resource['validFor'] = {
             'startDateTime': datetime.now().isoformat()
         }
         resource['relatedParty'] = [{
-            'id': c.user,
+            'id': user,
             'href': (
                 '%s/DSPartyManagement/api/partyManagement/v2/individual/%s' % (
                     self.store_url,
-                    c.user)
+                    user)
             ),
             'role': 'Owner'
         }]
+        image_url = progress.get('image')
+        if image_url is None:
+            image_url = self._upload_image(product['title'], content_info['image_base64'])
+            progress.complete('image', image_url)
+
         resource['attachment'] = [{
             'type': 'Picture',
-            'url': self._upload_image(
-                product['title'],
-                content_info['image_base64']
-            )
+            'url': image_url
         }]
         resource['bundledProductSpecification'] = []
         resource['productSpecificationRelationship'] = []
@@ -195,23 +341,27 @@ class StoreConnector(object):
             }]
         }]
         if content_info['license_title'] or content_info['license_description']:
-            resource['productSpecCharacteristic'].append({
-                'configurable': False,
-                'name': 'License',
-                'description': content_info['license_description'],
-                'valueType': 'string',
-                'productSpecCharacteristicValue': [{
-                    "valueType": "string",
-                    "default": True,
-                    "value": content_info['license_title'],
-                    "unitOfMeasure": "",
-                    "valueFrom": "",
-                    "valueTo": ""
-                }]
-            })
+            resource['productSpecCharacteristic'].append(
+                self._get_license_characteristic(content_info['license_title'], content_info['license_description']))
 
         return resource
 
+    def _get_license_characteristic(self, title, description):
+        return {
+            'configurable': False,
+            'name': 'License',
+            'description': description,
+            'valueType': 'string',
+            'productSpecCharacteristicValue': [{
+                "valueType": "string",
+                "default": True,
+                "value": title,
+                "unitOfMeasure": "",
+                "valueFrom": "",
+                "valueTo": ""
+            }]
+        }
+
     def _get_offering(self, offering_info, product):
         offering = {
             'name': offering_info['name'],
@@ -244,62 +394,120 @@ class StoreConnector(object):
         return offering
 
     def _make_request(self, method, url, headers={}, data=None):
-        def _get_headers_and_make_request(method, url, headers, data):
+        def _get_headers_and_make_request(method, url, headers, data, span):
+            priority = scheduling.current_priority()
+            self._rate_limiter.acquire(method, priority)
+
             # Include access token in the request
-            usertoken = plugins.toolkit.c.usertoken
+            usertoken = self._get_token()
             final_headers = headers.copy()
             # Receive the content in JSON to parse the errors easily
             final_headers['Accept'] = 'application/json'
-            # OAuth2Session
-            oauth_request = OAuth2Session(token=usertoken)
+            # Propagate the trace context to the store
+            if span.recording:
+                tracing.inject(final_headers)
+            # OAuth2Session, using the connections shared by all the requests
+            oauth_request = connections.mount(OAuth2Session(token=usertoken))
+
+            # Requests go through the recorder or the player when configured
+            req_method = recording.wrap(method, getattr(oauth_request, method))
+            body = self._compression.encode(url, data)
+            if span.recording:
+                span.set_attribute('http.request_size', len(body) if body is not None else
+                                   len(json.dumps(data)) if data is not None else 0)
+
+            with scheduling.SCHEDULER.slot(priority):
+                if body is None:
+                    req = req_method(url, headers=final_headers, json=data, verify=self.verify_https)
+                else:
+                    final_headers['Content-Type'] = 'application/json'
+                    final_headers['Content-Encoding'] = 'gzip'
+                    req = req_method(url, headers=final_headers, data=body, verify=self.verify_https)
+
+            compression.record_response(req)
+            if span.recording:
+                span.set_attribute('http.status_code', req.status_code)
+                span.set_attribute('http.response_size', len(req.content))
+            return req
 
-            req_method = getattr(oauth_request, method)
-            req = req_method(url, headers=final_headers, json=data, verify=self.verify_https)
+        with tracing.span('store %s' % method.upper(), {
+                'http.method': method.upper(),
+                'http.route': tracing.get_endpoint_template(url),
+                'retries': 0}) as span:
 
-            return req
+            req = _get_headers_and_make_request(method, url, headers, data, span)
 
-        req = _get_headers_and_make_request(method, url, headers, data)
+            # When a 401 status code is got,
+            # we should refresh the token and retry the request.
+            if req.status_code == 401 and self._refresh_token():
+                log.info(
+                    '%s(%s): returned 401. Token expired? Request will be retried with a refreshed token' % (method, url)
+                )
+                span.set_attribute('retries', 1)
+                # Update the header 'Authorization'
+                req = _get_headers_and_make_request(method, url, headers, data, span)
 
-        # When a 401 status code is got,
-        # we should refresh the token and retry the request.
-        if req.status_code == 401:
-            log.info(
-                '%s(%s): returned 401. Token expired? Request will be retried with a refreshed token' % (method, url)
-            )
-            plugins.toolkit.c.usertoken_refresh()
-            # Update the header 'Authorization'
-            req = _get_headers_and_make_request(method, url, headers, data)
+            log.info('%s(%s): %s %s' % (method, url, req.status_code, req.text))
+
+            status_code_first_digit = req.status_code / 100
+            invalid_first_digits = [4, 5]
 
-        log.info('%s(%s): %s %s' % (method, url, req.status_code, req.text))
+            if status_code_first_digit in invalid_first_digits:
+                result = req.json()
+                error_msg = result['error']
+                raise StoreRequestError(error_msg, req.status_code)
 
-        status_code_first_digit = req.status_code / 100
-        invalid_first_digits = [4, 5]
+            return req
 
-        if status_code_first_digit in invalid_first_digits:
-            result = req.json()
-            error_msg = result['error']
-            raise Exception(error_msg)
+    def _get_json(self, url):
+        """
+        Makes a GET request and returns the parsed body. When the listing has been
+        requested before and the store returned validators, the request is
+        conditional and the parsed body is reused if the listing has not changed
+        """
+        def _request(headers):
+            if headers:
+                return self._make_request('get', url, headers)
+            return self._make_request('get', url)
 
-        return req
+        # Listings depend on the permissions of the user
+        return LISTING_VALIDATORS.fetch('%s %s' % (self._get_user(), url), _request)
 
     def _update_acquire_url(self, dataset, resource):
-        # Set needed variables
-        c = plugins.toolkit.c
-        tk = plugins.toolkit
-        context = {'model': model, 'session': model.Session,
-                   'user': c.user or c.author, 'auth_user_obj': c.userobj,
-                   }
-
-        if dataset['private']:
+        if dataset['private'] and self.primary:
             resource_url = '%s/#/offering?productSpecId=%s' % (
                 self.store_url,
                 resource['id'])
 
             if dataset.get('acquire_url', '') != resource_url:
                 dataset['acquire_url'] = resource_url
-                tk.get_action('package_update')(context, dataset)
+                self._save_acquire_url(dataset['id'], resource_url)
                 log.info('Acquire URL updated correctly to %s' % resource_url)
 
+    def _save_acquire_url(self, dataset_id, acquire_url):
+        # Only the acquire_url extra changes, so the whole package_update (validation,
+        # plugin hooks and a synchronous index update) is not needed. It is written in
+        # its own session, so the changes pending in the request session are not committed
+        session = model.meta.create_local_session()
+        try:
+            package = session.query(model.Package).get(dataset_id)
+            if package is None:
+                log.warn('Acquire URL of dataset %s not saved: the dataset does not exist' % dataset_id)
+                return
+
+            rev = model.Revision()
+            rev.author = self._get_user()
+            rev.message = 'Acquire URL updated by the BAE publisher'
+            session.add(rev)
+            SQLAlchemySession.set_revision(session, rev)
+
+            package.extras['acquire_url'] = acquire_url
+            session.commit()
+        finally:
+            session.close()
+
+        jobs.enqueue_reindex(dataset_id, self.async_reindex)
+
     def _generate_product_info(self, product):
         return {
             'id': product.get('id'),
@@ -314,18 +522,58 @@ class StoreConnector(object):
                 return x['productSpecCharacteristicValue'][0].get('value')
         return ''
 
+    def get_paginated(self, url, page_size=100):
+        """
+        Generator that returns the elements of a store listing, requesting them
+        in pages of the given size.
+
+        :param url: The URL of the listing, it can include query parameters
+        :type url: string
+        """
+        separator = '&' if '?' in url else '?'
+        offset = 0
+
+        while True:
+            page = self._get_json('%s%soffset=%d&size=%d' % (url, separator, offset, page_size))
+
+            for element in page:
+                yield element
+
+            if len(page) < page_size:
+                break
+
+            offset += page_size
+
+    def get_products(self, owner=None, page_size=100, modified_since=None):
+        """
+        Generator that returns the product specifications of the store. If an owner
+        is given, only the product specifications owned by that user are returned.
+        If a date is given, only the ones updated after it are requested.
+        """
+        url = '%s/DSProductCatalog/api/catalogManagement/v2/productSpecification/' % self.store_url
+
+        filters = []
+        if owner is not None:
+            filters.append('relatedParty.id=%s' % owner)
+        if modified_since is not None:
+            filters.append('lastUpdate.gt=%s' % modified_since.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+        if filters:
+            url += '?' + '&'.join(filters)
+
+        return self.get_paginated(url, page_size)
+
     def _get_existing_products(self, dataset):
-        c = plugins.toolkit.c
         dataset_url = self._get_dataset_url(dataset)
 
-        req = self._make_request(
-            'get',
-            '%s/DSProductCatalog/api/catalogManagement/v2/productSpecification/?relatedParty.id=%s' % (self.store_url, c.user)
+        products = self._get_json(
+            '%s/DSProductCatalog/api/catalogManagement/v2/productSpecification/?relatedParty.id=%s' % (self.store_url, self._get_user())
         )
-        products = req.json()
 
         def _valid_products_filter(product):
-            return 'productSpecCharacteristic' in product and self._get_product_url(product['productSpecCharacteristic']) == dataset_url
+            # Retired and obsolete products cannot be offered again
+            return (product.get('lifecycleStatus', '').lower() not in INACTIVE_STATUSES and
+                    'productSpecCharacteristic' in product and
+                    self._get_product_url(product['productSpecCharacteristic']) == dataset_url)
         return filter(_valid_products_filter, products)
 
     def _get_existing_product(self, product):
@@ -338,9 +586,10 @@ class StoreConnector(object):
         else:
             return None
 
-    def _create_product(self, product, content_info):
+    def _create_product(self, product, content_info, progress=None):
+        progress = progress or PublishProgress()
         # Create the resource
-        resource = self._get_product(product, content_info)
+        resource = self._get_product(product, content_info, progress)
         headers = {'Content-Type': 'application/json'}
         resp = self._make_request(
             'post',
@@ -350,10 +599,28 @@ class StoreConnector(object):
         )
 
         resp_body = resp.json()
+        product_info = self._generate_product_info(resp_body)
+        progress.complete('product', product_info)
+
         self._update_acquire_url(product, resp_body)
+        progress.complete('acquire_url')
 
         # Return the resource
-        return self._generate_product_info(resp_body)
+        return product_info
+
+    def update_product(self, product_href, changes):
+        """
+        Updates only the given fields of a product specification
+
+        :param product_href: The href of the product specification
+        :type product_href: string
+
+        :param changes: The fields to update and their new values
+        :type changes: dict
+        """
+        headers = {'Content-Type': 'application/json'}
+        eff_url = self.store_url + urlparse(product_href).path
+        self._make_request('patch', eff_url, headers, changes)
 
     def _retire_catalog_element(self, url):
         headers = {'Content-Type': 'application/json'}
@@ -380,6 +647,63 @@ class StoreConnector(object):
         except Exception as e:
             log.warn('Rollback failed %s' % e)
 
+    def _get_idempotency_key(self, dataset, offering_info):
+        # A publish attempt is identified by the dataset, the catalog and the offering version.
+        # Records of the main store do not include the store, so the existing ones are still valid
+        key = '%s|%s|%s' % (dataset['id'], offering_info['catalog'], offering_info['version'])
+        if not self.primary:
+            key = '%s|%s' % (self.store_url, key)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _get_lock_name(self, dataset):
+        # Publications of the same dataset in different stores can run at the same time
+        if self.primary:
+            return 'baepublisher-publish-%s' % dataset['id']
+        return 'baepublisher-publish-%s-%s' % (hashlib.sha1(self.store_url.encode('utf-8')).hexdigest()[:12], dataset['id'])
+
+    def _get_progress(self, idempotency_key, dataset):
+        try:
+            db.init_db(model)
+            checkpoint = db.PublishCheckpoint.by_key(idempotency_key)
+            if checkpoint is not None and checkpoint.modified >= datetime.utcnow() - self.checkpoint_ttl:
+                log.info('Resuming the publication of dataset %s' % dataset['id'])
+                return PublishProgress(checkpoint, checkpoint.get_steps())
+
+            # Checkpoints too old are not trusted, the elements may have been removed from the store
+            checkpoint = checkpoint or db.PublishCheckpoint()
+            checkpoint.idempotency_key = idempotency_key
+            checkpoint.package_id = dataset['id']
+            checkpoint.steps = '{}'
+            return PublishProgress(checkpoint)
+        except Exception as e:
+            log.warn('Publish checkpoint of dataset %s could not be loaded: %s' % (dataset['id'], e))
+            return PublishProgress()
+
+    def _get_published_offering(self, idempotency_key):
+        db.init_db(model)
+        record = db.PublishRecord.by_key(idempotency_key)
+        return record.offering_url if record is not None else None
+
+    def _record_published_offering(self, idempotency_key, dataset, offering_info, offering_url):
+        db.init_db(model)
+        record = db.PublishRecord()
+        record.idempotency_key = idempotency_key
+        record.package_id = dataset['id']
+        record.catalog = offering_info['catalog']
+        record.version = offering_info['version']
+        record.offering_url = offering_url
+        model.Session.add(record)
+        # The publication has finished, so it will not be resumed
+        db.PublishCheckpoint.delete_by_key(idempotency_key)
+        model.Session.commit()
+
+    def _forget_published_offerings(self, dataset):
+        db.init_db(model)
+        db.PublishRecord.delete_by_package(dataset['id'])
+        db.ProductSync.delete_by_package(dataset['id'])
+        db.PublishCheckpoint.delete_by_package(dataset['id'])
+        model.Session.commit()
+
     def _normalize_catalog_url(self, url):
         result_url = url
         if '(' in url:
@@ -387,6 +711,92 @@ class StoreConnector(object):
 
         return result_url
 
+    def _retire_product(self, product):
+        # Search the offerings that include the product
+        offerings = self._get_json('{0}/DSProductCatalog/api/catalogManagement/v2/productOffering/?productSpecification.id={1}'.format(
+            self.store_url,
+            product['id']))
+
+        # Set the offerings as retired
+        active_statuses = ['active', 'launched']
+        for offering in offerings:
+            if offering['lifecycleStatus'].lower() in active_statuses:
+
+                if offering['lifecycleStatus'].lower() == 'active':
+                    self._launch_catalog_element(self._normalize_catalog_url(offering['href']))
+
+                self._retire_catalog_element(self._normalize_catalog_url(offering['href']))
+
+        # Set the product as retired
+        if product['lifecycleStatus'].lower() in active_statuses:
+            if product['lifecycleStatus'].lower() == 'active':
+                self._launch_catalog_element(self._normalize_catalog_url(product['href']))
+
+            self._retire_catalog_element(self._normalize_catalog_url(product['href']))
+
+    @tracing.traced('delete_attached_resources_batch', lambda self, datasets, workers=4: {'datasets': len(datasets)})
+    def delete_attached_resources_batch(self, datasets, workers=4):
+        """
+        Retires the store resources attached to several datasets. The products
+        of the user are requested only once and the products of the datasets are
+        retired, together with their offerings, by a bounded number of workers.
+
+        :param datasets: The datasets that have been deleted
+        :type datasets: list
+
+        :returns: The ids of the datasets whose resources could not be retired
+        :rtype: list
+        """
+        # The workers cannot access the user of the current request
+        connector = self if self._identity is not None else self.bind(self._get_user(), self._get_token())
+
+        try:
+            products = connector._get_json(
+                '%s/DSProductCatalog/api/catalogManagement/v2/productSpecification/?relatedParty.id=%s' % (self.store_url, connector._get_user())
+            )
+        except Exception as e:
+            log.warn('Products of user %s could not be loaded: %s' % (connector._get_user(), e))
+            return [dataset['id'] for dataset in datasets]
+
+        # First product of each dataset, the one retired by delete_attached_resources
+        products_by_url = {}
+        for product in products:
+            if 'productSpecCharacteristic' in product:
+                products_by_url.setdefault(self._get_product_url(product['productSpecCharacteristic']), product)
+
+        to_retire = [(dataset, products_by_url[self._get_dataset_url(dataset)]) for dataset in datasets
+                     if self._get_dataset_url(dataset) in products_by_url]
+
+        def _retire(item):
+            dataset, product = item
+            try:
+                connector._retire_product(product)
+                return dataset, None
+            except Exception as e:
+                return dataset, e
+
+        failed = []
+        if to_retire:
+            pool = ThreadPool(max(min(workers, len(to_retire)), 1))
+            try:
+                for dataset, error in pool.imap_unordered(_retire, to_retire):
+                    if error is not None:
+                        log.warn('Resources of dataset %s could not be retired: %s' % (dataset['id'], error))
+                        failed.append(dataset['id'])
+            finally:
+                pool.close()
+                pool.join()
+
+        # Published offerings are not valid anymore, so the datasets can be published again
+        for dataset in datasets:
+            try:
+                self._forget_published_offerings(dataset)
+            except Exception as e:
+                log.warn('Publish records could not be removed: %s' % e)
+
+        return failed
+
+    @tracing.traced('delete_attached_resources', lambda self, dataset: {'dataset': dataset.get('id')})
     def delete_attached_resources(self, dataset):
         """
         Method to delete all the attached store resources to a dataset. In particular, the method searches for a
@@ -405,29 +815,15 @@ class StoreConnector(object):
             return
 
         if len(products) > 0:
-            product = products[0]
-            # Search the offerings that include the product
-            response = self._make_request('get', '{0}/DSProductCatalog/api/catalogManagement/v2/productOffering/?productSpecification.id={1}'.format(
-                self.store_url,
-                product['id']))
-
-            # Set the offerings as retired
-            active_statuses = ['active', 'launched']
-            for offering in response.json():
-                if offering['lifecycleStatus'].lower() in active_statuses:
-
-                    if offering['lifecycleStatus'].lower() == 'active':
-                        self._launch_catalog_element(self._normalize_catalog_url(offering['href']))
-
-                    self._retire_catalog_element(self._normalize_catalog_url(offering['href']))
-
-            # Set the product as retired
-            if product['lifecycleStatus'].lower() in active_statuses:
-                if product['lifecycleStatus'].lower() == 'active':
-                        self._launch_catalog_element(self._normalize_catalog_url(product['href']))
+            self._retire_product(products[0])
 
-                self._retire_catalog_element(self._normalize_catalog_url(product['href']))
+        # Published offerings are not valid anymore, so the dataset can be published again
+        try:
+            self._forget_published_offerings(dataset)
+        except Exception as e:
+            log.warn('Publish records could not be removed: %s' % e)
 
+    @tracing.traced('create_offering', lambda self, dataset, offering_info: {'dataset': dataset.get('id')})
     def create_offering(self, dataset, offering_info):
         """
         Method to create an offering in the store that will contain the given dataset.
@@ -436,6 +832,10 @@ class StoreConnector(object):
         a new resource will be created.
         Once that the resource is ready, a new offering will be created and the resource
         will be bounded.
+        If the same dataset has already been published in the same catalog with the same
+        offering version, the URL of the existing offering is returned without contacting
+        the Store, so repeated attempts are safe. Concurrent attempts to publish the same
+        dataset are serialized, so the later ones reuse the result of the first one.
 
         :param dataset: The dataset that will be include in the offering
         :type dataset: dict
@@ -447,40 +847,77 @@ class StoreConnector(object):
         :returns: The URL of the offering that contains the dataset
         :rtype: string
 
-        :raises StoreException: When the store cannot be connected or when the Store
-            returns some errors
+        :raises StoreException: When the store cannot be connected, when the Store
+            returns some errors or when the dataset is being published by someone else
+            for too long
         """
 
+        try:
+            with self._lock_backend.hold(self._get_lock_name(dataset), self.lock_timeout):
+                return self._create_offering(dataset, offering_info)
+        except LockTimeout:
+            log.warn('Dataset %s is being published by another request' % dataset['id'])
+            raise StoreException('The dataset is already being published. Please, try again later')
+
+    def _create_offering(self, dataset, offering_info):
         log.debug('Creating Offering %s' % offering_info['name'])
         offering_created = False
+        resource = None
+
+        idempotency_key = self._get_idempotency_key(dataset, offering_info)
+        offering_url = self._get_published_offering(idempotency_key)
+        if offering_url is not None:
+            log.info('Dataset %s has already been published in %s' % (dataset['id'], offering_url))
+            return offering_url
 
         log.debug('Dataset: ')
         log.debug(dataset)
 
+        # Steps completed by previous attempts are not repeated
+        progress = self._get_progress(idempotency_key, dataset)
+        resource = progress.get('product')
+
         # Make the request to the server
         headers = {'Content-Type': 'application/json'}
         try:
             # Get the resource. If it does not exist, it will be created
-            resource = self._get_existing_product(dataset)
             if resource is None:
-                resource = self._create_product(dataset, offering_info)
-
-            offering = self._get_offering(offering_info, resource)
-            # Create the offering
-            resp = self._make_request(
-                'post',
-                '{0}/DSProductCatalog/api/catalogManagement/v2/catalog/{1}/productOffering/'.format(
-                    self.store_url,
-                    offering_info['catalog']),
-                headers, offering
-            )
-            offering_created = True
-
-            # Return offering URL
-#            name = offering_info['name'].replace(' ', '%20')
-            return resp.url
+                resource = self._get_existing_product(dataset)
+                if resource is None:
+                    resource = self._create_product(dataset, offering_info, progress)
+                else:
+                    progress.complete('product', resource)
+                    progress.complete('acquire_url')
+
+            elif not progress.get('acquire_url'):
+                self._update_acquire_url(dataset, resource)
+                progress.complete('acquire_url')
+
+            offering_url = progress.get('offering')
+            if offering_url is None:
+                offering = self._get_offering(offering_info, resource)
+                # Create the offering
+                resp = self._make_request(
+                    'post',
+                    '{0}/DSProductCatalog/api/catalogManagement/v2/catalog/{1}/productOffering/'.format(
+                        self.store_url,
+                        offering_info['catalog']),
+                    headers, offering
+                )
+                offering_created = True
+                offering_url = resp.url
+                progress.complete('offering', offering_url)
 
         except Exception as e:
             log.warn(e)
             self._rollback(offering_info, resource, offering_created)
             raise StoreException(e.message)
+
+        # The offering has been created, so a failure saving the record must not roll it back
+        try:
+            self._record_published_offering(idempotency_key, dataset, offering_info, offering_url)
+        except Exception as e:
+            log.warn('Publish record of dataset %s could not be saved: %s' % (dataset['id'], e))
+
+        # Return offering URL
+        return offering_url
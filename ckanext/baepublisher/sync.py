@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+import copy
+from datetime import datetime
+import json
+import logging
+import threading
+
+import ckan.model as model
+import ckan.plugins as plugins
+
+from ckanext.baepublisher import db
+from ckanext.baepublisher.store_connector import StoreRequestError
+
+log = logging.getLogger(__name__)
+
+SYNCED_FIELDS = ['name', 'description', 'version']
+
+
+class Debouncer(object):
+    """
+    Coalesces the calls made with the same key within a time window. The
+    callback is called once per key, with the last value given for it, when
+    no new calls have been made for that key during the window.
+    """
+
+    def __init__(self, window, callback):
+        self._window = window
+        self._callback = callback
+        self._guard = threading.Lock()
+        self._timers = {}
+
+    def schedule(self, key, value):
+        with self._guard:
+            timer = self._timers.get(key)
+            if timer is not None:
+                timer.cancel()
+
+            timer = threading.Timer(self._window, self._fire, [key, value])
+            # Pending calls do not keep the process alive, they are run by flush
+            timer.daemon = True
+            self._timers[key] = timer
+            timer.start()
+
+    def _fire(self, key, value):
+        with self._guard:
+            if self._timers.get(key) is not threading.current_thread():
+                # The call has been superseded by a newer one
+                return
+            del self._timers[key]
+
+        self._callback(key, value)
+
+    def pending(self):
+        with self._guard:
+            return list(self._timers.keys())
+
+    def flush(self):
+        """
+        Calls the callback of the pending keys right away, without waiting for
+        the end of their windows (e.g. when the process exits)
+        """
+        with self._guard:
+            timers, self._timers = self._timers, {}
+
+        for key, timer in timers.items():
+            timer.cancel()
+            try:
+                self._callback(key, timer.args[1])
+            except Exception as e:
+                log.warn('Pending call for %s failed: %s' % (key, e))
+
+
+def get_license_characteristic(characteristics):
+    for characteristic in characteristics:
+        if characteristic.get('name') == 'License':
+            return characteristic
+    return None
+
+
+def get_license(characteristics):
+    characteristic = get_license_characteristic(characteristics)
+    return characteristic['productSpecCharacteristicValue'][0].get('value', '') if characteristic is not None else ''
+
+
+def bind_request_user(connector):
+    """
+    Returns a copy of the connector bound to the user of the current request,
+    so it can be used by other threads. When there is no logged in user (e.g.
+    harvesters), the service account is used. None is returned when there
+    are no store credentials available.
+    """
+    try:
+        c = plugins.toolkit.c
+        if c.usertoken:
+            return connector.bind(c.user, c.usertoken)
+    except (AttributeError, TypeError):
+        pass
+
+    try:
+        return connector.bind_service()
+    except Exception:
+        return None
+
+
+class ProductSync(object):
+    """
+    Keeps the product specifications of the published datasets up to date.
+    Updates of the same dataset are coalesced within a time window and only
+    the fields that have changed since the last update are sent to the store.
+    """
+
+    def __init__(self, connector, window):
+        self._connector = connector
+        self._debouncer = Debouncer(window, self._sync)
+
+    def _get_connector(self):
+        return bind_request_user(self._connector)
+
+    def schedule(self, package_id):
+        db.init_db(model)
+        if not db.PublishRecord.is_published(package_id) and db.ProductSync.by_package(package_id) is None:
+            return
+
+        connector = self._get_connector()
+        if connector is None:
+            log.debug('Product of dataset %s not updated: there are no store credentials available' % package_id)
+            return
+
+        self._debouncer.schedule(package_id, connector)
+
+    def flush(self):
+        self._debouncer.flush()
+
+    def _sync(self, package_id, connector):
+        try:
+            self.sync(connector, package_id)
+        except Exception as e:
+            log.warn('Product of dataset %s could not be updated: %s' % (package_id, e))
+        finally:
+            model.Session.remove()
+
+    def _update_product(self, connector, product_href, changes):
+        try:
+            connector.update_product(product_href, changes)
+        except StoreRequestError as e:
+            # The editor of the dataset may not be allowed to update the product of the
+            # publisher, so the service account is used instead when it is configured
+            if e.status_code not in (401, 403) or connector._get_user() == self._connector.service_user:
+                raise
+
+            try:
+                service_connector = self._connector.bind_service()
+            except Exception:
+                raise e
+
+            log.info('Product %s updated with the service account: %s' % (product_href, e))
+            service_connector.update_product(product_href, changes)
+
+    def _get_dataset_spec(self, connector, dataset, characteristics):
+        spec = {
+            'name': dataset['title'],
+            'description': dataset.get('notes') or '',
+            'version': connector.validate_version(dataset.get('version')),
+            'productSpecCharacteristic': copy.deepcopy(characteristics),
+        }
+
+        # Only the license of the dataset is synced from the characteristics. Its description
+        # is not part of the dataset, so the one given on publication is kept
+        license_title = dataset.get('license_title') or ''
+        if license_title != get_license(characteristics):
+            current = get_license_characteristic(characteristics) or {}
+            spec['productSpecCharacteristic'] = [c for c in characteristics if c.get('name') != 'License']
+            if license_title:
+                spec['productSpecCharacteristic'].append(
+                    connector._get_license_characteristic(license_title, current.get('description', '')))
+
+        return spec
+
+    def sync(self, connector, package_id):
+        """
+        Updates the product specification of the dataset with the changes made
+        since the last update, using a single PATCH request.
+
+        :returns: The fields that have been updated
+        :rtype: dict
+        """
+        db.init_db(model)
+        context = {'model': model, 'session': model.Session, 'ignore_auth': True}
+        dataset = plugins.toolkit.get_action('package_show')(context, {'id': package_id})
+
+        state = db.ProductSync.by_package(package_id)
+        if state is None:
+            # The last pushed spec is unknown, so the current product is used as reference
+            products = connector._get_existing_products(dataset)
+            if len(products) == 0:
+                return {}
+
+            product = products[0]
+            state = db.ProductSync()
+            state.package_id = package_id
+            state.product_id = product['id']
+            state.product_href = product['href']
+            last_spec = {field: product.get(field) for field in SYNCED_FIELDS}
+            last_spec['productSpecCharacteristic'] = product.get('productSpecCharacteristic', [])
+        else:
+            last_spec = json.loads(state.spec)
+
+        spec = self._get_dataset_spec(connector, dataset, last_spec['productSpecCharacteristic'])
+        changes = {field: value for field, value in spec.items() if last_spec.get(field) != value}
+
+        if changes:
+            self._update_product(connector, state.product_href, changes)
+            log.info('Product %s updated: %s' % (state.product_id, ', '.join(sorted(changes.keys()))))
+
+        state.spec = json.dumps(spec)
+        state.modified = datetime.utcnow()
+        model.Session.add(state)
+        model.Session.commit()
+
+        return changes
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+# Factories of store elements and connector mocks shared by the tests of the
+# components that list the products of the store
+
+from __future__ import unicode_literals
+
+from datetime import datetime, timedelta
+
+from mock import MagicMock
+
+SITE_URL = 'https://localhost:8474'
+STORE_URL = 'https://store.example.com:7458'
+API_URL = '%s/DSProductCatalog/api/catalogManagement/v2' % STORE_URL
+
+
+def hours_ago(hours):
+    return (datetime.utcnow() - timedelta(hours=hours)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def make_product(product_id, dataset_id='dataset', status='Launched', last_update='2018-01-02T10:00:00.000Z', site_url=SITE_URL):
+    return {
+        'id': product_id,
+        'name': 'Product %s' % product_id,
+        'version': '1.0',
+        'lifecycleStatus': status,
+        'lastUpdate': last_update,
+        'href': '%s/productSpecification/%s' % (API_URL, product_id),
+        'productSpecCharacteristic': [{
+            'name': 'Location',
+            'productSpecCharacteristicValue': [{'value': '%s/dataset/%s' % (site_url, dataset_id)}]
+        }]
+    }
+
+
+def make_offering(offering_id, product_id, status='Launched', last_update='2018-01-02T10:00:00.000Z'):
+    return {
+        'id': offering_id,
+        'name': 'Offering %s' % offering_id,
+        'version': '1.0',
+        'lifecycleStatus': status,
+        'lastUpdate': last_update,
+        'href': '%s/catalog/51/productOffering/%s' % (API_URL, offering_id),
+        'productSpecification': {'id': product_id}
+    }
+
+
+def make_connector(**kwargs):
+    connector = MagicMock(site_url=SITE_URL, store_url=STORE_URL, **kwargs)
+    connector._get_product_url.side_effect = \
+        lambda characteristics: characteristics[0]['productSpecCharacteristicValue'][0]['value'] if characteristics else ''
+    return connector
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.baepublisher.cache as cache
+
+import unittest
+
+from mock import MagicMock, patch
+from parameterized import parameterized
+
+
+class RefreshAheadCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cache.RefreshAheadCache(ttl=100, refresh_ahead=20, max_stale=50)
+        self.cache.refresh = MagicMock()
+
+    @patch('ckanext.baepublisher.cache.time')
+    def test_missing_key_is_loaded(self, time):
+        time.time.return_value = 1000
+        loader = MagicMock(return_value='value')
+
+        self.assertEquals('value', self.cache.get('key', loader))
+        self.assertEquals('value', self.cache.get('key', loader))
+        loader.assert_called_once_with()
+
+    @parameterized.expand([
+        # Fresh entry
+        (50, 'old', False, False),
+        # Close to expire, refreshed in background
+        (85, 'old', True, False),
+        # Expired but still served while it is refreshed
+        (120, 'old', True, False),
+        # Too old to be served
+        (150, 'new', False, True),
+    ])
+    @patch('ckanext.baepublisher.cache.time')
+    def test_get(self, age, expected_value, refreshed, loaded, time):
+        time.time.return_value = 1000
+        self.cache.set('key', 'old')
+        time.time.return_value = 1000 + age
+        loader = MagicMock(return_value='new')
+
+        self.assertEquals(expected_value, self.cache.get('key', loader))
+
+        if refreshed:
+            self.cache.refresh.assert_called_once_with('key', loader)
+        else:
+            self.assertEquals(0, self.cache.refresh.call_count)
+        self.assertEquals(1 if loaded else 0, loader.call_count)
+
+    def test_loader_errors_are_propagated_without_value(self):
+        loader = MagicMock(side_effect=Exception('error'))
+
+        with self.assertRaises(Exception):
+            self.cache.get('key', loader)
+
+    @patch('ckanext.baepublisher.cache.threading.Thread')
+    def test_refresh_only_once(self, Thread):
+        refresh_cache = cache.RefreshAheadCache()
+        loader = MagicMock()
+
+        refresh_cache.refresh('key', loader)
+        refresh_cache.refresh('key', loader)
+
+        Thread.assert_called_once_with(target=refresh_cache._refresh, args=('key', loader))
+
+        # Once refreshed, the key can be refreshed again
+        refresh_cache._refresh('key', MagicMock(return_value='value'))
+        refresh_cache.refresh('key', loader)
+        self.assertEquals(2, Thread.call_count)
+
+    def test_refresh_errors_keep_stale_value(self):
+        refresh_cache = cache.RefreshAheadCache()
+        refresh_cache.set('key', 'old')
+
+        refresh_cache._refresh('key', MagicMock(side_effect=Exception('error')))
+
+        self.assertEquals('old', refresh_cache.get('key', MagicMock()))
+
+    def test_least_recently_used_entries_are_dropped(self):
+        bounded_cache = cache.RefreshAheadCache(max_entries=2)
+        bounded_cache.set('a', 1)
+        bounded_cache.set('b', 2)
+        self.assertEquals(1, bounded_cache.get('a', MagicMock()))
+
+        bounded_cache.set('c', 3)
+
+        # The least recently used entry is the one dropped
+        self.assertEquals(2, len(bounded_cache))
+        self.assertEquals(1, bounded_cache.get('a', MagicMock()))
+        self.assertEquals(3, bounded_cache.get('c', MagicMock()))
+        self.assertEquals('new', bounded_cache.get('b', MagicMock(return_value='new')))
+
+    @patch('ckanext.baepublisher.cache.time')
+    def test_entries_that_cannot_be_served_are_dropped(self, time):
+        time.time.return_value = 1000
+        self.cache.set('old', 'value')
+        time.time.return_value = 1100
+        self.cache.set('recent', 'value')
+
+        time.time.return_value = 1150
+        self.cache.set('new', 'value')
+
+        # Entries older than ttl + max_stale are not kept
+        self.assertEquals(2, len(self.cache))
+
+
+class ExpiringDictTest(unittest.TestCase):
+
+    @patch('ckanext.baepublisher.cache.time.time')
+    def test_entries_expire(self, time):
+        entries = cache.ExpiringDict(ttl=10)
+        time.return_value = 100
+        entries.set('a', 1)
+        time.return_value = 105
+        entries.set('b', 2)
+
+        time.return_value = 111
+        self.assertEquals(1, len(entries))
+        self.assertIsNone(entries.pop('a'))
+        self.assertEquals(2, entries.pop('b'))
+        self.assertEquals('default', entries.pop('b', 'default'))
+
+    def test_entries_are_bounded(self):
+        entries = cache.ExpiringDict(max_entries=2)
+        for key in ['a', 'b', 'c']:
+            entries.set(key, key)
+
+        self.assertEquals(2, len(entries))
+        self.assertIsNone(entries.pop('a'))
+        self.assertEquals('c', entries.pop('c'))
+
+
+class ValidatorCacheTest(unittest.TestCase):
+
+    def _response(self, status_code=200, headers={}, data=None, content=b''):
+        return MagicMock(status_code=status_code, headers=headers, content=content, **{'json.return_value': data})
+
+    def test_entries_are_bounded(self):
+        validators = cache.ValidatorCache(max_bytes=20)
+        for key in ['a', 'b', 'c']:
+            validators.put(key, self._response(headers={'ETag': key}, content=b'x' * 10), key)
+
+        self.assertIsNone(validators.get('a'))
+        self.assertEquals('b', validators.get('b').data)
+        self.assertEquals('c', validators.get('c').data)
+        self.assertEquals(20, validators.size)
+
+    def test_big_responses_are_not_kept(self):
+        validators = cache.ValidatorCache(max_bytes=20)
+        validators.put('a', self._response(headers={'ETag': 'a'}, content=b'x' * 10), 'a')
+        validators.put('b', self._response(headers={'ETag': 'b'}, content=b'x' * 30), 'b')
+
+        self.assertIsNone(validators.get('b'))
+        self.assertEquals('a', validators.get('a').data)
+
+    def test_replaced_entries_are_not_counted_twice(self):
+        validators = cache.ValidatorCache(max_bytes=20)
+        validators.put('a', self._response(headers={'ETag': 'v1'}, content=b'x' * 10), 'a')
+        validators.put('a', self._response(headers={'ETag': 'v2'}, content=b'x' * 15), 'a')
+
+        self.assertEquals(15, validators.size)
+
+        validators.configure(10)
+        self.assertIsNone(validators.get('a'))
+        self.assertEquals(0, validators.size)
+
+    def test_responses_without_validators_are_not_kept(self):
+        validators = cache.ValidatorCache()
+        validators.put('key', self._response(headers={'ETag': 'v1'}), 'data')
+        validators.put('key', self._response(), 'new_data')
+
+        self.assertIsNone(validators.get('key'))
+
+    def test_not_modified_without_entry(self):
+        validators = cache.ValidatorCache()
+        request = MagicMock(return_value=self._response(304, data='data'))
+
+        self.assertEquals('data', validators.fetch('key', request))
+        request.assert_called_once_with({})
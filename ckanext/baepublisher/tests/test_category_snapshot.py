@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+import ckanext.baepublisher.category_snapshot as category_snapshot
+import ckanext.baepublisher.reference_data as reference_data
+
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+
+from mock import MagicMock, patch
+
+CATEGORIES = [
+    {'id': '1', 'name': 'Programación', 'isRoot': True, 'href': 'http://store/category/1'},
+    {'id': '5', 'name': 'java', 'isRoot': False, 'parentId': '1', 'href': 'http://store/category/5'},
+    {'id': '14', 'name': 'haskell', 'isRoot': False, 'parentId': '1', 'href': 'http://store/category/14'},
+    {'id': '20', 'name': 'Data', 'isRoot': True, 'href': 'http://store/category/20'},
+]
+
+
+class CategorySnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'categories.snapshot')
+        self.store = category_snapshot.SnapshotStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_no_snapshot(self):
+        self.assertIsNone(self.store.current())
+
+    def test_publish_and_read(self):
+        categories, relatives = reference_data.sort_categories(CATEGORIES)
+
+        self.assertTrue(self.store.publish(categories, relatives))
+
+        snapshot = self.store.current()
+        self.assertEquals(len(categories), len(snapshot))
+        self.assertEquals(relatives, snapshot.relatives())
+        self.assertEquals([c['id'] for c in categories], [c['id'] for c in snapshot.categories()])
+        self.assertEquals('Programación', snapshot.category(0)['name'])
+        self.assertTrue(snapshot.category(0)['isRoot'])
+        self.assertFalse(snapshot.category(1)['isRoot'])
+
+    def test_unchanged_categories_are_not_published(self):
+        categories, relatives = reference_data.sort_categories(CATEGORIES)
+        with patch('time.time', return_value=1000):
+            self.store.publish(categories, relatives)
+        snapshot = self.store.current()
+
+        with patch('time.time', return_value=5000):
+            self.assertFalse(self.store.publish(categories, relatives))
+
+        # The snapshot is not rewritten, but it is marked as up to date
+        self.assertIs(snapshot, self.store.current())
+        self.assertEquals(5000, snapshot.updated)
+
+    def test_old_snapshots_are_not_served(self):
+        categories, relatives = reference_data.sort_categories(CATEGORIES)
+        self.store.publish(categories, relatives)
+
+        with patch('ckanext.baepublisher.reference_data.SNAPSHOT', self.store):
+            with patch('time.time', return_value=time.time() + 4000):
+                self.assertIsNone(reference_data.get_category_snapshot())
+
+                # Publishing the same categories again keeps serving the snapshot
+                self.store.publish(categories, relatives)
+                self.assertIsNotNone(reference_data.get_category_snapshot())
+
+    def test_new_snapshots_are_picked_up(self):
+        reader = category_snapshot.SnapshotStore(self.path)
+        self.store.publish(*reference_data.sort_categories(CATEGORIES[:1]))
+        self.assertEquals(1, len(reader.current()))
+
+        self.store.publish(*reference_data.sort_categories(CATEGORIES))
+
+        self.assertEquals(len(CATEGORIES), len(reader.current()))
+        # Temporary files are not left behind
+        self.assertEquals(['categories.snapshot'], os.listdir(self.directory))
+
+    def test_invalid_file(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'X' * 64)
+
+        self.assertIsNone(self.store.current())
+
+    @patch('ckanext.baepublisher.reference_data.fetch_content', return_value=CATEGORIES)
+    def test_single_refresher(self, fetch_content):
+        locks = MagicMock()
+        locks.acquire.return_value = False
+
+        with patch('ckanext.baepublisher.reference_data.SNAPSHOT', self.store):
+            # Another worker of the node holds the lock, the store is not contacted
+            self.assertFalse(reference_data._elect_refresher(locks))
+            self.assertEquals(0, fetch_content.call_count)
+
+            locks.acquire.return_value = True
+            self.assertTrue(reference_data._elect_refresher(locks))
+            reference_data._refresh_categories('http://store')
+
+        self.assertEquals(reference_data.REFRESHER_LOCK % (socket.gethostname(), self.path), locks.acquire.call_args[0][0])
+        self.assertEquals(0, locks.acquire.call_args[0][1])
+        self.assertEquals(len(CATEGORIES), len(self.store.current()))
+
+    def test_refresher_without_snapshot(self):
+        locks = MagicMock()
+
+        with patch('ckanext.baepublisher.reference_data.SNAPSHOT', None):
+            # Each worker keeps its own categories
+            self.assertTrue(reference_data._elect_refresher(locks))
+
+        self.assertEquals(0, locks.acquire.call_count)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+import ckanext.baepublisher.cleanup as cleanup
+
+import unittest
+from datetime import timedelta
+
+from mock import MagicMock
+from store_fixtures import API_URL, hours_ago, make_connector, make_product
+
+OFFERINGS_URL = API_URL + '/productOffering/?productSpecification.id=%s'
+PRODUCTS_URL = API_URL + '/productSpecification/?offset=%d&size=2'
+
+
+def make_old_product(product_id, age=48, **kwargs):
+    return make_product(product_id, last_update=hours_ago(age), **kwargs)
+
+
+class GarbageCollectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self._model = cleanup.model
+        cleanup.model = MagicMock()
+
+        self._db = cleanup.db
+        cleanup.db = MagicMock()
+        cleanup.db.State.get.return_value = None
+
+        self.connector = make_connector(checkpoint_ttl=timedelta(days=1))
+
+        self.collector = cleanup.GarbageCollector(self.connector, page_size=2, workers=2, max_pages=2, min_age=24)
+        self.collector._get_referenced_products = MagicMock(return_value=set(['4']))
+        self.collector._expire_checkpoints = MagicMock(return_value=(0, []))
+        self.collector._get_package_states = MagicMock(return_value={})
+
+    def tearDown(self):
+        cleanup.model = self._model
+        cleanup.db = self._db
+
+    def _set_store(self, products, offerings):
+        def _get_json(url):
+            for offset in range(0, len(products) + 2, 2):
+                if url == PRODUCTS_URL % offset:
+                    return products[offset:offset + 2]
+            return offerings.get(url, [])
+
+        self.connector._get_json.side_effect = _get_json
+
+    def test_orphaned_products_retired(self):
+        self._set_store([
+            make_old_product('1'),
+            # Included in an offering
+            make_old_product('2'),
+            # Already retired
+            make_old_product('3', status='Retired'),
+            # Acquire URL of a dataset
+            make_old_product('4'),
+            make_old_product('5', dataset_id='other', status='Retired'),
+        ], {OFFERINGS_URL % '2': [{'id': 'offering'}]})
+        self.collector._max_pages = 3
+
+        summary = self.collector.run()
+
+        self.assertEquals(['1'], summary['orphans'])
+        self.assertEquals(['1'], summary['retired'])
+        self.connector._normalize_catalog_url.assert_called_once_with(API_URL + '/productSpecification/1')
+        self.connector._retire_catalog_element.assert_called_once_with(self.connector._normalize_catalog_url.return_value)
+        # The listing has been fully checked, so the next run starts again
+        self.assertEquals(5, summary['products'])
+        cleanup.db.State.set.assert_called_once_with(cleanup.CURSOR_KEY, '0')
+
+    def test_products_of_existing_datasets_kept(self):
+        self._set_store([
+            make_old_product('1', dataset_id='live'),
+            make_old_product('2', dataset_id='deleted'),
+            make_old_product('3', dataset_id='purged'),
+        ], {})
+        self.connector.get_paginated.return_value = [make_old_product('1', dataset_id='live')]
+        self.collector._get_package_states.return_value = {'live': 'active', 'deleted': 'deleted'}
+
+        summary = self.collector.run()
+
+        self.assertEquals(['2', '3'], sorted(summary['orphans']))
+        self.assertEquals(['deleted', 'live', 'purged'], sorted(self.collector._get_package_states.call_args[0][0]))
+        # The only product of the live dataset is not checked
+        self.assertFalse(any(
+            call[0][0] == OFFERINGS_URL % '1' for call in self.connector._get_json.call_args_list))
+
+    def test_duplicated_products_of_existing_datasets_retired(self):
+        self._set_store([
+            make_old_product('1', dataset_id='live', age=72),
+            make_old_product('2', dataset_id='live', age=48),
+        ], {})
+        self.connector.get_paginated.return_value = [
+            make_old_product('1', dataset_id='live', age=72),
+            make_old_product('2', dataset_id='live', age=48),
+            # Newer products that cannot be reused do not count
+            make_old_product('3', dataset_id='live', age=1, status='Retired'),
+            # Ignored by the store filter
+            make_old_product('4', dataset_id='other', age=1),
+        ]
+        self.collector._get_package_states.return_value = {'live': 'active'}
+
+        summary = self.collector.run()
+
+        # The newest product of the dataset is kept for its next publication
+        self.assertEquals(['1'], summary['orphans'])
+        self.assertEquals(['1'], summary['retired'])
+        self.connector.get_paginated.assert_called_once_with(
+            API_URL + '/productSpecification/?productSpecCharacteristic.productSpecCharacteristicValue.value='
+            'https%3A%2F%2Flocalhost%3A8474%2Fdataset%2Flive', 2)
+
+    def test_products_of_existing_datasets_kept_on_lookup_errors(self):
+        self._set_store([make_old_product('1', dataset_id='live', age=72)], {})
+        self.connector.get_paginated.side_effect = Exception('Store down')
+        self.collector._get_package_states.return_value = {'live': 'active'}
+
+        self.assertEquals([], self.collector.run()['orphans'])
+        self.assertEquals(0, self.connector._retire_catalog_element.call_count)
+
+    def test_recent_and_foreign_products_kept(self):
+        self._set_store([make_old_product('1', age=2), make_old_product('2', site_url='https://other.ckan')], {})
+
+        self.assertEquals([], self.collector.run()['orphans'])
+        self.assertEquals(0, self.connector._retire_catalog_element.call_count)
+
+    def test_dry_run(self):
+        self._set_store([make_old_product('1')], {})
+
+        summary = self.collector.run(dry_run=True)
+
+        self.assertEquals(['1'], summary['orphans'])
+        self.assertEquals([], summary['retired'])
+        self.assertEquals(0, self.connector._retire_catalog_element.call_count)
+        self.assertEquals(0, cleanup.db.State.set.call_count)
+        self.collector._expire_checkpoints.assert_called_once_with(True)
+
+    def test_bounded_passes(self):
+        cleanup.db.State.get.return_value = '2'
+        products = [make_old_product('%d' % i, age=1) for i in range(10)]
+        self._set_store(products, {})
+
+        summary = self.collector.run()
+
+        # Two pages starting where the previous run stopped
+        self.assertEquals(4, summary['products'])
+        cleanup.db.State.set.assert_called_once_with(cleanup.CURSOR_KEY, '6')
+
+    def test_failures(self):
+        self._set_store([make_old_product('1')], {})
+        self.connector._retire_catalog_element.side_effect = Exception('Store down')
+
+        summary = self.collector.run()
+
+        self.assertEquals([], summary['retired'])
+        self.assertEquals(['1'], summary['failed'])
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+import ckanext.baepublisher.compression as compression
+import ckanext.baepublisher.metrics as metrics
+
+import gzip
+import io
+import json
+import unittest
+
+from mock import MagicMock
+from parameterized import parameterized
+
+BIG_BODY = {'content': {'data': 'A' * 4096}}
+
+
+class CompressionTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.policy = compression.CompressionPolicy({
+            'ckan.baepublisher.compress_requests': 'assets/uploadJob productSpecification',
+            'ckan.baepublisher.compress_min_size': '100',
+        })
+
+    @parameterized.expand([
+        ('http://store/charging/api/assetManagement/assets/uploadJob', BIG_BODY, True),
+        ('http://store/DSProductCatalog/api/catalogManagement/v2/productSpecification/', BIG_BODY, True),
+        ('http://store/DSProductCatalog/api/catalogManagement/v2/productOffering/', BIG_BODY, False),
+        ('http://store/charging/api/assetManagement/assets/uploadJob', {'small': 'body'}, False),
+        ('http://store/charging/api/assetManagement/assets/uploadJob', None, False),
+    ])
+    def test_encode(self, url, data, compressed):
+        body = self.policy.encode(url, data)
+
+        if compressed:
+            with gzip.GzipFile(fileobj=io.BytesIO(body)) as f:
+                self.assertEquals(data, json.loads(f.read().decode('utf-8')))
+            self.assertTrue(metrics.snapshot()['request_bytes_saved'] > 0)
+        else:
+            self.assertIsNone(body)
+            self.assertEquals({}, metrics.snapshot())
+
+    def test_disabled_by_default(self):
+        policy = compression.CompressionPolicy({})
+        self.assertIsNone(policy.encode('http://store/charging/api/assetManagement/assets/uploadJob', BIG_BODY))
+
+    @parameterized.expand([
+        ({'Content-Encoding': 'gzip', 'Content-Length': '100'}, {'response_bytes': 100, 'response_bytes_saved': 900}),
+        ({'Content-Encoding': 'deflate'}, {'response_bytes': 50, 'response_bytes_saved': 950}),
+        ({}, {}),
+    ])
+    def test_record_response(self, headers, expected_counters):
+        response = MagicMock(headers=headers, content=b'a' * 1000)
+        response.raw.tell.return_value = 50
+
+        compression.record_response(response)
+
+        self.assertEquals(expected_counters, metrics.snapshot())
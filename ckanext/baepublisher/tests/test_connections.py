@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.baepublisher.connections as connections
+
+import socket
+import threading
+import unittest
+
+import requests
+from mock import patch
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    # Kept alive connections must not block the other ones
+    daemon_threads = True
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+class DNSCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        connections.metrics.reset()
+
+    @patch('ckanext.baepublisher.connections.socket.getaddrinfo')
+    def test_addresses_are_cached(self, getaddrinfo):
+        getaddrinfo.return_value = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.1', 443))]
+        cache = connections.DNSCache(300)
+
+        self.assertEquals(('10.0.0.1', 443), cache.resolve('store.example.com', 443))
+        self.assertEquals(('10.0.0.1', 443), cache.resolve('store.example.com', 443))
+
+        getaddrinfo.assert_called_once_with('store.example.com', 443, 0, socket.SOCK_STREAM)
+        self.assertEquals(1, connections.report()['dns_lookups'])
+        self.assertEquals(1, connections.report()['dns_cache_hits'])
+
+        # Addresses are resolved again when the connection to the cached one fails
+        cache.forget('store.example.com', 443)
+        cache.resolve('store.example.com', 443)
+        self.assertEquals(2, getaddrinfo.call_count)
+
+    @patch('ckanext.baepublisher.connections.time.time')
+    @patch('ckanext.baepublisher.connections.socket.getaddrinfo')
+    def test_addresses_expire(self, getaddrinfo, time):
+        getaddrinfo.return_value = [(socket.AF_INET6, socket.SOCK_STREAM, 6, '', ('::1', 443, 0, 0))]
+        time.return_value = 1000
+        cache = connections.DNSCache(300)
+
+        self.assertEquals(('::1', 443), cache.resolve('store.example.com', 443))
+        time.return_value = 1301
+        cache.resolve('store.example.com', 443)
+
+        self.assertEquals(2, getaddrinfo.call_count)
+
+    @patch('ckanext.baepublisher.connections.socket.getaddrinfo')
+    def test_cache_disabled(self, getaddrinfo):
+        getaddrinfo.return_value = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.1', 443))]
+        cache = connections.DNSCache(0)
+
+        cache.resolve('store.example.com', 443)
+        cache.resolve('store.example.com', 443)
+
+        self.assertEquals(2, getaddrinfo.call_count)
+
+
+class ConnectionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _Server(('127.0.0.1', 0), _KeepAliveHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+
+        connections.metrics.reset()
+        connections.DNS_CACHE.clear()
+        self._adapter = connections._ADAPTER
+        connections._ADAPTER = None
+
+    def tearDown(self):
+        connections.get_adapter().close()
+        connections._ADAPTER = self._adapter
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _get(self):
+        session = connections.mount(requests.Session())
+        self.assertEquals({}, session.get(self.url).json())
+
+    def test_connections_are_reused(self):
+        # Each request uses its own session, as the requests to the store
+        self._get()
+        self._get()
+        self._get()
+
+        report = connections.report()
+        self.assertEquals(1, report['opened'])
+        self.assertEquals(2, report['reused'])
+        self.assertEquals(1, report['dns_lookups'])
+
+    def test_prewarm(self):
+        self.assertEquals(2, connections.prewarm(self.url, 2))
+        self.assertEquals(2, connections.report()['opened'])
+
+        # Both connections are already open
+        self.assertEquals(0, connections.prewarm(self.url, 2))
+
+        self._get()
+        self.assertEquals(2, connections.report()['opened'])
+        self.assertEquals(1, connections.report()['reused'])
+
+    @patch('ckanext.baepublisher.connections.time.sleep')
+    def test_prewarmer_logs_the_report(self, sleep):
+        sleep.side_effect = StopIteration()
+
+        with patch('ckanext.baepublisher.connections.log') as log:
+            with self.assertRaises(StopIteration):
+                connections._keep_connections_warm([self.url], 2, 60, True)
+
+        self.assertEquals(2, connections.report()['opened'])
+        self.assertIn('2 opened', log.info.call_args[0][0])
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2018 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+import ckanext.baepublisher.controllers.dashboard_controller as controller
+
+import unittest
+
+from mock import MagicMock
+from parameterized import parameterized
+
+
+class DashboardControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._toolkit = controller.plugins.toolkit
+        controller.plugins.toolkit = MagicMock()
+
+        self._request = controller.request
+        controller.request = MagicMock(params={})
+
+        self._helpers = controller.helpers
+        controller.helpers = MagicMock()
+
+        self._bind_request_user = controller.bind_request_user
+        controller.bind_request_user = MagicMock()
+
+        self._StoreConnector = controller.StoreConnector
+        controller.StoreConnector = MagicMock()
+
+        self._OfferingIndex = controller.OfferingIndex
+        controller.OfferingIndex = MagicMock()
+        self.index = controller.OfferingIndex.return_value
+        self.index.search.return_value = (0, [])
+        controller._INDEX = None
+
+        self.instanceController = controller.DashboardControllerUI()
+
+    def tearDown(self):
+        controller.plugins.toolkit = self._toolkit
+        controller.request = self._request
+        controller.helpers = self._helpers
+        controller.bind_request_user = self._bind_request_user
+        controller.StoreConnector = self._StoreConnector
+        controller.OfferingIndex = self._OfferingIndex
+        controller._INDEX = None
+
+    def test_index_shared(self):
+        self.assertIs(self.instanceController._index, controller.DashboardControllerUI()._index)
+        self.assertEquals(1, controller.StoreConnector.call_count)
+        self.assertIs(self.index.connector, self.instanceController._store_connector)
+
+    def test_not_logged_in(self):
+        controller.plugins.toolkit.c.user = None
+        controller.plugins.toolkit.abort.side_effect = Exception('aborted')
+
+        with self.assertRaises(Exception):
+            self.instanceController.offerings()
+
+        self.assertEquals(401, controller.plugins.toolkit.abort.call_args[0][0])
+        self.assertEquals(0, self.index.search.call_count)
+
+    @parameterized.expand([
+        ({}, 1, {'q': None, 'kind': None, 'status': None, 'sort': 'last_update', 'descending': True}),
+        ({'q': ' weather ', 'kind': 'offering', 'status': 'Launched', 'sort': 'name', 'order': 'asc', 'page': '3'}, 3,
+         {'q': 'weather', 'kind': 'offering', 'status': 'Launched', 'sort': 'name', 'descending': False}),
+        ({'kind': 'other', 'page': 'a'}, 1, {'q': None, 'kind': None, 'status': None, 'sort': 'last_update', 'descending': True}),
+    ])
+    def test_offerings(self, params, page, filters):
+        controller.plugins.toolkit.c.user = 'user'
+        controller.request.params = params
+        elements = [MagicMock()]
+        self.index.search.return_value = (41, elements)
+
+        result = self.instanceController.offerings()
+
+        connector = controller.bind_request_user.return_value
+        self.index.refresh.assert_called_once_with(connector, 'user', False)
+        self.index.search.assert_called_once_with('user', offset=(page - 1) * 20, limit=20, **filters)
+
+        page_kwargs = controller.helpers.Page.call_args[1]
+        self.assertEquals((page, 41, 20), (page_kwargs['page'], page_kwargs['item_count'], page_kwargs['items_per_page']))
+        self.assertEquals(elements, controller.helpers.Page.return_value.items)
+
+        self.assertEquals(controller.plugins.toolkit.render.return_value, result)
+        self.assertEquals('user/dashboard_offerings.html', controller.plugins.toolkit.render.call_args[0][0])
+
+    def test_offerings_refresh(self):
+        controller.plugins.toolkit.c.user = 'user'
+        controller.request.params = {'refresh': '1'}
+
+        self.instanceController.offerings()
+
+        self.index.refresh.assert_called_once_with(controller.bind_request_user.return_value, 'user', True)
+
+    def test_pager_url(self):
+        controller.helpers.url_for.return_value = '/dashboard/offerings'
+
+        url = self.instanceController._pager_url({'q': 'a b', 'kind': '', 'sort': 'name'}, 2)
+
+        self.assertTrue(url.startswith('/dashboard/offerings?'))
+        self.assertEquals(['page=2', 'q=a+b', 'sort=name'], sorted(url.split('?')[1].split('&')))
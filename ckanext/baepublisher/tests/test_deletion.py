@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+import ckanext.baepublisher.deletion as deletion
+
+import threading
+import unittest
+
+from mock import MagicMock, patch
+
+
+class DeletionBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self._model = deletion.model
+        deletion.model = MagicMock()
+
+        self._bind_request_user = deletion.bind_request_user
+        self.connector = MagicMock()
+        self.connector._get_user.return_value = 'user'
+        deletion.bind_request_user = MagicMock(return_value=self.connector)
+
+    def tearDown(self):
+        deletion.model = self._model
+        deletion.bind_request_user = self._bind_request_user
+
+    def test_deletions_are_batched(self):
+        finished = threading.Event()
+        self.connector.delete_attached_resources_batch.side_effect = lambda datasets, workers: finished.set() or []
+        batcher = deletion.DeletionBatcher(self.connector, 0.05, 2)
+
+        batcher.add({'id': 'a'})
+        batcher.add({'id': 'b'})
+        self.assertEquals({'user': 2}, batcher.pending())
+
+        self.assertTrue(finished.wait(5))
+        self.connector.delete_attached_resources_batch.assert_called_once_with([{'id': 'a'}, {'id': 'b'}], 2)
+        self.assertEquals({}, batcher.pending())
+        deletion.model.Session.remove.assert_called_once_with()
+
+    @patch('ckanext.baepublisher.deletion.threading.Timer')
+    def test_batches_per_user(self, Timer):
+        other_connector = MagicMock()
+        other_connector._get_user.return_value = 'other'
+        deletion.bind_request_user.side_effect = [self.connector, other_connector, self.connector]
+        batcher = deletion.DeletionBatcher(self.connector, 10)
+
+        batcher.add({'id': 'a'})
+        batcher.add({'id': 'b'})
+        batcher.add({'id': 'c'})
+
+        # The window starts with the first dataset of each user
+        self.assertEquals(2, Timer.call_count)
+        self.assertEquals({'user': 2, 'other': 1}, batcher.pending())
+
+        batcher._flush('user')
+        self.connector.delete_attached_resources_batch.assert_called_once_with([{'id': 'a'}, {'id': 'c'}], 4)
+        self.assertEquals({'other': 1}, batcher.pending())
+
+    @patch('ckanext.baepublisher.deletion.threading.Timer')
+    def test_no_credentials(self, Timer):
+        deletion.bind_request_user.return_value = None
+        batcher = deletion.DeletionBatcher(self.connector, 10)
+
+        batcher.add({'id': 'a'})
+
+        self.assertEquals(0, Timer.call_count)
+        self.assertEquals({}, batcher.pending())
+
+    @patch('ckanext.baepublisher.deletion.threading.Timer')
+    def test_flush_error(self, Timer):
+        self.connector.delete_attached_resources_batch.side_effect = Exception('Store down')
+        batcher = deletion.DeletionBatcher(self.connector, 10)
+        batcher.add({'id': 'a'})
+
+        batcher._flush('user')
+
+        self.assertEquals({}, batcher.pending())
+        deletion.model.Session.remove.assert_called_once_with()
+
+    @patch('ckanext.baepublisher.deletion.threading.Timer')
+    def test_flush_pending_batches(self, Timer):
+        other_connector = MagicMock()
+        other_connector._get_user.return_value = 'other'
+        deletion.bind_request_user.side_effect = [self.connector, other_connector]
+        batcher = deletion.DeletionBatcher(self.connector, 10)
+        batcher.add({'id': 'a'})
+        batcher.add({'id': 'b'})
+
+        batcher.flush()
+
+        self.connector.delete_attached_resources_batch.assert_called_once_with([{'id': 'a'}], 4)
+        other_connector.delete_attached_resources_batch.assert_called_once_with([{'id': 'b'}], 4)
+        self.assertEquals(2, Timer.return_value.cancel.call_count)
+        self.assertEquals({}, batcher.pending())
+
+        # The timers of the flushed batches have nothing left to retire
+        batcher._flush('user')
+        self.connector.delete_attached_resources_batch.assert_called_once_with([{'id': 'a'}], 4)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.baepublisher.jobs as jobs
+
+import unittest
+
+from mock import MagicMock, patch
+from parameterized import parameterized
+
+
+class JobsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._toolkit = jobs.plugins.toolkit
+        jobs.plugins.toolkit = MagicMock()
+
+    def tearDown(self):
+        jobs.plugins.toolkit = self._toolkit
+
+    @patch('ckanext.baepublisher.jobs.reindex_package')
+    def test_enqueue_reindex_deferred(self, reindex_package):
+        jobs.enqueue_reindex('package_id')
+
+        jobs.plugins.toolkit.enqueue_job.assert_called_once_with(
+            reindex_package, ['package_id'], title='baepublisher reindex package_id')
+        self.assertEquals(0, reindex_package.call_count)
+
+    @parameterized.expand([
+        (False, True),
+        (True, False),
+    ])
+    @patch('ckanext.baepublisher.jobs.reindex_package')
+    def test_enqueue_reindex_inline(self, deferred, jobs_available, reindex_package):
+        if not jobs_available:
+            del jobs.plugins.toolkit.enqueue_job
+
+        jobs.enqueue_reindex('package_id', deferred)
+
+        reindex_package.assert_called_once_with('package_id')
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.baepublisher.locks as locks
+
+import unittest
+
+from mock import MagicMock, patch
+from parameterized import parameterized
+
+
+class LocksTest(unittest.TestCase):
+
+    def setUp(self):
+        self._model = locks.model
+        locks.model = MagicMock()
+
+    def tearDown(self):
+        locks.model = self._model
+
+    @parameterized.expand([
+        ({}, locks.DatabaseLockBackend),
+        ({'ckan.baepublisher.lock_backend': 'database'}, locks.DatabaseLockBackend),
+        ({'ckan.baepublisher.lock_backend': ' local '}, locks.LocalLockBackend),
+        ({'ckan.baepublisher.lock_backend': 'ckanext.baepublisher.locks:LocalLockBackend'}, locks.LocalLockBackend),
+    ])
+    def test_get_lock_backend(self, config, expected_class):
+        self.assertIsInstance(locks.get_lock_backend(config), expected_class)
+
+    def test_get_lock_backend_shared(self):
+        config = {'ckan.baepublisher.lock_backend': 'local'}
+        self.assertIs(locks.get_lock_backend(config), locks.get_lock_backend(config))
+
+    def test_local_lock(self):
+        backend = locks.LocalLockBackend()
+
+        self.assertTrue(backend.acquire('dataset1', 0))
+        self.assertFalse(backend.acquire('dataset1', 0))
+        self.assertTrue(backend.acquire('dataset2', 0))
+
+        backend.release('dataset1')
+        self.assertTrue(backend.acquire('dataset1', 0))
+
+    @patch('ckanext.baepublisher.locks.time')
+    def test_acquire_waits_until_timeout(self, time):
+        backend = locks.LocalLockBackend()
+        backend._try_acquire('dataset')
+        time.time.side_effect = [0, 0.5, 1.5]
+
+        self.assertFalse(backend.acquire('dataset', 1))
+        time.sleep.assert_called_once_with(locks.POLL_INTERVAL)
+
+    def test_hold(self):
+        backend = locks.LocalLockBackend()
+
+        with backend.hold('dataset', 0):
+            with self.assertRaises(locks.LockTimeout):
+                with backend.hold('dataset', 0):
+                    pass
+
+        # The lock is released when the block finishes
+        self.assertTrue(backend.acquire('dataset', 0))
+
+    @parameterized.expand([
+        (True,),
+        (False,),
+    ])
+    def test_database_lock(self, acquired):
+        connection = locks.model.meta.engine.connect.return_value
+        connection.execute.return_value.scalar.return_value = acquired
+        backend = locks.DatabaseLockBackend()
+        lock_id = backend._get_lock_id('dataset')
+
+        self.assertEquals(acquired, backend._try_acquire('dataset'))
+        connection.execute.assert_called_once_with('SELECT pg_try_advisory_lock(%s)', lock_id)
+
+        if acquired:
+            # The connection is kept open until the lock is released
+            self.assertEquals(0, connection.close.call_count)
+            backend.release('dataset')
+            connection.execute.assert_called_with('SELECT pg_advisory_unlock(%s)', lock_id)
+
+        connection.close.assert_called_once_with()
+
+    def test_database_lock_id(self):
+        backend = locks.DatabaseLockBackend()
+
+        self.assertEquals(backend._get_lock_id('dataset'), backend._get_lock_id('dataset'))
+        self.assertNotEquals(backend._get_lock_id('dataset'), backend._get_lock_id('dataset2'))
+        self.assertTrue(-2 ** 63 <= backend._get_lock_id('dataset') < 2 ** 63)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.baepublisher.multistore as multistore
+
+import threading
+import unittest
+
+from mock import MagicMock, patch
+
+MAIN_STORE = 'http://store.example.com'
+OTHER_STORE = 'http://store.example.org'
+
+CATALOGS = {
+    MAIN_STORE: [{'id': '1', 'name': 'Catalog'}],
+    OTHER_STORE: [{'id': '7', 'name': 'Other'}, {'id': '8', 'name': 'Catalog'}],
+}
+
+CATEGORIES = {
+    MAIN_STORE: [{'id': '10', 'href': MAIN_STORE + '/category/10', 'name': 'Health'}],
+    OTHER_STORE: [{'id': '20', 'href': OTHER_STORE + '/category/20', 'name': 'Health'}],
+}
+
+
+def get_content(store_url, content, user=None):
+    return (CATALOGS if content == 'catalog' else CATEGORIES)[store_url]
+
+
+class MultiStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.main = MagicMock(store_url=MAIN_STORE, primary=True, _identity={'user': 'user'})
+        self.other = MagicMock(store_url=OTHER_STORE, primary=False)
+        self.other._get_user.return_value = 'user'
+        self.other.bind.return_value = self.other
+        self.main.for_store.return_value = self.other
+
+        self.config = {'ckan.baepublisher.store_urls': '%s/ %s' % (MAIN_STORE, OTHER_STORE)}
+        self.instance = multistore.MultiStoreConnector(self.main, self.config)
+
+        self._get_content = multistore.reference_data.get_content
+        multistore.reference_data.get_content = get_content
+
+    def tearDown(self):
+        multistore.reference_data.get_content = self._get_content
+
+    def test_single_store(self):
+        connector = MagicMock()
+        self.assertIs(connector, multistore.get_store_connector(connector, {}))
+
+    def test_additional_stores(self):
+        self.main.for_store.reset_mock()
+        connector = multistore.get_store_connector(self.main, self.config)
+
+        self.assertIsInstance(connector, multistore.MultiStoreConnector)
+        # The main store is not duplicated
+        self.main.for_store.assert_called_once_with(OTHER_STORE)
+        self.assertEquals([self.other], connector.stores)
+        # Other attributes are the ones of the main store
+        self.assertEquals(MAIN_STORE, connector.store_url)
+        self.assertEquals(self.main.validate_version, connector.validate_version)
+
+    def test_publish(self):
+        self.main.create_offering.return_value = MAIN_STORE + '/offering/1'
+        self.other.create_offering.return_value = OTHER_STORE + '/offering/2'
+        dataset = {'id': 'dataset'}
+        offering_info = {'catalog': '1', 'categories': [{'id': '10', 'href': MAIN_STORE + '/category/10'}]}
+
+        self.assertEquals(MAIN_STORE + '/offering/1', self.instance.create_offering(dataset, offering_info))
+
+        self.main.create_offering.assert_called_once_with(dataset, offering_info)
+        # Catalogs and categories are matched by name
+        self.other.create_offering.assert_called_once_with(dataset, {
+            'catalog': '8',
+            'categories': [{'id': '20', 'href': OTHER_STORE + '/category/20'}],
+        })
+
+    def test_publish_concurrently(self):
+        started = threading.Event()
+
+        def _create_main(dataset, offering_info):
+            started.set()
+            return 'main'
+
+        # The main store is published while the other store is waiting
+        self.main.create_offering.side_effect = _create_main
+        self.other.create_offering.side_effect = lambda dataset, offering_info: started.wait(5) and 'other'
+
+        results = self.instance.publish({'id': 'dataset'}, {'catalog': '1', 'categories': []})
+
+        self.assertEquals([MAIN_STORE, OTHER_STORE], list(results))
+        self.assertEquals({'result': 'main', 'error': None}, results[MAIN_STORE])
+        self.assertEquals({'result': 'other', 'error': None}, results[OTHER_STORE])
+
+    def test_publish_fails_in_some_stores(self):
+        self.main.create_offering.return_value = 'main'
+
+        with self.assertRaises(multistore.MultiStoreException) as e:
+            self.instance.create_offering({'id': 'dataset'}, {'catalog': '1', 'categories': [{'id': '11', 'href': ''}]})
+
+        self.assertEquals('main', e.exception.results[MAIN_STORE]['result'])
+        self.assertEquals('The category 11 does not exist in %s' % OTHER_STORE, e.exception.results[OTHER_STORE]['error'])
+        self.assertEquals(0, self.other.create_offering.call_count)
+        self.assertIn('It has been published in %s' % MAIN_STORE, '%s' % e.exception)
+
+    def test_delete(self):
+        dataset = {'id': 'dataset'}
+        self.other.delete_attached_resources.side_effect = Exception('Store down')
+
+        results = self.instance.delete_attached_resources(dataset)
+
+        self.main.delete_attached_resources.assert_called_once_with(dataset)
+        self.other.delete_attached_resources.assert_called_once_with(dataset)
+        self.assertIsNone(results[MAIN_STORE]['error'])
+        self.assertEquals('Store down', results[OTHER_STORE]['error'])
+
+    def test_delete_batch(self):
+        datasets = [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]
+        self.main.delete_attached_resources_batch.return_value = ['a']
+        self.other.delete_attached_resources_batch.return_value = ['c']
+
+        self.assertEquals(['a', 'c'], self.instance.delete_attached_resources_batch(datasets, 2))
+        self.main.delete_attached_resources_batch.assert_called_once_with(datasets, 2)
+        self.other.delete_attached_resources_batch.assert_called_once_with(datasets, 2)
+
+    def test_delete_batch_store_down(self):
+        datasets = [{'id': 'a'}, {'id': 'b'}]
+        self.main.delete_attached_resources_batch.return_value = []
+        self.other.delete_attached_resources_batch.side_effect = Exception('Store down')
+
+        self.assertEquals(['a', 'b'], self.instance.delete_attached_resources_batch(datasets))
+
+    @patch('ckanext.baepublisher.multistore.plugins')
+    def test_user_of_the_request(self, plugins):
+        self.main._identity = None
+        plugins.toolkit.c.user = 'user'
+        plugins.toolkit.c.usertoken = {'access_token': 'token'}
+
+        self.assertEquals([self.other], self.instance._get_stores())
+
+        # The other stores cannot refresh the token of the request
+        self.other.bind.assert_called_once_with('user', {'access_token': 'token'})
+
+    def test_bind(self):
+        connector = self.instance.bind('user', {'access_token': 'token'})
+
+        self.main.bind.assert_called_once_with('user', {'access_token': 'token'}, None)
+        self.assertEquals(self.main.bind.return_value, connector._primary)
+        self.assertEquals([self.other], connector.stores)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+import ckanext.baepublisher.offering_index as offering_index
+
+import unittest
+from datetime import datetime, timedelta
+
+from mock import MagicMock, patch
+from store_fixtures import API_URL, make_connector, make_offering, make_product
+
+
+class OfferingIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self._model = offering_index.model
+        offering_index.model = MagicMock()
+
+        self._db = offering_index.db
+        offering_index.db = MagicMock()
+        offering_index.db.State.get.return_value = None
+        offering_index.db.IndexedElement.by_owner.return_value = {}
+        offering_index.db.IndexedElement.side_effect = lambda: MagicMock()
+
+        self.connector = make_connector()
+        self.connector.get_products.return_value = [make_product('1', 'dataset_a'), make_product('2', 'dataset_b', 'Retired')]
+        self.connector.get_paginated.side_effect = lambda url, page_size=100: {
+            '%s/catalog/?relatedParty.id=user' % API_URL: [{'id': '51'}],
+            '%s/catalog/51/productOffering/' % API_URL: [make_offering('3', '1')],
+        }[url]
+
+        self.index = offering_index.OfferingIndex(self.connector, page_size=2)
+
+    def tearDown(self):
+        offering_index.model = self._model
+        offering_index.db = self._db
+
+    def _added(self):
+        return dict((call[0][0].href, call[0][0]) for call in offering_index.model.Session.add.call_args_list)
+
+    def test_sync(self):
+        summary = self.index.sync(self.connector, 'user')
+
+        self.assertEquals({'products': 2, 'offerings': 1, 'updated': 3, 'removed': 0}, summary)
+        self.connector.get_products.assert_called_once_with(owner='user', page_size=2, modified_since=None)
+
+        added = self._added()
+        product = added['%s/productSpecification/1' % API_URL]
+        self.assertEquals(('user', 'product', '1', 'Launched', 'dataset_a', datetime(2018, 1, 2, 10, 0, 0)),
+                          (product.owner, product.kind, product.element_id, product.lifecycle_status,
+                           product.package_id, product.last_update))
+
+        # Offerings are linked to the dataset of their product
+        offering = added['%s/catalog/51/productOffering/3' % API_URL]
+        self.assertEquals(('offering', '1', 'dataset_a'), (offering.kind, offering.product_id, offering.package_id))
+
+        offering_index.model.Session.commit.assert_called_once_with()
+        # The pass listed everything, so the next ones can be incremental
+        self.assertEquals(['index_full_synced:user', 'index_synced:user'],
+                          sorted(call[0][0] for call in offering_index.db.State.set.call_args_list))
+
+    def test_incremental_sync(self):
+        last_sync = datetime.utcnow() - timedelta(seconds=600)
+        offering_index.db.State.get.side_effect = lambda key, default=None: {
+            'index_synced:user': last_sync.strftime(offering_index.DATE_FORMAT),
+            'index_full_synced:user': (last_sync - timedelta(seconds=600)).strftime(offering_index.DATE_FORMAT),
+        }[key]
+        # The product of the offering has not been updated since the last pass
+        offering_index.db.IndexedElement.by_owner.return_value = {
+            '%s/productSpecification/1' % API_URL: MagicMock(kind='product', element_id='1', package_id='dataset_a'),
+            '%s/productSpecification/9' % API_URL: MagicMock(kind='product', element_id='9', package_id='dataset_c'),
+        }
+        self.connector.get_products.return_value = [make_product('2', 'dataset_b', 'Retired')]
+        since = last_sync.replace(microsecond=0)
+        offerings_url = '%s/catalog/51/productOffering/?lastUpdate.gt=%s' % (API_URL, since.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+        self.connector.get_paginated.side_effect = lambda url, page_size=100: {
+            '%s/catalog/?relatedParty.id=user' % API_URL: [{'id': '51'}],
+            offerings_url: [make_offering('3', '1')],
+        }[url]
+
+        summary = self.index.sync(self.connector, 'user')
+
+        self.connector.get_products.assert_called_once_with(owner='user', page_size=2, modified_since=since)
+        self.assertEquals({'products': 1, 'offerings': 1, 'updated': 2, 'removed': 0}, summary)
+        self.assertEquals('dataset_a', self._added()['%s/catalog/51/productOffering/3' % API_URL].package_id)
+        # Removed elements are only detected by full passes
+        self.assertEquals(0, offering_index.db.IndexedElement.delete_by_href.call_count)
+        offering_index.db.State.set.assert_called_once_with('index_synced:user', offering_index.db.State.set.call_args[0][1])
+
+    def test_periodic_full_sync(self):
+        last_sync = datetime.utcnow() - timedelta(seconds=600)
+        offering_index.db.State.get.side_effect = lambda key, default=None: {
+            'index_synced:user': last_sync.strftime(offering_index.DATE_FORMAT),
+            'index_full_synced:user': (last_sync - timedelta(seconds=3600)).strftime(offering_index.DATE_FORMAT),
+        }[key]
+
+        self.index.sync(self.connector, 'user')
+
+        self.connector.get_products.assert_called_once_with(owner='user', page_size=2, modified_since=None)
+        offering_index.db.IndexedElement.delete_by_href.assert_called_once_with([])
+
+    def test_sync_only_writes_changes(self):
+        unchanged = MagicMock(last_update=datetime(2018, 1, 2, 10, 0, 0), lifecycle_status='Launched', package_id='dataset_a')
+        changed = MagicMock(last_update=datetime(2018, 1, 1, 10, 0, 0), lifecycle_status='Launched', package_id='dataset_b')
+        removed = MagicMock()
+        offering_index.db.IndexedElement.by_owner.return_value = {
+            '%s/productSpecification/1' % API_URL: unchanged,
+            '%s/productSpecification/2' % API_URL: changed,
+            '%s/productSpecification/9' % API_URL: removed,
+        }
+
+        summary = self.index.sync(self.connector, 'user')
+
+        self.assertEquals(2, summary['updated'])
+        self.assertEquals(1, summary['removed'])
+        self.assertNotIn(unchanged, self._added().values())
+        self.assertEquals('Retired', changed.lifecycle_status)
+        offering_index.db.IndexedElement.delete_by_href.assert_called_once_with(['%s/productSpecification/9' % API_URL])
+
+    @patch('ckanext.baepublisher.offering_index.threading.Thread')
+    def test_refresh(self, Thread):
+        offering_index.db.State.get.return_value = (datetime.utcnow() - timedelta(seconds=10)).strftime(offering_index.DATE_FORMAT)
+        self.index.max_age = 300
+
+        # The index is recent
+        self.assertFalse(self.index.refresh(self.connector, 'user'))
+        self.assertEquals(0, Thread.call_count)
+
+        # A synchronization is requested
+        self.assertTrue(self.index.refresh(self.connector, 'user', force=True))
+        Thread.assert_called_once_with(target=self.index._run, args=(self.connector, 'user', True))
+        self.assertTrue(self.index.is_syncing('user'))
+
+        # Only one synchronization runs at the same time
+        self.assertTrue(self.index.refresh(self.connector, 'user', force=True))
+        self.assertEquals(1, Thread.call_count)
+
+        self.index._run(self.connector, 'user')
+        self.assertFalse(self.index.is_syncing('user'))
+
+    def test_failed_sync(self):
+        self.connector.get_products.side_effect = Exception('Store down')
+
+        self.index._run(self.connector, 'user')
+
+        offering_index.model.Session.rollback.assert_called_once_with()
+        self.assertEquals(0, offering_index.db.State.set.call_count)
+        self.assertFalse(self.index.is_syncing('user'))
+        self.connector._lock_backend.release.assert_called_once_with('baepublisher-index-user')
+
+    def test_sync_runs_in_a_single_worker(self):
+        self.index.sync = MagicMock()
+        self.connector._lock_backend.acquire.return_value = False
+
+        self.index._run(self.connector, 'user', True)
+
+        # Another worker holds the lock of the index
+        self.connector._lock_backend.acquire.assert_called_once_with('baepublisher-index-user', 0)
+        self.assertEquals(0, self.index.sync.call_count)
+        self.assertEquals(0, self.connector._lock_backend.release.call_count)
+
+    def test_index_synchronized_by_another_worker(self):
+        self.index.sync = MagicMock()
+        offering_index.db.State.get.return_value = datetime.utcnow().strftime(offering_index.DATE_FORMAT)
+
+        self.index._run(self.connector, 'user')
+
+        # The index became fresh while the lock was being acquired
+        self.assertEquals(0, self.index.sync.call_count)
+        self.connector._lock_backend.release.assert_called_once_with('baepublisher-index-user')
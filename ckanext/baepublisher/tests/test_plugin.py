@@ -21,7 +21,7 @@ import ckanext.baepublisher.plugin as plugin
 
 import unittest
 
-from mock import MagicMock
+from mock import MagicMock, call, patch
 from parameterized import parameterized
 
 
@@ -35,6 +35,9 @@ class PluginTest(unittest.TestCase):
         self._StoreConnector = plugin.StoreConnector
         self._store_connector_instance = MagicMock()
         plugin.StoreConnector = MagicMock(return_value=self._store_connector_instance)
+        self._ProductSync = plugin.ProductSync
+        self._product_sync_instance = MagicMock()
+        plugin.ProductSync = MagicMock(return_value=self._product_sync_instance)
 
         # Create the plugin
         self.storePublisher = plugin.StorePublisher()
@@ -42,11 +45,14 @@ class PluginTest(unittest.TestCase):
     def tearDown(self):
         plugin.plugins.toolkit = self._toolkit
         plugin.StoreConnector = self._StoreConnector
+        plugin.ProductSync = self._ProductSync
 
     @parameterized.expand([
         (plugin.plugins.IConfigurer,),
+        (plugin.plugins.IConfigurable,),
         (plugin.plugins.IRoutes,),
         (plugin.plugins.IPackageController,),
+        (plugin.plugins.IMiddleware,),
     ])
     def test_implementation(self, interface):
         self.assertTrue(interface.implemented_by(plugin.StorePublisher))
@@ -60,15 +66,75 @@ class PluginTest(unittest.TestCase):
         plugin.plugins.toolkit.add_template_directory.assert_called_once_with(config, 'templates')
         plugin.plugins.toolkit.add_resource.assert_called_once_with('fanstatic', 'baepublisher')
 
+    @parameterized.expand([
+        (True,),
+        (False,),
+    ])
+    def test_configure(self, warm_up):
+        self._reference_data = plugin.reference_data
+        plugin.reference_data = MagicMock()
+        self._connections = plugin.connections
+        plugin.connections = MagicMock()
+        plugin.plugins.toolkit.asbool.return_value = warm_up
+        config = {'ckan.baepublisher.warm_up': str(warm_up)}
+
+        try:
+            self.storePublisher.configure(config)
+
+            plugin.reference_data.configure.assert_called_once_with(config)
+            plugin.connections.configure.assert_called_once_with(config)
+            # The categories are only loaded and the connections opened by the web workers
+            self.assertEquals(0, plugin.reference_data.start_refresher.call_count)
+            self.assertEquals(0, plugin.connections.start_prewarmer.call_count)
+
+            app = MagicMock()
+            middleware = self.storePublisher.make_middleware(app, config)
+            middleware({}, None)
+            # Apps wrapped by the plugin share the tasks, so they are only started once
+            self.storePublisher.make_middleware(MagicMock(), config)({}, None)
+            middleware({}, None)
+
+            self.assertEquals(2, app.call_count)
+            plugin.connections.start_prewarmer.assert_called_once_with(
+                [self._store_connector_instance.store_url], 2, 60, self._store_connector_instance.verify_https)
+            if warm_up:
+                plugin.reference_data.start_refresher.assert_called_once_with(
+                    self._store_connector_instance.store_url, self._store_connector_instance._lock_backend)
+            else:
+                self.assertEquals(0, plugin.reference_data.start_refresher.call_count)
+        finally:
+            plugin.reference_data = self._reference_data
+            plugin.connections = self._connections
+
+    def test_configure_without_prewarm(self):
+        self._connections = plugin.connections
+        plugin.connections = MagicMock()
+        plugin.plugins.toolkit.asbool.return_value = False
+
+        try:
+            self.storePublisher.configure({'ckan.baepublisher.prewarm_connections': '0'})
+            self.storePublisher._start_background_tasks()
+
+            self.assertEquals(0, plugin.connections.start_prewarmer.call_count)
+        finally:
+            plugin.connections = self._connections
+
     def test_map(self):
         # Call the method
         m = MagicMock()
         self.storePublisher.before_map(m)
 
         # Test that the connect method has been called
-        m.connect.assert_called_once_with('dataset_publish', '/dataset/publish/{id}', action='publish',
-                                          controller='ckanext.baepublisher.controllers.ui_controller:PublishControllerUI',
-                                          ckan_icon='shopping-cart')
+        controller = 'ckanext.baepublisher.controllers.ui_controller:PublishControllerUI'
+        self.assertEquals([
+            call('dataset_publish', '/dataset/publish/{id}', action='publish', controller=controller, ckan_icon='shopping-cart'),
+            call('baepublisher_reference_data', '/baepublisher/reference_data', action='reference_data', controller=controller),
+            call('baepublisher_reference_data_content', '/baepublisher/reference_data/{content}', action='reference_data',
+                 controller=controller),
+            call('baepublisher_dashboard_offerings', '/dashboard/offerings', action='offerings',
+                 controller='ckanext.baepublisher.controllers.dashboard_controller:DashboardControllerUI',
+                 ckan_icon='shopping-cart'),
+        ], m.connect.call_args_list)
 
     def test_after_delete(self):
         dataset = MagicMock()
@@ -84,3 +150,60 @@ class PluginTest(unittest.TestCase):
         self._store_connector_instance.delete_attached_resources.assert_called_once_with(dataset)
         action.assert_called_once_with(context, dataset_info)
         plugin.plugins.toolkit.get_action.assert_called_once_with('package_show')
+
+    @parameterized.expand([
+        ('example-pkg-id',),
+        ('example-pkg-name',),
+    ])
+    def test_after_delete_captured_dataset(self, pkg_id):
+        entity = MagicMock(id='example-pkg-id', private=True)
+        entity.name = 'example-pkg-name'
+        plugin.plugins.toolkit.get_action = MagicMock()
+
+        # Call the functions in the same order than package_delete
+        context = {'user': MagicMock()}
+        self.storePublisher.delete(entity)
+        self.storePublisher.after_delete(context, {'id': pkg_id})
+
+        # The dataset is not retrieved again
+        self.assertEquals(0, plugin.plugins.toolkit.get_action.call_count)
+        self._store_connector_instance.delete_attached_resources.assert_called_once_with(
+            {'id': 'example-pkg-id', 'name': 'example-pkg-name', 'private': True})
+        self.assertEquals(0, len(self.storePublisher._deleted_datasets))
+
+    @patch('ckanext.baepublisher.cache.time.time')
+    def test_failed_deletions_expire(self, time):
+        entity = MagicMock(id='example-pkg-id', private=True)
+        entity.name = 'example-pkg-name'
+        time.return_value = 1000
+
+        # package_delete failed after calling delete, so after_delete is never called
+        self.storePublisher.delete(entity)
+        self.assertEquals(2, len(self.storePublisher._deleted_datasets))
+
+        time.return_value = 1301
+        self.assertEquals(0, len(self.storePublisher._deleted_datasets))
+
+    def test_after_delete_batched(self):
+        dataset = {'id': 'example-pkg-id'}
+        plugin.plugins.toolkit.get_action = MagicMock(return_value=MagicMock(return_value=dataset))
+        self.storePublisher._deletion_batcher = MagicMock()
+
+        self.storePublisher.after_delete({'user': MagicMock()}, {'id': 'example-pkg-id'})
+
+        self.storePublisher._deletion_batcher.add.assert_called_once_with(dataset)
+        self.assertEquals(0, self._store_connector_instance.delete_attached_resources.call_count)
+
+    def test_after_update(self):
+        pkg_dict = {'id': 'example-pkg-id'}
+
+        self.assertEquals(pkg_dict, self.storePublisher.after_update({}, pkg_dict))
+
+        self._product_sync_instance.schedule.assert_called_once_with('example-pkg-id')
+
+    def test_after_update_sync_disabled(self):
+        self.storePublisher._product_sync = None
+        pkg_dict = {'id': 'example-pkg-id'}
+
+        self.assertEquals(pkg_dict, self.storePublisher.after_update({}, pkg_dict))
+        self.assertEquals(0, self._product_sync_instance.schedule.call_count)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.baepublisher.profiling as profiling
+
+import inspect
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock, patch
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = profiling.Profiler({
+            'ckan.baepublisher.profile_rate': '1',
+            'ckan.baepublisher.profile_dir': self.directory,
+            'ckan.baepublisher.profile_keep': '2',
+        })
+        self._profiler = profiling.PROFILER
+        profiling.PROFILER = self.profiler
+
+    def tearDown(self):
+        profiling.PROFILER = self._profiler
+        shutil.rmtree(self.directory)
+
+    def test_disabled_by_default(self):
+        profiler = profiling.Profiler()
+        self.assertEquals(0, profiler.rate)
+        self.assertFalse(profiler.should_profile())
+
+    def test_signature_is_kept(self):
+        @profiling.profiled('publish')
+        def publish(self, id, offering_info=None):
+            pass
+
+        # Pylons passes the arguments of the actions according to their signature
+        self.assertEquals(['self', 'id', 'offering_info'], inspect.getargspec(publish).args)
+
+    def test_not_sampled(self):
+        self.profiler.rate = 0
+        func = MagicMock(return_value='result')
+        get_metadata = MagicMock()
+
+        self.assertEquals('result', profiling.profiled('publish', get_metadata)(lambda *args: func(*args))(1))
+
+        func.assert_called_once_with(1)
+        self.assertEquals(0, get_metadata.call_count)
+        self.assertEquals([], os.listdir(self.directory))
+
+    def test_profile_written(self):
+        @profiling.profiled('publish', lambda id: {'dataset': id})
+        def publish(id):
+            return id
+
+        self.assertEquals('dataset1', publish('dataset1'))
+
+        files = sorted(os.listdir(self.directory))
+        self.assertEquals(2, len(files))
+        self.assertTrue(files[0].endswith('.json'))
+        self.assertTrue(files[1].endswith('.prof'))
+
+        with open(os.path.join(self.directory, files[0])) as f:
+            metadata = json.load(f)
+        self.assertEquals('publish', metadata['name'])
+        self.assertEquals('dataset1', metadata['dataset'])
+        self.assertIn('duration', metadata)
+
+    def test_profile_written_on_errors(self):
+        @profiling.profiled('after_delete')
+        def after_delete():
+            raise ValueError('failed')
+
+        with self.assertRaises(ValueError):
+            after_delete()
+
+        self.assertEquals(2, len(os.listdir(self.directory)))
+
+    @patch('ckanext.baepublisher.profiling.log')
+    def test_save_errors_do_not_fail(self, log):
+        self.profiler.save = MagicMock(side_effect=IOError('Disk full'))
+
+        self.assertEquals(3, profiling.profiled('publish')(lambda: 3)())
+        self.assertEquals(1, log.warn.call_count)
+
+    def test_rotation(self):
+        func = profiling.profiled('publish')(lambda: None)
+        for _ in range(4):
+            func()
+
+        self.assertEquals(4, len(os.listdir(self.directory)))
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.baepublisher.ratelimit as ratelimit
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock, patch
+from parameterized import parameterized
+
+
+class RateLimitTest(unittest.TestCase):
+
+    @parameterized.expand([
+        # Full bucket
+        (None, (4, 100), 0),
+        # Tokens are refilled with the time
+        ((0, 99), (1, 100), 0),
+        ((0.5, 100), (0.5, 100), 0.25),
+        # The bucket does not exceed its capacity
+        ((5, 0), (4, 100), 0),
+    ])
+    def test_take_token(self, state, expected_state, expected_wait):
+        new_state, wait = ratelimit.take_token(state, 2, 5, 100)
+
+        self.assertEquals(expected_state, new_state)
+        self.assertAlmostEqual(expected_wait, wait)
+
+    @parameterized.expand([
+        ('get', ratelimit.READ),
+        ('GET', ratelimit.READ),
+        ('post', ratelimit.WRITE),
+        ('patch', ratelimit.WRITE),
+        ('delete', ratelimit.WRITE),
+    ])
+    def test_get_kind(self, method, kind):
+        self.assertEquals(kind, ratelimit.RateLimiter.get_kind(method))
+
+    def test_disabled_by_default(self):
+        limiter = ratelimit.RateLimiter({})
+        self.assertIsNone(limiter._backend)
+        limiter.acquire('get')
+
+    @patch.dict('ckanext.baepublisher.ratelimit._BACKENDS', clear=True)
+    def test_backend_shared(self):
+        config = {'ckan.baepublisher.rate_limit_reads': '2', 'ckan.baepublisher.rate_limit_backend': 'redis'}
+
+        backend_class = MagicMock()
+        with patch.dict('ckanext.baepublisher.ratelimit.RATE_LIMIT_BACKENDS', {'redis': backend_class}):
+            first = ratelimit.RateLimiter(config)
+            second = ratelimit.RateLimiter(config)
+
+        # The client of the backend is only created once per process
+        self.assertIs(first._backend, second._backend)
+        backend_class.assert_called_once_with(config)
+
+    @patch('ckanext.baepublisher.ratelimit.time')
+    def test_acquire_waits(self, time):
+        limiter = ratelimit.RateLimiter({'ckan.baepublisher.rate_limit_writes': '2'})
+        limiter._backend = MagicMock()
+        limiter._backend.take.side_effect = [0.5, 0]
+
+        limiter.acquire('post')
+
+        time.sleep.assert_called_once_with(0.5)
+        limiter._backend.take.assert_called_with(ratelimit.WRITE, 2, 2)
+
+    def test_reads_not_limited(self):
+        limiter = ratelimit.RateLimiter({'ckan.baepublisher.rate_limit_writes': '2'})
+        limiter._backend = MagicMock()
+
+        limiter.acquire('get')
+
+        self.assertEquals(0, limiter._backend.take.call_count)
+
+    @parameterized.expand([
+        ('interactive', [ratelimit.READ]),
+        ('background', [ratelimit.READ, ratelimit.BACKGROUND]),
+    ])
+    def test_background_budget(self, priority, buckets):
+        limiter = ratelimit.RateLimiter({
+            'ckan.baepublisher.rate_limit_reads': '4',
+            'ckan.baepublisher.rate_limit_background': '1',
+        })
+        limiter._backend = MagicMock()
+        limiter._backend.take.return_value = 0
+
+        limiter.acquire('get', priority)
+
+        self.assertEquals(buckets, [call[0][0] for call in limiter._backend.take.call_args_list])
+
+    def test_backend_errors_do_not_block(self):
+        limiter = ratelimit.RateLimiter({'ckan.baepublisher.rate_limit_reads': '2'})
+        limiter._backend = MagicMock()
+        limiter._backend.take.side_effect = Exception('Connection refused')
+
+        limiter.acquire('get')
+
+    def test_file_backend(self):
+        directory = tempfile.mkdtemp()
+        try:
+            config = {'ckan.baepublisher.rate_limit_file': os.path.join(directory, 'ratelimit.json')}
+            backend1 = ratelimit.FileBackend(config)
+            backend2 = ratelimit.FileBackend(config)
+
+            # Both backends share the same bucket
+            self.assertEquals(0, backend1.take('read', 0.001, 2))
+            self.assertEquals(0, backend2.take('read', 0.001, 2))
+            self.assertTrue(backend1.take('read', 0.001, 2) > 0)
+        finally:
+            shutil.rmtree(directory)
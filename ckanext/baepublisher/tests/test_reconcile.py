@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+import ckanext.baepublisher.reconcile as reconcile
+
+import unittest
+from datetime import datetime
+
+from mock import MagicMock
+from parameterized import parameterized
+from store_fixtures import make_connector, make_product, STORE_URL
+
+
+def make_package(package_id, state='active', private=False, acquire_url=''):
+    package = MagicMock(id=package_id, state=state, private=private)
+    package.acquire_url = acquire_url
+    return package
+
+
+class ReconcileTest(unittest.TestCase):
+
+    def setUp(self):
+        self._model = reconcile.model
+        reconcile.model = MagicMock()
+
+        self._db = reconcile.db
+        reconcile.db = MagicMock()
+        reconcile.db.State.get.return_value = None
+
+        self.connector = make_connector()
+
+        self.reconciler = reconcile.Reconciler(self.connector, page_size=2, workers=2)
+
+    def tearDown(self):
+        reconcile.model = self._model
+        reconcile.db = self._db
+
+    def _set_packages(self, packages):
+        self.reconciler._get_modified_packages = MagicMock(return_value=packages)
+        acquire_urls = dict((package.id, package.acquire_url) for package in packages if package.acquire_url)
+        self.reconciler._get_acquire_urls = MagicMock(
+            side_effect=lambda ids: dict((i, acquire_urls[i]) for i in ids if i in acquire_urls))
+        states = dict((package.id, package.state) for package in packages)
+        self.reconciler._get_package_states = MagicMock(
+            side_effect=lambda ids: dict((i, states[i]) for i in ids if i in states))
+
+    @parameterized.expand([
+        ('2017-03-14T10:00:00.000Z', datetime(2017, 3, 14, 10, 0, 0)),
+        ('2017-03-14T10:00:00', datetime(2017, 3, 14, 10, 0, 0)),
+        ('', None),
+        (None, None),
+    ])
+    def test_parse_date(self, value, expected):
+        self.assertEquals(expected, reconcile.parse_date(value))
+
+    def test_retire_products_of_deleted_datasets(self):
+        self.connector.get_products.return_value = [
+            make_product('1', 'deleted_dataset'),
+            make_product('2', 'deleted_dataset', status='Retired'),
+            make_product('3', 'active_dataset'),
+            make_product('4', 'purged_dataset'),
+            make_product('5', 'other', status='Launched'),
+        ]
+        self.connector.get_products.return_value[4]['productSpecCharacteristic'] = []
+        self._set_packages([make_package('deleted_dataset', state='deleted'), make_package('active_dataset')])
+
+        summary = self.reconciler.run()
+
+        self.assertEquals(['1', '4'], sorted(summary['retired']))
+        self.assertEquals([], summary['failed'])
+        self.assertEquals(2, self.connector._retire_product.call_count)
+        self.assertEquals(1, reconcile.db.State.set.call_count)
+        self.assertEquals(reconcile.WATERMARK_KEY, reconcile.db.State.set.call_args[0][0])
+
+    def test_failed_products_keep_watermark(self):
+        self.connector.get_products.return_value = [make_product('1', 'deleted_dataset')]
+        self.connector._retire_product.side_effect = Exception('Store error')
+        self._set_packages([make_package('deleted_dataset', state='deleted')])
+
+        summary = self.reconciler.run()
+
+        self.assertEquals(['1'], summary['failed'])
+        self.assertEquals(0, reconcile.db.State.set.call_count)
+
+    def test_unmodified_products_are_skipped(self):
+        reconcile.db.State.get.return_value = '2018-01-01T00:00:00'
+        self.connector.get_products.return_value = [
+            make_product('1', 'purged_dataset', last_update='2017-12-01T00:00:00.000Z'),
+            make_product('2', 'purged_dataset2', last_update='2018-01-02T00:00:00.000Z'),
+        ]
+        self._set_packages([])
+
+        summary = self.reconciler.run()
+
+        self.reconciler._get_modified_packages.assert_called_once_with(datetime(2018, 1, 1))
+        # Only the products updated since the last pass are requested
+        self.connector.get_products.assert_called_once_with(page_size=2, modified_since=datetime(2018, 1, 1))
+        self.assertEquals(['2'], summary['retired'])
+        self.assertEquals(1, summary['products'])
+
+    def test_incremental_pass_requests_the_products_of_modified_datasets(self):
+        reconcile.db.State.get.return_value = '2018-01-01T00:00:00'
+        self.connector.get_products.return_value = []
+        # The store ignores the filter on the Location of the products
+        self.connector.get_paginated.return_value = [
+            make_product('1', 'deleted_dataset', last_update='2017-12-01T00:00:00.000Z'),
+            make_product('2', 'other_dataset', last_update='2017-12-01T00:00:00.000Z'),
+        ]
+        self._set_packages([make_package('deleted_dataset', state='deleted'), make_package('public_dataset')])
+
+        summary = self.reconciler.run()
+
+        # Public datasets do not need any product
+        self.connector.get_paginated.assert_called_once_with(
+            STORE_URL + '/DSProductCatalog/api/catalogManagement/v2/productSpecification/'
+            '?productSpecCharacteristic.productSpecCharacteristicValue.value=https%3A%2F%2Flocalhost%3A8474%2Fdataset%2Fdeleted_dataset', 2)
+        self.connector.get_products.assert_called_once_with(page_size=2, modified_since=datetime(2018, 1, 1))
+        self.assertEquals(['1'], summary['retired'])
+        self.assertEquals(2, summary['datasets'])
+
+    def test_too_many_modified_datasets_list_all_the_products(self):
+        reconcile.db.State.get.return_value = '2018-01-01T00:00:00'
+        self.reconciler = reconcile.Reconciler(self.connector, page_size=2, workers=2, max_lookups=1)
+        self.connector.get_products.return_value = [
+            make_product('1', 'deleted_dataset', last_update='2017-12-01T00:00:00.000Z'),
+            make_product('2', 'deleted_dataset2', last_update='2017-12-01T00:00:00.000Z'),
+            make_product('3', 'active_dataset', last_update='2017-12-01T00:00:00.000Z'),
+        ]
+        self._set_packages([make_package('deleted_dataset', state='deleted'), make_package('deleted_dataset2', state='deleted')])
+
+        summary = self.reconciler.run()
+
+        self.assertEquals(0, self.connector.get_paginated.call_count)
+        self.connector.get_products.assert_called_once_with(page_size=2, modified_since=None)
+        self.assertEquals(['1', '2'], sorted(summary['retired']))
+        # Products not updated since the last pass are not counted as checked
+        self.assertEquals(0, summary['products'])
+
+    def test_full_pass(self):
+        reconcile.db.State.get.return_value = '2018-01-01T00:00:00'
+        self.connector.get_products.return_value = [
+            make_product('1', 'purged_dataset', last_update='2017-12-01T00:00:00.000Z'),
+        ]
+        self._set_packages([])
+
+        summary = self.reconciler.run(full=True)
+
+        self.reconciler._get_modified_packages.assert_called_once_with(None)
+        self.assertEquals(['1'], summary['retired'])
+
+    @parameterized.expand([
+        # The acquire URL points to a retired product, there is an active one
+        ([('1', 'Retired'), ('2', 'Launched')], '1', '%s/#/offering?productSpecId=2' % STORE_URL),
+        # The acquire URL points to a retired product, there are no active ones
+        ([('1', 'Retired')], '1', ''),
+        # The acquire URL points to an active product
+        ([('1', 'Launched')], '1', None),
+    ])
+    def test_repair_acquire_url(self, products, acquire_product, expected_url):
+        self.connector.get_products.return_value = [make_product(i, 'private_dataset', status) for i, status in products]
+        acquire_url = '%s/#/offering?productSpecId=%s' % (STORE_URL, acquire_product)
+        self._set_packages([make_package('private_dataset', private=True, acquire_url=acquire_url)])
+
+        summary = self.reconciler.run()
+
+        if expected_url is None:
+            self.assertEquals([], summary['repaired'])
+            self.assertEquals(0, self.connector._save_acquire_url.call_count)
+        else:
+            self.assertEquals(['private_dataset'], summary['repaired'])
+            self.connector._save_acquire_url.assert_called_once_with('private_dataset', expected_url)
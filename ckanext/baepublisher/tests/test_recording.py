@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.baepublisher.recording as recording
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock, patch
+from parameterized import parameterized
+
+
+class RecordingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cassette.jsonl')
+        self._transport = recording.TRANSPORT
+
+    def tearDown(self):
+        recording.TRANSPORT = self._transport
+        shutil.rmtree(self.directory)
+
+    def _response(self, status_code, content, headers=None):
+        response = MagicMock(status_code=status_code, content=content)
+        response.headers = headers or {}
+        return response
+
+    def test_scrub(self):
+        data = {
+            'name': 'dataset',
+            'access_token': 'secret',
+            'content': {'contentType': 'image/png', 'data': 'iVBORw0KGgo='},
+            'relatedParty': [{'id': 'user', 'password': 'secret'}],
+        }
+
+        self.assertEquals({
+            'name': 'dataset',
+            'access_token': 'SCRUBBED',
+            'content': {'contentType': 'image/png', 'data': 'AAAAAAAAAAAA'},
+            'relatedParty': [{'id': 'user', 'password': 'SCRUBBED'}],
+        }, recording.scrub(data))
+
+    def test_scrub_headers(self):
+        self.assertEquals({'Authorization': 'SCRUBBED', 'Accept': 'application/json'},
+                          recording.scrub_headers({'Authorization': 'Bearer token', 'Accept': 'application/json'}))
+
+    def test_wrap_disabled(self):
+        recording.TRANSPORT = None
+        send = MagicMock()
+        self.assertIs(send, recording.wrap('get', send))
+
+    @parameterized.expand([
+        ('', type(None)),
+        ('record', recording.Recorder),
+    ])
+    def test_configure(self, mode, transport_class):
+        recording.configure({'ckan.baepublisher.http_mode': mode, 'ckan.baepublisher.http_cassette': self.path})
+        self.assertIsInstance(recording.TRANSPORT, transport_class)
+
+    def test_configure_invalid_mode(self):
+        with self.assertRaises(ValueError):
+            recording.configure({'ckan.baepublisher.http_mode': 'rewind'})
+
+    @patch('ckanext.baepublisher.recording.time')
+    def test_record_and_replay(self, time):
+        time.time.side_effect = [10, 10.5, 20, 20.25]
+        url = 'http://store.com/DSProductCatalog/api/catalogManagement/v2/category'
+        send = MagicMock(side_effect=[
+            self._response(200, b'[{"id": "1"}]', {'ETag': '"1"'}),
+            self._response(404, b'not found'),
+        ])
+
+        recording.TRANSPORT = recording.Recorder(self.path)
+        headers = {'Authorization': 'Bearer token'}
+        self.assertEquals(200, recording.wrap('get', send)(url, params={'lifecycleStatus': 'Launched'}, headers=headers).status_code)
+        self.assertEquals(404, recording.wrap('get', send)(url + '/2', headers=headers).status_code)
+
+        with open(self.path) as f:
+            entries = [json.loads(line) for line in f]
+        self.assertEquals('GET %s?lifecycleStatus=Launched' % url, entries[0]['key'])
+        self.assertEquals({'Authorization': 'SCRUBBED'}, entries[0]['request']['headers'])
+        self.assertEquals(0.5, entries[0]['elapsed'])
+
+        # The store is not contacted when replaying
+        send.reset_mock()
+        recording.TRANSPORT = recording.Player(self.path, 2)
+
+        response = recording.wrap('get', send)(url, params={'lifecycleStatus': 'Launched'})
+        self.assertEquals(200, response.status_code)
+        self.assertEquals([{'id': '1'}], response.json())
+        self.assertEquals('"1"', response.headers['etag'])
+        time.sleep.assert_called_once_with(1.0)
+
+        response = recording.wrap('get', send)(url + '/2')
+        self.assertEquals('not found', response.text)
+        self.assertFalse(response.ok)
+        self.assertEquals(0, send.call_count)
+
+    def test_replay_order(self):
+        with open(self.path, 'w') as f:
+            for status_code in (201, 200):
+                f.write(json.dumps({
+                    'key': 'POST http://store.com/offering',
+                    'response': {'status_code': status_code, 'headers': {}, 'body': {}, 'encoding': 'json'},
+                    'elapsed': 0.1,
+                }) + '\n')
+
+        recording.TRANSPORT = recording.Player(self.path, 0)
+        send = recording.wrap('post', MagicMock())
+
+        # The last response is repeated
+        self.assertEquals([201, 200, 200], [send('http://store.com/offering').status_code for _ in range(3)])
+
+        with self.assertRaises(recording.ReplayError):
+            send('http://store.com/product')
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.baepublisher.scheduling as scheduling
+
+import threading
+import time
+import unittest
+
+from parameterized import parameterized
+
+
+class SchedulingTest(unittest.TestCase):
+
+    def test_priority_context(self):
+        self.assertEquals(scheduling.BACKGROUND, scheduling.current_priority())
+
+        with scheduling.priority(scheduling.INTERACTIVE):
+            self.assertEquals(scheduling.INTERACTIVE, scheduling.current_priority())
+
+        self.assertEquals(scheduling.BACKGROUND, scheduling.current_priority())
+
+    def test_priority_is_per_thread(self):
+        priorities = []
+
+        with scheduling.priority(scheduling.INTERACTIVE):
+            thread = threading.Thread(target=lambda: priorities.append(scheduling.current_priority()))
+            thread.start()
+            thread.join()
+
+        self.assertEquals([scheduling.BACKGROUND], priorities)
+
+    def test_disabled(self):
+        scheduler = scheduling.Scheduler(0)
+
+        with scheduler.slot(), scheduler.slot():
+            pass
+
+        self.assertFalse(scheduler.acquire(scheduling.INTERACTIVE))
+
+    @parameterized.expand([
+        # Interactive requests are served first
+        (10, 1, ['interactive'] * 4 + ['background'] * 4, ['interactive'] * 4 + ['background'] * 4),
+        # Background requests get their share of the slots
+        (2, 1, ['interactive'] * 4 + ['background'] * 2, ['interactive', 'interactive', 'background'] * 2),
+    ])
+    def test_weighted_fair_queuing(self, interactive_weight, background_weight, arrivals, expected):
+        scheduler = scheduling.Scheduler(1, {
+            scheduling.INTERACTIVE: interactive_weight,
+            scheduling.BACKGROUND: background_weight,
+        })
+        served = []
+
+        def request(priority):
+            with scheduler.slot(priority):
+                served.append(priority)
+
+        # Keep the only slot busy until all the requests are waiting
+        scheduler._free = 0
+        threads = []
+        for priority in arrivals:
+            thread = threading.Thread(target=request, args=(priority,))
+            thread.start()
+            threads.append(thread)
+
+        while sum(len(queue) for queue in scheduler._queues.values()) < len(arrivals):
+            time.sleep(0.01)
+
+        scheduler.release()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(expected, served)
+
+    def test_configure(self):
+        scheduling.configure({
+            'ckan.baepublisher.scheduler_slots': '4',
+            'ckan.baepublisher.scheduler_background_weight': '2',
+        })
+        try:
+            self.assertEquals(4, scheduling.SCHEDULER.slots)
+            self.assertEquals({scheduling.INTERACTIVE: 10, scheduling.BACKGROUND: 2}, scheduling.SCHEDULER.weights)
+        finally:
+            scheduling.configure({})
@@ -23,9 +23,10 @@ import ckanext.baepublisher.store_connector as store_connector
 
 import unittest
 import requests
+from datetime import datetime, timedelta
 from decimal import Decimal
 
-from mock import call, MagicMock, patch
+from mock import ANY, call, MagicMock, patch
 from parameterized import parameterized
 
 # Need to be defined here, since it will be used as tests parameter
@@ -76,9 +77,23 @@ class StoreConnectorTest(unittest.TestCase):
 
         self._OAuth2Session = store_connector.OAuth2Session
 
+        self._jobs = store_connector.jobs
+        store_connector.jobs = MagicMock()
+
+        self._SQLAlchemySession = store_connector.SQLAlchemySession
+        store_connector.SQLAlchemySession = MagicMock()
+
+        store_connector.LISTING_VALIDATORS.clear()
+
+        self._db = store_connector.db
+        store_connector.db = MagicMock()
+        store_connector.db.PublishRecord.by_key.return_value = None
+        store_connector.db.PublishCheckpoint.by_key.return_value = None
+
         self.config = {
             'ckan.site_url': BASE_SITE_URL,
             'ckan.baepublisher.store_url': BASE_STORE_URL,
+            'ckan.baepublisher.lock_backend': 'local',
         }
 
         self.instance = store_connector.StoreConnector(self.config)
@@ -94,6 +109,9 @@ class StoreConnectorTest(unittest.TestCase):
         store_connector.plugins.toolkit = self._toolkit
         store_connector.OAuth2Session = self._OAuth2Session
         store_connector.model = self._model
+        store_connector.db = self._db
+        store_connector.jobs = self._jobs
+        store_connector.SQLAlchemySession = self._SQLAlchemySession
 
         # Restore controller functions
         self.instance._make_request = self._make_request
@@ -309,6 +327,32 @@ class StoreConnectorTest(unittest.TestCase):
                 # Check response
                 self.assertEquals(second_response, result)
 
+    @patch('ckanext.baepublisher.store_connector.tracing.EXPORTER')
+    def test_make_request_traced(self, exporter):
+        store_connector.plugins.toolkit.c.usertoken = {'access_token': 'access_token'}
+
+        response = MagicMock(status_code=200, content='{"id": 1}')
+        request = MagicMock()
+        request.patch.return_value = response
+        store_connector.OAuth2Session = MagicMock(return_value=request)
+
+        self.instance._make_request('patch', BASE_STORE_URL + '/DSProductCatalog/api/catalogManagement/v2/productSpecification/12:(0.1)', {}, {'a': 1})
+
+        span = exporter.export.call_args[0][0]
+        self.assertEquals('store PATCH', span.name)
+        self.assertEquals({
+            'http.method': 'PATCH',
+            'http.route': '/DSProductCatalog/api/catalogManagement/v2/productSpecification/{id}',
+            'http.status_code': 200,
+            'http.request_size': 8,
+            'http.response_size': 9,
+            'retries': 0,
+        }, span.attributes)
+
+        # The trace context is sent to the store
+        headers = request.patch.call_args[1]['headers']
+        self.assertEquals(span.traceparent(), headers['traceparent'])
+
     def test_make_request_exception(self):
         method = 'get'
         url = 'http://example.com'
@@ -351,9 +395,13 @@ class StoreConnectorTest(unittest.TestCase):
         c.user = resource_provider
         package_update = MagicMock()
         store_connector.plugins.toolkit.get_action = MagicMock(return_value=package_update)
+        session = store_connector.model.meta.create_local_session.return_value
+        package = session.query.return_value.get.return_value
+        package.extras = {}
 
         # Call the method
         dataset = {
+            'id': 'dataset_id',
             'private': private,
             'acquire_url': acquire_url
         }
@@ -363,21 +411,40 @@ class StoreConnectorTest(unittest.TestCase):
             'provider': resource_provider,
             'id': 'example_id'
         }
-        expected_dataset = dataset.copy()
-#        new_name = resource['name'].replace(' ', '%20')
-        expected_dataset['acquire_url'] = '%s/#/offering?productSpecId=%s' % (BASE_STORE_URL, resource['id'])
+        expected_acquire_url = '%s/#/offering?productSpecId=%s' % (BASE_STORE_URL, resource['id'])
 
         # Update Acquire URL
         self.instance._update_acquire_url(dataset, resource)
 
+        # The full package_update action is never used
+        self.assertEquals(0, package_update.call_count)
+
         # Check that the acquire URL has been updated
         if should_update:
-            context = {'model': store_connector.model, 'session': store_connector.model.Session,
-                       'user': c.user or c.author, 'auth_user_obj': c.userobj,
-                       }
-            package_update.assert_called_once_with(context, expected_dataset)
+            self.assertEquals(expected_acquire_url, dataset['acquire_url'])
+            # The extra is written in a separate session, with its own revision
+            session.query.assert_called_once_with(store_connector.model.Package)
+            session.query.return_value.get.assert_called_once_with('dataset_id')
+            store_connector.SQLAlchemySession.set_revision.assert_called_once_with(
+                session, store_connector.model.Revision.return_value)
+            self.assertEquals({'acquire_url': expected_acquire_url}, package.extras)
+            session.commit.assert_called_once_with()
+            session.close.assert_called_once_with()
+            self.assertEquals(0, store_connector.model.repo.commit.call_count)
+            store_connector.jobs.enqueue_reindex.assert_called_once_with('dataset_id', self.instance.async_reindex)
         else:
-            self.assertEquals(0, package_update.call_count)
+            self.assertEquals(0, session.commit.call_count)
+            self.assertEquals(0, store_connector.jobs.enqueue_reindex.call_count)
+
+    def test_save_acquire_url_missing_dataset(self):
+        session = store_connector.model.meta.create_local_session.return_value
+        session.query.return_value.get.return_value = None
+
+        self.instance._save_acquire_url('dataset_id', 'https://store/#/offering?productSpecId=1')
+
+        self.assertEquals(0, session.commit.call_count)
+        session.close.assert_called_once_with()
+        self.assertEquals(0, store_connector.jobs.enqueue_reindex.call_count)
 
     @parameterized.expand([
         ([], None),
@@ -504,6 +571,25 @@ class StoreConnectorTest(unittest.TestCase):
             self.instance._update_acquire_url.assert_called_once_with(
                 dataset, current_user_resources[id_correct_resource])
 
+    def test_get_existing_products_skips_inactive(self):
+        def make_product(product_id, status):
+            return {
+                'id': product_id,
+                'lifecycleStatus': status,
+                'productSpecCharacteristic': [{
+                    'name': 'Location',
+                    'productSpecCharacteristicValue': [{'value': '{}/dataset/{}'.format(BASE_SITE_URL, DATASET['id'])}]
+                }]
+            }
+
+        self.instance._get_user = MagicMock(return_value='user')
+        self.instance._get_json = MagicMock(return_value=[
+            make_product('1', 'Retired'), make_product('2', 'Obsolete'), make_product('3', 'Launched')])
+
+        products = self.instance._get_existing_products(DATASET)
+
+        self.assertEquals(['3'], [product['id'] for product in products])
+
     @parameterized.expand([
         ('basic', {'Location': 'EXAMPLEURL', 'success': True}),
         ('role', {'Location': 'EXAMPLEURL', 'success': True}, 'customer'),
@@ -739,7 +825,7 @@ class StoreConnectorTest(unittest.TestCase):
             self.instance._get_existing_product.assert_called_once_with(DATASET)
             if not resource_exists:
                 self.instance._create_product.assert_called_once_with(
-                    DATASET, OFFERING_INFO_BASE)
+                    DATASET, OFFERING_INFO_BASE, ANY)
             self.instance._get_offering.assert_called_once_with(OFFERING_INFO_BASE, resource)
 
             def check_make_request_calls(call, method, url, headers, data):
@@ -814,3 +900,316 @@ class StoreConnectorTest(unittest.TestCase):
 
         self.instance._get_existing_products.assert_called_once_with('dataset')
         self.assertEquals(0, self.instance._make_request.call_count)
+
+    def test_delete_resources_batch(self):
+        datasets = [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]
+
+        def _product(id_, dataset_id):
+            return {'id': id_, 'productSpecCharacteristic': [{
+                'name': 'Location',
+                'productSpecCharacteristicValue': [{'value': self.instance._get_dataset_url({'id': dataset_id})}]
+            }]}
+
+        products = [_product('1', 'a'), _product('2', 'a'), _product('3', 'b'), _product('4', 'other')]
+        self.instance._get_json = MagicMock(return_value=products)
+
+        def _retire_product(product):
+            if product['id'] == '3':
+                raise Exception('Error')
+
+        self.instance._retire_product = MagicMock(side_effect=_retire_product)
+        self.instance._forget_published_offerings = MagicMock()
+        store_connector.plugins.toolkit.c.user = 'user'
+
+        failed = self.instance.delete_attached_resources_batch(datasets, 2)
+
+        # The products of the user are requested only once
+        self.instance._get_json.assert_called_once_with(
+            'https://store.example.com:7458/DSProductCatalog/api/catalogManagement/v2/productSpecification/?relatedParty.id=user')
+        self.assertEquals(['1', '3'], sorted(c[0][0]['id'] for c in self.instance._retire_product.call_args_list))
+        self.assertEquals(['b'], failed)
+        self.assertEquals(datasets, [c[0][0] for c in self.instance._forget_published_offerings.call_args_list])
+
+    def test_delete_resources_batch_products_not_loaded(self):
+        self.instance._get_json = MagicMock(side_effect=Exception('Store down'))
+        self.instance._retire_product = MagicMock()
+
+        self.assertEquals(['a', 'b'], self.instance.delete_attached_resources_batch([{'id': 'a'}, {'id': 'b'}]))
+        self.assertEquals(0, self.instance._retire_product.call_count)
+
+    def test_idempotency_key(self):
+        offering_info = OFFERING_INFO_BASE.copy()
+        key = self.instance._get_idempotency_key(DATASET, offering_info)
+
+        # The same attempt generates the same key
+        self.assertEquals(key, self.instance._get_idempotency_key(DATASET.copy(), OFFERING_INFO_BASE.copy()))
+
+        # A different catalog or version generates a different key
+        offering_info['catalog'] = 'catalog2'
+        self.assertNotEquals(key, self.instance._get_idempotency_key(DATASET, offering_info))
+
+        offering_info = OFFERING_INFO_BASE.copy()
+        offering_info['version'] = '1.8'
+        self.assertNotEquals(key, self.instance._get_idempotency_key(DATASET, offering_info))
+
+    def test_for_store(self):
+        connector = self.instance.for_store('http://store.example.org/')
+
+        self.assertEquals('http://store.example.org', connector.store_url)
+        self.assertFalse(connector.primary)
+        self.assertTrue(self.instance.primary)
+        self.assertEquals('http://store.example.org:', connector._rate_limiter.scope)
+        self.assertEquals('', self.instance._rate_limiter.scope)
+
+        # Publications in different stores do not share records and locks
+        self.assertNotEquals(self.instance._get_idempotency_key(DATASET, OFFERING_INFO_BASE),
+                             connector._get_idempotency_key(DATASET, OFFERING_INFO_BASE))
+        self.assertNotEquals(self.instance._get_lock_name(DATASET), connector._get_lock_name(DATASET))
+
+    def test_update_acquire_url_other_store(self):
+        connector = self.instance.for_store('http://store.example.org')
+        connector._save_acquire_url = MagicMock()
+
+        connector._update_acquire_url({'id': 'dataset', 'private': True}, {'id': 'product'})
+
+        self.assertEquals(0, connector._save_acquire_url.call_count)
+
+    def test_create_offering_already_published(self):
+        offering_url = 'https://store.example.com:7458/DSProductCatalog/api/catalogManagement/v2/productOffering/1'
+        store_connector.db.PublishRecord.by_key.return_value = MagicMock(offering_url=offering_url)
+        self.instance._get_existing_product = MagicMock()
+        self.instance._make_request = MagicMock()
+
+        self.assertEquals(offering_url, self.instance.create_offering(DATASET, OFFERING_INFO_BASE))
+
+        store_connector.db.PublishRecord.by_key.assert_called_once_with(
+            self.instance._get_idempotency_key(DATASET, OFFERING_INFO_BASE))
+        self.assertEquals(0, self.instance._get_existing_product.call_count)
+        self.assertEquals(0, self.instance._make_request.call_count)
+
+    def test_create_offering_records_result(self):
+        resource = {'id': 'resource_id'}
+        self.instance._get_existing_product = MagicMock(return_value=resource)
+        self.instance._get_offering = MagicMock()
+        self.instance._make_request = MagicMock()
+        self.instance._make_request.return_value.url = 'http://offering.url'
+
+        self.assertEquals('http://offering.url', self.instance.create_offering(DATASET, OFFERING_INFO_BASE))
+
+        record = store_connector.db.PublishRecord.return_value
+        self.assertEquals(self.instance._get_idempotency_key(DATASET, OFFERING_INFO_BASE), record.idempotency_key)
+        self.assertEquals(DATASET['id'], record.package_id)
+        self.assertEquals(OFFERING_INFO_BASE['catalog'], record.catalog)
+        self.assertEquals(OFFERING_INFO_BASE['version'], record.version)
+        self.assertEquals('http://offering.url', record.offering_url)
+        store_connector.model.Session.add.assert_called_once_with(record)
+        store_connector.model.Session.commit.assert_called_once_with()
+
+    def _checkpoint(self, steps, age=0):
+        checkpoint = MagicMock(modified=datetime.utcnow() - timedelta(seconds=age))
+        checkpoint.get_steps.return_value = steps
+        store_connector.db.PublishCheckpoint.by_key.return_value = checkpoint
+        return checkpoint
+
+    def test_create_offering_resumed(self):
+        resource = {'id': 'resource_id', 'href': 'resource_href', 'name': 'resource', 'version': '1.0'}
+        self._checkpoint({'image': 'http://image.url', 'product': resource, 'acquire_url': True})
+        self.instance._get_existing_product = MagicMock()
+        self.instance._create_product = MagicMock()
+        self.instance._get_offering = MagicMock(return_value={'offering': 1})
+        self.instance._make_request = MagicMock()
+        self.instance._make_request.return_value.url = 'http://offering.url'
+
+        self.assertEquals('http://offering.url', self.instance.create_offering(DATASET, OFFERING_INFO_BASE))
+
+        # Only the offering is created
+        self.assertEquals(0, self.instance._get_existing_product.call_count)
+        self.assertEquals(0, self.instance._create_product.call_count)
+        self.instance._get_offering.assert_called_once_with(OFFERING_INFO_BASE, resource)
+        self.assertEquals(1, self.instance._make_request.call_count)
+
+        # The finished publication is not resumed again
+        store_connector.db.PublishCheckpoint.delete_by_key.assert_called_once_with(
+            self.instance._get_idempotency_key(DATASET, OFFERING_INFO_BASE))
+
+    def test_create_offering_resumed_with_offering(self):
+        self._checkpoint({'product': {'id': 'resource_id'}, 'acquire_url': True, 'offering': 'http://offering.url'})
+        self.instance._make_request = MagicMock()
+
+        self.assertEquals('http://offering.url', self.instance.create_offering(DATASET, OFFERING_INFO_BASE))
+        self.assertEquals(0, self.instance._make_request.call_count)
+
+    def test_create_offering_saves_progress(self):
+        checkpoint = self._checkpoint({}, age=86401)
+        resource = {'id': 'resource_id'}
+        self.instance._create_product = MagicMock(return_value=resource)
+        self.instance._get_existing_product = MagicMock(return_value=resource)
+        self.instance._get_offering = MagicMock()
+        self.instance._make_request = MagicMock(side_effect=Exception('Connection reset'))
+
+        with self.assertRaises(store_connector.StoreException):
+            self.instance.create_offering(DATASET, OFFERING_INFO_BASE)
+
+        # The old checkpoint is discarded and the completed steps are saved
+        self.assertEquals('{}', checkpoint.steps)
+        self.assertEquals([call('product', resource), call('acquire_url', True)], checkpoint.complete.call_args_list)
+
+    def test_create_product_saves_progress(self):
+        self.instance._upload_image = MagicMock(return_value='http://image.url')
+        self.instance._make_request = MagicMock()
+        self.instance._make_request.return_value.json.return_value = {'id': 'product_id', 'href': 'product_href'}
+        self.instance._update_acquire_url = MagicMock()
+        content_info = dict(OFFERING_INFO_BASE, role='', license_title='', license_description='')
+        progress = store_connector.PublishProgress()
+
+        self.instance._create_product(DATASET, content_info, progress)
+
+        self.assertEquals({
+            'image': 'http://image.url',
+            'product': {'id': 'product_id', 'href': 'product_href', 'name': None, 'version': None},
+            'acquire_url': True,
+        }, progress.steps)
+
+        # A new attempt reuses the image and the asset
+        self.instance._upload_image.reset_mock()
+        self.instance._make_request.reset_mock()
+        content_info['role'] = 'consumer'
+        self.instance._get_product(DATASET, content_info, store_connector.PublishProgress(steps={'image': 'http://image.url', 'asset': True}))
+
+        self.assertEquals(0, self.instance._upload_image.call_count)
+        self.assertEquals(0, self.instance._make_request.call_count)
+
+    def test_delete_resources_forgets_published_offerings(self):
+        self.instance._make_request = MagicMock()
+        self.instance._get_existing_products = MagicMock(return_value=[])
+
+        self.instance.delete_attached_resources({'id': 'example_id'})
+
+        store_connector.db.PublishRecord.delete_by_package.assert_called_once_with('example_id')
+        store_connector.model.Session.commit.assert_called_once_with()
+
+    def test_create_offering_locked(self):
+        self.instance._create_offering = MagicMock(return_value='http://offering.url')
+        self.instance._lock_backend = MagicMock()
+
+        self.assertEquals('http://offering.url', self.instance.create_offering(DATASET, OFFERING_INFO_BASE))
+
+        self.instance._lock_backend.hold.assert_called_once_with('baepublisher-publish-%s' % DATASET['id'], 30)
+        self.instance._create_offering.assert_called_once_with(DATASET, OFFERING_INFO_BASE)
+
+    def test_create_offering_lock_timeout(self):
+        self.instance._create_offering = MagicMock()
+        self.instance._lock_backend = MagicMock()
+        self.instance._lock_backend.hold.side_effect = store_connector.LockTimeout('Timeout')
+
+        with self.assertRaises(store_connector.StoreException):
+            self.instance.create_offering(DATASET, OFFERING_INFO_BASE)
+
+        self.assertEquals(0, self.instance._create_offering.call_count)
+
+    def test_bind(self):
+        token = {'access_token': 'token'}
+        new_token = {'access_token': 'new_token'}
+        refresh = MagicMock(return_value=new_token)
+
+        connector = self.instance.bind('user', token, refresh)
+
+        self.assertIsNot(self.instance, connector)
+        self.assertEquals('user', connector._get_user())
+        self.assertEquals(token, connector._get_token())
+        self.assertTrue(connector._refresh_token())
+        self.assertEquals(new_token, connector._get_token())
+
+        # The original connector still uses the user of the request
+        self.assertEquals(store_connector.plugins.toolkit.c.user, self.instance._get_user())
+
+    def test_bind_service(self):
+        self.instance.service_user = 'service'
+        self.instance.service_token = 'service_token'
+
+        connector = self.instance.bind_service()
+
+        self.assertEquals('service', connector._get_user())
+        self.assertEquals({'token_type': 'Bearer', 'access_token': 'service_token'}, connector._get_token())
+        # Service tokens cannot be refreshed
+        self.assertFalse(connector._refresh_token())
+
+    def test_bind_service_not_configured(self):
+        with self.assertRaises(store_connector.StoreException):
+            self.instance.bind_service()
+
+    @parameterized.expand([
+        ({}, ''),
+        ({'owner': 'user'}, '?relatedParty.id=user'),
+        ({'modified_since': datetime(2018, 1, 2, 10, 0, 0)}, '?lastUpdate.gt=2018-01-02T10:00:00.000Z'),
+        ({'owner': 'user', 'modified_since': datetime(2018, 1, 2)}, '?relatedParty.id=user&lastUpdate.gt=2018-01-02T00:00:00.000Z'),
+    ])
+    def test_get_products(self, kwargs, query):
+        self.instance.get_paginated = MagicMock(return_value=iter([]))
+
+        self.instance.get_products(page_size=2, **kwargs)
+
+        self.instance.get_paginated.assert_called_once_with(
+            '%s/DSProductCatalog/api/catalogManagement/v2/productSpecification/%s' % (BASE_STORE_URL, query), 2)
+
+    @parameterized.expand([
+        ('http://example.com/list', [], ['http://example.com/list?offset=0&size=2']),
+        ('http://example.com/list?a=b', [[1, 2], [3]], ['http://example.com/list?a=b&offset=0&size=2', 'http://example.com/list?a=b&offset=2&size=2']),
+        ('http://example.com/list', [[1, 2], [3, 4], []], ['http://example.com/list?offset=0&size=2', 'http://example.com/list?offset=2&size=2', 'http://example.com/list?offset=4&size=2']),
+    ])
+    def test_get_paginated(self, url, pages, expected_urls):
+        responses = [MagicMock(**{'json.return_value': page}) for page in (pages or [[]])]
+        self.instance._make_request = MagicMock(side_effect=responses)
+
+        elements = list(self.instance.get_paginated(url, page_size=2))
+
+        self.assertEquals([element for page in pages for element in page], elements)
+        self.assertEquals([call('get', expected_url) for expected_url in expected_urls], self.instance._make_request.call_args_list)
+
+    @parameterized.expand([
+        ({}, 200, False),
+        ({'ETag': '"v1"'}, 200, True),
+        ({'Last-Modified': 'Mon, 01 Jan 2018 00:00:00 GMT'}, 304, True),
+    ])
+    def test_get_json_conditional(self, validators, second_status, conditional):
+        url = 'http://example.com/list'
+        store_connector.plugins.toolkit.c.user = 'user'
+        first_response = MagicMock(status_code=200, headers=validators)
+        first_response.json.return_value = [{'id': '1'}]
+        second_response = MagicMock(status_code=second_status, headers=validators)
+        second_response.json.return_value = [{'id': '2'}]
+        self.instance._make_request = MagicMock(side_effect=[first_response, second_response])
+
+        self.assertEquals([{'id': '1'}], self.instance._get_json(url))
+        result = self.instance._get_json(url)
+
+        if conditional:
+            expected_headers = {}
+            if 'ETag' in validators:
+                expected_headers['If-None-Match'] = validators['ETag']
+            if 'Last-Modified' in validators:
+                expected_headers['If-Modified-Since'] = validators['Last-Modified']
+            self.assertEquals(call('get', url, expected_headers), self.instance._make_request.call_args_list[1])
+        else:
+            self.assertEquals(call('get', url), self.instance._make_request.call_args_list[1])
+
+        # A 304 response reuses the parsed body
+        self.assertEquals([{'id': '1'}] if second_status == 304 else [{'id': '2'}], result)
+
+    def test_make_request_compressed(self):
+        store_connector.plugins.toolkit.c.usertoken = {'access_token': 'token'}
+        self.instance._compression = MagicMock()
+        self.instance._compression.encode.return_value = b'compressed'
+        response = MagicMock(status_code=201, headers={})
+        request = MagicMock()
+        request.post.return_value = response
+        store_connector.OAuth2Session = MagicMock(return_value=request)
+
+        self.assertEquals(response, self.instance._make_request('post', 'http://example.com', {'Content-Type': 'application/json'}, {'a': 'b'}))
+
+        self.instance._compression.encode.assert_called_once_with('http://example.com', {'a': 'b'})
+        request.post.assert_called_once_with('http://example.com', headers={
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+            'Content-Encoding': 'gzip'
+        }, data=b'compressed', verify=True)
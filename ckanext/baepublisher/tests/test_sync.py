@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+import ckanext.baepublisher.sync as sync
+
+import json
+import threading
+import unittest
+
+from mock import call, MagicMock, patch
+from parameterized import parameterized
+
+LICENSE = {
+    'name': 'License',
+    'description': 'Attribution required',
+    'productSpecCharacteristicValue': [{'value': 'cc-by'}]
+}
+LOCATION = {
+    'name': 'Location',
+    'productSpecCharacteristicValue': [{'value': 'https://localhost/dataset/example_id'}]
+}
+
+DATASET = {
+    'id': 'example_id',
+    'title': 'Dataset A',
+    'notes': 'Description',
+    'version': '1.0',
+    'license_title': 'cc-by',
+}
+
+
+class DebouncerTest(unittest.TestCase):
+
+    def test_calls_are_coalesced(self):
+        callback = MagicMock()
+        finished = threading.Event()
+        callback.side_effect = lambda key, value: finished.set()
+        debouncer = sync.Debouncer(0.05, callback)
+
+        debouncer.schedule('dataset', 1)
+        debouncer.schedule('dataset', 2)
+        debouncer.schedule('dataset', 3)
+
+        self.assertTrue(finished.wait(5))
+        callback.assert_called_once_with('dataset', 3)
+        self.assertEquals([], debouncer.pending())
+
+    @patch('ckanext.baepublisher.sync.threading.Timer')
+    def test_superseded_timer_is_ignored(self, Timer):
+        callback = MagicMock()
+        debouncer = sync.Debouncer(10, callback)
+
+        debouncer.schedule('dataset', 1)
+        Timer.return_value.cancel.assert_not_called()
+        debouncer.schedule('dataset', 2)
+        Timer.return_value.cancel.assert_called_once_with()
+
+        # A cancelled timer that fires anyway does not call the callback
+        debouncer._fire('dataset', 1)
+        self.assertEquals(0, callback.call_count)
+        self.assertEquals(['dataset'], debouncer.pending())
+        self.assertTrue(Timer.return_value.daemon)
+
+    def test_flush(self):
+        callback = MagicMock()
+        debouncer = sync.Debouncer(10, callback)
+        debouncer.schedule('dataset', 1)
+        debouncer.schedule('dataset', 2)
+        debouncer.schedule('other', 3)
+
+        debouncer.flush()
+
+        self.assertEquals(2, callback.call_count)
+        callback.assert_has_calls([call('dataset', 2), call('other', 3)], any_order=True)
+        self.assertEquals([], debouncer.pending())
+
+
+class ProductSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self._model = sync.model
+        sync.model = MagicMock()
+
+        self._db = sync.db
+        sync.db = MagicMock()
+
+        self._toolkit = sync.plugins.toolkit
+        sync.plugins.toolkit = MagicMock()
+        self.package_show = sync.plugins.toolkit.get_action.return_value
+        self.package_show.return_value = DATASET.copy()
+
+        self.connector = MagicMock()
+        self.connector.validate_version.side_effect = lambda version: version
+        self.connector._get_license_characteristic.side_effect = lambda title, description: \
+            {'name': 'License', 'description': description, 'productSpecCharacteristicValue': [{'value': title}]}
+        self.connector.service_user = 'service'
+
+        self.product_sync = sync.ProductSync(self.connector, 30)
+        self.product_sync._debouncer = MagicMock()
+
+    def tearDown(self):
+        sync.model = self._model
+        sync.db = self._db
+        sync.plugins.toolkit = self._toolkit
+
+    def _set_state(self, **spec):
+        last_spec = {
+            'name': DATASET['title'],
+            'description': DATASET['notes'],
+            'version': DATASET['version'],
+            'productSpecCharacteristic': [LOCATION, LICENSE],
+        }
+        last_spec.update(spec)
+        state = sync.db.ProductSync.by_package.return_value
+        state.product_href = 'http://store/product/1'
+        state.spec = json.dumps(last_spec)
+        return state
+
+    @parameterized.expand([
+        (True, None, True),
+        (False, MagicMock(), True),
+        (False, None, False),
+    ])
+    def test_schedule(self, published, state, scheduled):
+        sync.db.PublishRecord.is_published.return_value = published
+        sync.db.ProductSync.by_package.return_value = state
+        sync.plugins.toolkit.c.user = 'user'
+        sync.plugins.toolkit.c.usertoken = {'access_token': 'token'}
+
+        self.product_sync.schedule('example_id')
+
+        if scheduled:
+            self.connector.bind.assert_called_once_with('user', {'access_token': 'token'})
+            self.product_sync._debouncer.schedule.assert_called_once_with('example_id', self.connector.bind.return_value)
+        else:
+            self.assertEquals(0, self.product_sync._debouncer.schedule.call_count)
+
+    def test_schedule_without_user_uses_service(self):
+        sync.plugins.toolkit.c.usertoken = None
+
+        self.product_sync.schedule('example_id')
+
+        self.product_sync._debouncer.schedule.assert_called_once_with('example_id', self.connector.bind_service.return_value)
+
+    def test_sync_without_changes(self):
+        self._set_state()
+
+        self.assertEquals({}, self.product_sync.sync(self.connector, 'example_id'))
+        self.assertEquals(0, self.connector.update_product.call_count)
+
+    def test_sync_changed_fields(self):
+        state = self._set_state(name='Old name', version='0.9')
+
+        changes = self.product_sync.sync(self.connector, 'example_id')
+
+        self.assertEquals({'name': 'Dataset A', 'version': '1.0'}, changes)
+        self.connector.update_product.assert_called_once_with('http://store/product/1', changes)
+        self.assertEquals('Dataset A', json.loads(state.spec)['name'])
+        sync.model.Session.commit.assert_called_once_with()
+
+    def test_sync_changed_license(self):
+        self._set_state()
+        self.package_show.return_value['license_title'] = 'odc-odbl'
+
+        changes = self.product_sync.sync(self.connector, 'example_id')
+
+        self.assertEquals(['productSpecCharacteristic'], list(changes.keys()))
+        # The description given on publication is kept
+        self.assertEquals([LOCATION, {'name': 'License', 'description': 'Attribution required',
+                                      'productSpecCharacteristicValue': [{'value': 'odc-odbl'}]}],
+                          changes['productSpecCharacteristic'])
+
+    @parameterized.expand([
+        (401, True),
+        (403, True),
+        (400, False),
+    ])
+    def test_sync_falls_back_to_service_account(self, status_code, fallback):
+        self._set_state(name='Old name')
+        editor = MagicMock()
+        editor._get_user.return_value = 'editor'
+        editor.validate_version.side_effect = lambda version: version
+        editor.update_product.side_effect = sync.StoreRequestError('Forbidden', status_code)
+
+        if fallback:
+            self.product_sync.sync(editor, 'example_id')
+            self.connector.bind_service.return_value.update_product.assert_called_once_with(
+                'http://store/product/1', {'name': 'Dataset A'})
+            sync.model.Session.commit.assert_called_once_with()
+        else:
+            with self.assertRaises(sync.StoreRequestError):
+                self.product_sync.sync(editor, 'example_id')
+            self.assertEquals(0, self.connector.bind_service.call_count)
+
+    def test_sync_without_service_account(self):
+        self._set_state(name='Old name')
+        error = sync.StoreRequestError('Forbidden', 403)
+        self.connector.update_product.side_effect = error
+        self.connector._get_user.return_value = 'editor'
+        self.connector.bind_service.side_effect = Exception('Not configured')
+
+        with self.assertRaises(sync.StoreRequestError) as cm:
+            self.product_sync.sync(self.connector, 'example_id')
+
+        # The error of the store is reported, not the missing configuration
+        self.assertIs(error, cm.exception)
+        self.assertEquals(0, sync.model.Session.commit.call_count)
+
+    def test_sync_first_time_uses_current_product(self):
+        sync.db.ProductSync.by_package.return_value = None
+        self.connector._get_existing_products.return_value = [{
+            'id': '1',
+            'href': 'http://store/product/1',
+            'name': DATASET['title'],
+            'description': 'Old description',
+            'version': DATASET['version'],
+            'productSpecCharacteristic': [LOCATION, LICENSE]
+        }]
+
+        changes = self.product_sync.sync(self.connector, 'example_id')
+
+        self.assertEquals({'description': 'Description'}, changes)
+        self.connector.update_product.assert_called_once_with('http://store/product/1', changes)
+        state = sync.db.ProductSync.return_value
+        self.assertEquals('1', state.product_id)
+        sync.model.Session.add.assert_called_once_with(state)
+
+    def test_sync_product_not_found(self):
+        sync.db.ProductSync.by_package.return_value = None
+        self.connector._get_existing_products.return_value = []
+
+        self.assertEquals({}, self.product_sync.sync(self.connector, 'example_id'))
+        self.assertEquals(0, self.connector.update_product.call_count)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+import ckanext.baepublisher.tracing as tracing
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock, patch
+from parameterized import parameterized
+
+
+class TracingTest(unittest.TestCase):
+
+    def setUp(self):
+        self._exporter = tracing.EXPORTER
+        tracing.EXPORTER = MagicMock()
+
+    def tearDown(self):
+        tracing.EXPORTER = self._exporter
+
+    @parameterized.expand([
+        ('http://store.com/DSProductCatalog/api/catalogManagement/v2/category', '/DSProductCatalog/api/catalogManagement/v2/category'),
+        ('http://store.com/DSProductCatalog/api/catalogManagement/v2/productSpecification/12:(0.1)', '/DSProductCatalog/api/catalogManagement/v2/productSpecification/{id}'),
+        ('http://store.com/DSProductCatalog/api/catalogManagement/v2/catalog/3/productOffering?relatedParty.id=user', '/DSProductCatalog/api/catalogManagement/v2/catalog/{id}/productOffering'),
+        ('http://store.com/charging/api/assetManagement/assets/uploadJob/0f8fad5b-d9cb-469f-a165-70867728950e', '/charging/api/assetManagement/assets/uploadJob/{id}'),
+    ])
+    def test_get_endpoint_template(self, url, expected):
+        self.assertEquals(expected, tracing.get_endpoint_template(url))
+
+    def test_disabled(self):
+        tracing.EXPORTER = None
+
+        with tracing.span('create_offering') as span:
+            self.assertFalse(span.recording)
+            span.set_attribute('dataset', 'dataset1')
+            self.assertEquals({}, tracing.inject({}))
+
+        self.assertIsNone(tracing.current_span())
+
+    def test_nested_spans(self):
+        with tracing.span('create_offering', {'dataset': 'dataset1'}) as parent:
+            with tracing.span('store GET') as child:
+                self.assertEquals({'traceparent': '00-%s-%s-01' % (parent.trace_id, child.span_id)}, tracing.inject({}))
+
+        self.assertIsNone(tracing.current_span())
+        self.assertEquals([child, parent], [args[0][0] for args in tracing.EXPORTER.export.call_args_list])
+        self.assertEquals(parent.trace_id, child.trace_id)
+        self.assertEquals(parent.span_id, child.parent_id)
+        self.assertIsNone(parent.parent_id)
+        self.assertEquals(32, len(parent.trace_id))
+        self.assertEquals(16, len(parent.span_id))
+        self.assertEquals({'dataset': 'dataset1'}, parent.attributes)
+
+    def test_errors_are_recorded(self):
+        with self.assertRaises(ValueError):
+            with tracing.span('store GET'):
+                raise ValueError('failed')
+
+        span = tracing.EXPORTER.export.call_args[0][0]
+        self.assertEquals('ValueError: failed', span.error)
+        self.assertIsNotNone(span.end)
+
+    @patch('ckanext.baepublisher.tracing.log')
+    def test_export_errors_do_not_fail(self, log):
+        tracing.EXPORTER.export.side_effect = IOError('Disk full')
+
+        with tracing.span('store GET'):
+            pass
+
+        self.assertEquals(1, log.warn.call_count)
+
+    def test_traced(self):
+        @tracing.traced('delete_attached_resources', lambda dataset: {'dataset': dataset['id']})
+        def delete_attached_resources(dataset):
+            return tracing.current_span()
+
+        span = delete_attached_resources({'id': 'dataset1'})
+
+        self.assertEquals('delete_attached_resources', span.name)
+        self.assertEquals({'dataset': 'dataset1'}, span.attributes)
+
+    @parameterized.expand([
+        ('none', type(None)),
+        ('file', tracing.FileExporter),
+        ('otlp', tracing.OTLPExporter),
+        ('ckanext.baepublisher.tracing:FileExporter', tracing.FileExporter),
+    ])
+    def test_configure(self, name, exporter_class):
+        tracing.configure({'ckan.baepublisher.tracing': name})
+        self.assertIsInstance(tracing.EXPORTER, exporter_class)
+
+    def test_file_exporter(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'traces.jsonl')
+            tracing.EXPORTER = tracing.FileExporter({'ckan.baepublisher.tracing_file': path})
+
+            with tracing.span('create_offering'):
+                with tracing.span('store GET', {'http.status_code': 200}):
+                    pass
+
+            with open(path) as f:
+                spans = [json.loads(line) for line in f]
+
+            self.assertEquals(['store GET', 'create_offering'], [span['name'] for span in spans])
+            self.assertEquals({'http.status_code': 200}, spans[0]['attributes'])
+            self.assertEquals(spans[1]['span_id'], spans[0]['parent_id'])
+        finally:
+            shutil.rmtree(directory)
+
+    @patch('ckanext.baepublisher.tracing.threading.Thread')
+    def test_otlp_exporter_batches_traces(self, thread):
+        exporter = tracing.OTLPExporter({})
+
+        parent = tracing.Span('create_offering')
+        child = tracing.Span('store GET', parent, {'http.method': 'GET', 'http.status_code': 200})
+        child.end = parent.end = parent.start + 1
+
+        # Spans are only sent when the trace finishes
+        exporter.export(child)
+        self.assertEquals(0, thread.call_count)
+        exporter.export(parent)
+        thread.assert_called_once_with(target=exporter.send, args=([child, parent],))
+
+        body = exporter.to_otlp([child, parent])
+        spans = body['resourceSpans'][0]['scopeSpans'][0]['spans']
+        self.assertEquals([3, 1], [span['kind'] for span in spans])
+        self.assertEquals(parent.span_id, spans[0]['parentSpanId'])
+        self.assertEquals([
+            {'key': 'http.method', 'value': {'stringValue': 'GET'}},
+            {'key': 'http.status_code', 'value': {'intValue': '200'}},
+        ], spans[0]['attributes'])
@@ -20,11 +20,12 @@
 from __future__ import unicode_literals
 import ckanext.baepublisher.controllers.ui_controller as controller
 import base64
+import json
 import os
 import unittest
 import requests
 
-from mock import MagicMock
+from mock import MagicMock, mock_open, patch
 from parameterized import parameterized
 
 
@@ -53,11 +54,16 @@ class UIControllerTest(unittest.TestCase):
 
         self._base64 = controller.base64
         controller.base64 = MagicMock()
+        # The default logo has already been loaded by a previous request
+        controller._LOGO_CKAN_B64 = LOGO_CKAN_B64
 
         self._StoreConnector = controller.StoreConnector
         self._store_connector_instance = MagicMock(store_url='localhost')
         controller.StoreConnector = MagicMock(return_value=self._store_connector_instance)
 
+        controller.reference_data.CACHE.clear()
+        controller.reference_data.VALIDATORS.clear()
+
         # Create the plugin
         self.instanceController = controller.PublishControllerUI()
 
@@ -65,9 +71,11 @@ class UIControllerTest(unittest.TestCase):
         controller.StoreConnector = self._StoreConnector
 
     class MockResponse:
-        def __init__(self, json_data, status_code, dic):
+        def __init__(self, json_data, status_code, dic, headers={}):
             self.json_data = json_data
+            self.content = json.dumps(json_data).encode('utf-8')
             self.status_code = status_code
+            self.headers = headers
             self.called_Raise = False
             self.dic = dic
 
@@ -82,7 +90,7 @@ class UIControllerTest(unittest.TestCase):
 
         def raise_for_status(self):
             self.called_Raise = True
-            if self.status_code != 200:
+            if self.status_code not in (200, 304):
                 raise Exception
             else:
                 return self.status_code
@@ -99,6 +107,19 @@ class UIControllerTest(unittest.TestCase):
             else:
                 return []
 
+    def test_get_default_logo(self):
+        controller._LOGO_CKAN_B64 = None
+        open_file = mock_open(read_data=b'logo')
+
+        with patch('ckanext.baepublisher.controllers.ui_controller.open', open_file, create=True):
+            logo = controller.get_default_logo()
+            self.assertIs(logo, controller.get_default_logo())
+
+        # The file is only read the first time
+        open_file.assert_called_once_with(controller.filepath, 'rb')
+        controller.base64.b64encode.assert_called_once_with(b'logo')
+        self.assertEquals(controller.base64.b64encode.return_value, logo)
+
     @parameterized.expand([
         # Incorrect parameter
         ('offering', MockResponse({}, 403, []), {'lifecycleStatus': 'Launched'}),
@@ -118,7 +139,7 @@ class UIControllerTest(unittest.TestCase):
         requests.get.assert_called_once_with(
             '{0}/DSProductCatalog/api/catalogManagement/v2/{1}'.format(
                 self._store_connector_instance.store_url, content),
-            params=filters, verify=True)
+            params=filters, headers={}, verify=True)
 
         if content == 'category' or content == 'catalog':
             self.assertEquals(r, {'id': '1'})
@@ -128,6 +149,170 @@ class UIControllerTest(unittest.TestCase):
             self.assertEquals(self.instanceController._get_content(content), {})
             self.assertTrue(resp.called_Raise)
 
+    def test_get_content_cached(self):
+        requests.get = MagicMock(return_value=self.MockResponse([{'id': '1'}], 200, []))
+        controller.plugins.toolkit.c.user = 'eugenio'
+        controller.plugins.toolkit.c.errors = {}
+
+        self.assertEquals([{'id': '1'}], self.instanceController._get_content('category'))
+        self.assertEquals([{'id': '1'}], controller.PublishControllerUI()._get_content('category'))
+
+        # Categories are shared by all the requests of the worker
+        self.assertEquals(1, requests.get.call_count)
+
+        # Catalogs are cached per user
+        self.instanceController._get_content('catalog')
+        controller.plugins.toolkit.c.user = 'other'
+        self.instanceController._get_content('catalog')
+        self.assertEquals(3, requests.get.call_count)
+
+    def test_get_content_not_modified(self):
+        controller.plugins.toolkit.c.user = 'eugenio'
+        controller.plugins.toolkit.c.errors = {}
+        requests.get = MagicMock(side_effect=[
+            self.MockResponse([{'id': '1'}], 200, [], {'ETag': '"v1"', 'Last-Modified': 'Mon, 01 Jan 2018 00:00:00 GMT'}),
+            self.MockResponse(None, 304, [])
+        ])
+
+        self.assertEquals([{'id': '1'}], self.instanceController._get_content('category'))
+
+        # The cached value has expired, so it is revalidated
+        controller.reference_data.CACHE.clear()
+        self.assertEquals([{'id': '1'}], self.instanceController._get_content('category'))
+
+        self.assertEquals({
+            'If-None-Match': '"v1"',
+            'If-Modified-Since': 'Mon, 01 Jan 2018 00:00:00 GMT'
+        }, requests.get.call_args_list[1][1]['headers'])
+
+    @patch('ckanext.baepublisher.controllers.ui_controller.reference_data.get_category_snapshot')
+    def test_get_categories_from_snapshot(self, get_category_snapshot):
+        self.instanceController._get_content = MagicMock()
+        snapshot = get_category_snapshot.return_value
+
+        result = self.instanceController._get_categories()
+
+        self.assertEquals((snapshot.categories.return_value, snapshot.relatives.return_value), result)
+        self.assertEquals(0, self.instanceController._get_content.call_count)
+
+    @patch('ckanext.baepublisher.controllers.ui_controller.reference_data.publish_category_snapshot')
+    @patch('ckanext.baepublisher.controllers.ui_controller.reference_data.get_category_snapshot')
+    def test_get_categories_publishes_snapshot(self, get_category_snapshot, publish_category_snapshot):
+        get_category_snapshot.return_value = None
+        controller.plugins.toolkit.c.errors = {}
+        categories = [{'name': 'Programacion', 'isRoot': True, 'id': '1', 'href': 'http://store/category/1'}]
+        self.instanceController._get_content = MagicMock(return_value=categories)
+
+        result = self.instanceController._get_categories()
+
+        self.assertEquals((categories, {'1': {'id': '1', 'href': 'http://store/category/1'}}), result)
+        publish_category_snapshot.assert_called_once_with(*result)
+
+    @patch('ckanext.baepublisher.controllers.ui_controller.reference_data.publish_category_snapshot')
+    @patch('ckanext.baepublisher.controllers.ui_controller.reference_data.get_category_snapshot')
+    @patch('ckanext.baepublisher.controllers.ui_controller.reference_data.get_content')
+    def test_load_options(self, get_content, get_category_snapshot, publish_category_snapshot):
+        get_category_snapshot.return_value = None
+        get_content.side_effect = lambda store_url, content, user=None: {
+            'category': [
+                {'name': 'Programacion', 'isRoot': True, 'id': '1', 'href': 'http://store/category/1'},
+                {'name': 'java', 'isRoot': False, 'id': '5', 'parentId': '1', 'href': 'http://store/category/5'},
+                {'name': 'jvm', 'isRoot': False, 'id': '7', 'parentId': '5', 'href': 'http://store/category/7'},
+                {'name': 'Datos', 'isRoot': True, 'id': '6', 'href': 'http://store/category/6'},
+            ],
+            'catalog': [{'id': '51', 'name': 'catalog1', 'lifecycleStatus': 'Launched'}],
+        }[content]
+
+        self.assertEquals(([
+            {'value': '1', 'text': 'Programacion', 'depth': 0},
+            {'value': '5', 'text': 'java', 'depth': 1},
+            {'value': '7', 'text': 'jvm', 'depth': 2},
+            {'value': '6', 'text': 'Datos', 'depth': 0},
+        ], None), self.instanceController._load_options('category'))
+        self.assertEquals(1, publish_category_snapshot.call_count)
+
+        self.assertEquals(([{'value': '51', 'text': 'catalog1'}], None),
+                          self.instanceController._load_options('catalog', 'eugenio'))
+        get_content.assert_called_with('localhost', 'catalog', 'eugenio')
+
+    @patch('ckanext.baepublisher.controllers.ui_controller.reference_data.get_content')
+    def test_load_options_error(self, get_content):
+        get_content.side_effect = controller.reference_data.ReferenceDataError('catalog', [])
+
+        self.assertEquals(([], 'catalog couldnt be loaded'), self.instanceController._load_options('catalog', 'eugenio'))
+
+    @parameterized.expand([
+        (None, ['catalogs', 'categories'], 'private'),
+        ('category', ['categories'], 'public'),
+        ('catalog', ['catalogs'], 'private'),
+    ])
+    @patch('ckanext.baepublisher.controllers.ui_controller.response')
+    def test_reference_data(self, content, keys, visibility, response):
+        controller.plugins.toolkit.c.user = 'eugenio'
+        controller.request.if_none_match = []
+        options = {'category': [{'value': '1', 'text': 'Programacion', 'depth': 0}], 'catalog': [{'value': '51', 'text': 'catalog1'}]}
+        self.instanceController._load_options = MagicMock(side_effect=lambda content, user=None: (options[content], None))
+
+        result = json.loads(self.instanceController.reference_data(content))
+
+        self.assertEquals(sorted(keys + ['errors']), sorted(result.keys()))
+        self.assertEquals([], result['errors'])
+        if 'categories' in keys:
+            self.assertEquals(options['category'], result['categories'])
+        if 'catalogs' in keys:
+            self.assertEquals(options['catalog'], result['catalogs'])
+        self.assertEquals('%s, max-age=%d' % (visibility, controller.reference_data.CACHE.ttl), response.cache_control)
+        self.assertEquals(32, len(response.etag))
+
+    @patch('ckanext.baepublisher.controllers.ui_controller.response')
+    def test_reference_data_not_modified(self, response):
+        controller.plugins.toolkit.c.user = 'eugenio'
+        controller.request.if_none_match = []
+        self.instanceController._load_options = MagicMock(return_value=([], None))
+
+        self.instanceController.reference_data()
+        controller.request.if_none_match = ['other', response.etag]
+
+        self.assertEquals('', self.instanceController.reference_data())
+        self.assertEquals(304, response.status_int)
+
+    @patch('ckanext.baepublisher.controllers.ui_controller.response')
+    def test_reference_data_errors_are_not_cached(self, response):
+        controller.plugins.toolkit.c.user = 'eugenio'
+        controller.request.if_none_match = []
+        self.instanceController._load_options = MagicMock(side_effect=[([], 'catalog couldnt be loaded'), ([], None)])
+
+        result = json.loads(self.instanceController.reference_data())
+
+        self.assertEquals(['catalog couldnt be loaded'], result['errors'])
+        self.assertEquals('no-store', response.cache_control)
+
+    @parameterized.expand([
+        ('offering', None, 404),
+        ('catalog', None, 401),
+        (None, None, 401),
+    ])
+    def test_reference_data_invalid(self, content, user, status):
+        controller.plugins.toolkit.c.user = user
+        controller.plugins.toolkit.abort.side_effect = Exception('aborted')
+
+        with self.assertRaises(Exception):
+            self.instanceController.reference_data(content)
+
+        self.assertEquals(status, controller.plugins.toolkit.abort.call_args[0][0])
+
+    def test_publish_form_does_not_wait_for_the_store(self):
+        controller.request.POST = {}
+        self.instanceController._get_content = MagicMock()
+        self.instanceController._get_categories = MagicMock()
+
+        self.instanceController.publish('package_id')
+
+        self.assertEquals(0, self.instanceController._get_content.call_count)
+        self.assertEquals(0, self.instanceController._get_categories.call_count)
+        self.assertEquals({}, controller.plugins.toolkit.c.offering)
+        controller.plugins.toolkit.render.assert_called_once_with('package/publish.html')
+
     @parameterized.expand([
         # (False, False, {},),
         # # Test missing fields and wrong version
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2014 - 2017 CoNWeT Lab., Universidad Politécnica de Madrid
+
+# This file is part of CKAN BAE Publisher Extension.
+
+# CKAN BAE Publisher Extension is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# CKAN BAE Publisher Extension is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with CKAN BAE Publisher Extension.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals
+
+from binascii import hexlify
+from contextlib import contextmanager
+import json
+import logging
+import numbers
+import os
+import re
+import threading
+import time
+from urlparse import urlparse
+
+from decorator import decorator
+
+log = logging.getLogger(__name__)
+
+# Path segments that identify a single element (e.g. 12, 12:(0.1) or UUIDs)
+ID_SEGMENT = re.compile(r'^(\d+(:\(.*\))?|[0-9a-fA-F-]{16,})$')
+
+_local = threading.local()
+
+
+def get_endpoint_template(url):
+    """
+    Returns the path of the URL with the element ids replaced by {id}, so the
+    requests to the same endpoint can be grouped
+    """
+    path = urlparse(url).path
+    return '/'.join('{id}' if ID_SEGMENT.match(segment) else segment for segment in path.split('/'))
+
+
+class Span(object):
+
+    recording = True
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else hexlify(os.urandom(16)).decode('ascii')
+        self.span_id = hexlify(os.urandom(8)).decode('ascii')
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.end = None
+        self.error = None
+
+    def set_attribute(self, name, value):
+        self.attributes[name] = value
+
+    def traceparent(self):
+        return '00-%s-%s-01' % (self.trace_id, self.span_id)
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start,
+            'end': self.end,
+            'duration': self.end - self.start if self.end is not None else None,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class NoopSpan(object):
+    """
+    Span used when tracing is disabled, it records nothing
+    """
+
+    recording = False
+    attributes = {}
+
+    def set_attribute(self, name, value):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class NoopExporter(object):
+
+    def __init__(self, config):
+        pass
+
+    def export(self, span):
+        pass
+
+
+class FileExporter(object):
+    """
+    Appends the finished spans to ckan.baepublisher.tracing_file, one JSON
+    document per line
+    """
+
+    def __init__(self, config):
+        self.path = config.get('ckan.baepublisher.tracing_file', 'baepublisher-traces.jsonl')
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), sort_keys=True, default=str)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+class OTLPExporter(object):
+    """
+    Sends the spans to an OpenTelemetry collector using OTLP over HTTP with
+    JSON encoding (ckan.baepublisher.tracing_endpoint). Spans are sent in
+    batches when a trace finishes or ckan.baepublisher.tracing_batch_size
+    spans are pending, from a background thread.
+    """
+
+    def __init__(self, config):
+        self.endpoint = config.get('ckan.baepublisher.tracing_endpoint', 'http://localhost:4318/v1/traces')
+        self.service_name = config.get('ckan.baepublisher.tracing_service_name', 'ckan')
+        self.batch_size = int(config.get('ckan.baepublisher.tracing_batch_size', 100))
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self._pending.append(span)
+            if span.parent_id is not None and len(self._pending) < self.batch_size:
+                return
+
+            spans, self._pending = self._pending, []
+
+        thread = threading.Thread(target=self.send, args=(spans,))
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def _get_value(value):
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, numbers.Integral):
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': '%s' % value}
+
+    def to_otlp(self, spans):
+        return {
+            'resourceSpans': [{
+                'resource': {
+                    'attributes': [{'key': 'service.name', 'value': {'stringValue': self.service_name}}]
+                },
+                'scopeSpans': [{
+                    'scope': {'name': 'ckanext-baepublisher'},
+                    'spans': [{
+                        'traceId': span.trace_id,
+                        'spanId': span.span_id,
+                        'parentSpanId': span.parent_id or '',
+                        'name': span.name,
+                        # SPAN_KIND_CLIENT for the requests to the store, SPAN_KIND_INTERNAL otherwise
+                        'kind': 3 if 'http.method' in span.attributes else 1,
+                        'startTimeUnixNano': str(int(span.start * 1e9)),
+                        'endTimeUnixNano': str(int(span.end * 1e9)),
+                        'attributes': [
+                            {'key': key, 'value': self._get_value(value)}
+                            for key, value in sorted(span.attributes.items())
+                        ],
+                        'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+                    } for span in spans]
+                }]
+            }]
+        }
+
+    def send(self, spans):
+        # Imported here since requests is only needed once the spans are sent
+        import requests
+
+        try:
+            requests.post(self.endpoint, json=self.to_otlp(spans), timeout=5)
+        except Exception as e:
+            log.warn('Traces could not be sent to %s: %s' % (self.endpoint, e))
+
+
+TRACING_EXPORTERS = {
+    'none': NoopExporter,
+    'file': FileExporter,
+    'otlp': OTLPExporter,
+}
+
+EXPORTER = None
+
+
+def configure(config):
+    """
+    Sets the exporter configured in ckan.baepublisher.tracing. The value can
+    be one of the included exporters (none, file, otlp) or the path of a
+    custom exporter class (my.module:MyExporter). Tracing is disabled by
+    default.
+    """
+    global EXPORTER
+
+    name = config.get('ckan.baepublisher.tracing', 'none').strip()
+
+    if name in TRACING_EXPORTERS:
+        exporter_class = TRACING_EXPORTERS[name]
+    else:
+        module_name, _, class_name = name.partition(':')
+        module = __import__(str(module_name), fromlist=[str(class_name)])
+        exporter_class = getattr(module, class_name)
+
+    EXPORTER = None if exporter_class is NoopExporter else exporter_class(config)
+
+
+def current_span():
+    return getattr(_local, 'span', None)
+
+
+@contextmanager
+def span(name, attributes=None):
+    """
+    Opens a span, child of the current span of the thread. When tracing is
+    disabled a span that records nothing is returned.
+    """
+    exporter = EXPORTER
+    if exporter is None:
+        yield NOOP_SPAN
+        return
+
+    parent = current_span()
+    new_span = Span(name, parent, attributes)
+    _local.span = new_span
+    try:
+        yield new_span
+    except Exception as e:
+        new_span.error = '%s: %s' % (type(e).__name__, e)
+        raise
+    finally:
+        _local.span = parent
+        new_span.end = time.time()
+        try:
+            exporter.export(new_span)
+        except Exception as e:
+            log.warn('Span %s could not be exported: %s' % (name, e))
+
+
+@contextmanager
+def activate(parent):
+    """
+    Makes the given span the current one of the thread, so the spans opened
+    by other threads on behalf of a request belong to its trace
+    """
+    previous = current_span()
+    _local.span = parent if isinstance(parent, Span) else None
+    try:
+        yield
+    finally:
+        _local.span = previous
+
+
+def inject(headers):
+    """
+    Adds the trace context of the current span to the headers of an outbound
+    request (W3C Trace Context)
+    """
+    current = current_span()
+    if current is not None:
+        headers['traceparent'] = current.traceparent()
+    return headers
+
+
+def traced(name, get_attributes=None):
+    """
+    Decorator that runs the function inside a span. get_attributes receives
+    the arguments of the call and returns the attributes of the span.
+    """
+
+    def _traced(func, *args, **kwargs):
+        if EXPORTER is None:
+            return func(*args, **kwargs)
+
+        attributes = get_attributes(*args, **kwargs) if get_attributes is not None else {}
+        with span(name, attributes):
+            return func(*args, **kwargs)
+
+    return decorator(_traced)
@@ -58,5 +58,8 @@ setup(
     entry_points='''
         [ckan.plugins]
         baepublisher=ckanext.baepublisher.plugin:StorePublisher
+
+        [paste.paster_command]
+        baepublisher=ckanext.baepublisher.commands:BaePublisherCommand
     ''',
 )